@@ -0,0 +1,210 @@
+"""bench.py: Benchmarks of the overhead of orchestrating tasks with PyREM.
+
+Remote commands are run through a fake ``ssh`` (and ``rsync``) put on the
+PATH, which runs commands locally, so that the benchmarks measure PyREM
+rather than the network. Results are printed (or written to a file) as JSON,
+so that they can be compared across commits:
+
+    python benchmarks/bench.py --output before.json
+    python benchmarks/bench.py --quick
+
+Each timing is the median over the repetitions, in seconds.
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+# pylint: disable=wrong-import-position
+from pyrem.task import (Parallel, RemoteTask, Sequential, SubprocessTask,
+                        STARTED_TASKS, cleanup)
+
+
+FAKE_SSH = """#!/bin/sh
+# Skips the options and the host, and runs the command locally
+for arg; do cmd=$arg; done
+exec sh -c "$cmd"
+"""
+
+FAKE_RSYNC = """#!/bin/sh
+exit 0
+"""
+
+
+def install_fakes():
+    """Put the fake ssh and rsync on the PATH, returning their directory."""
+    directory = tempfile.mkdtemp(prefix='pyrem-bench-')
+    for name, script in [('ssh', FAKE_SSH), ('rsync', FAKE_RSYNC)]:
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    os.environ['PATH'] = directory + os.pathsep + os.environ['PATH']
+    return directory
+
+
+def timed(func, repeat):
+    """Run a function **repeat** times, returning the median duration."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def bench_start_latency(repeat):
+    """Time ``start()`` alone, and ``start(wait=True)``, for one task."""
+    results = {}
+    for name, make in [
+            ('SubprocessTask', lambda: SubprocessTask(['true'])),
+            ('RemoteTask', lambda: RemoteTask('localhost', ['true']))]:
+        tasks = []
+
+        def start():
+            task = make()
+            task.start()
+            tasks.append(task)
+
+        results[name] = {
+            'start': timed(start, repeat),
+            'start_wait': timed(lambda: make().start(wait=True), repeat)}
+        for task in tasks:
+            task.wait()
+    return results
+
+
+def bench_parallel(sizes, repeat):
+    """Time running N tasks with a ``Parallel``, per N."""
+    results = {}
+    for size in sizes:
+        duration = timed(lambda: Parallel(
+            [SubprocessTask(['true']) for _ in range(size)]).start(wait=True),
+                         repeat)
+        results[str(size)] = {'total': duration,
+                              'tasks_per_second': size / duration}
+    return results
+
+
+def bench_sequential(length, repeat):
+    """Time a chain of tasks, compared to running them one by one."""
+    def one_by_one():
+        for _ in range(length):
+            SubprocessTask(['true']).start(wait=True)
+
+    chained = timed(lambda: Sequential(
+        [SubprocessTask(['true']) for _ in range(length)]).start(wait=True),
+                    repeat)
+    baseline = timed(one_by_one, repeat)
+    return {'length': length, 'total': chained,
+            'overhead_per_task': (chained - baseline) / length}
+
+
+def bench_cleanup(size, repeat):
+    """Time ``cleanup()`` stopping N running local and remote tasks."""
+    def run():
+        for i in range(size):
+            if i % 2:
+                RemoteTask('localhost', ['sleep 60']).start()
+            else:
+                SubprocessTask(['sleep', '60']).start()
+        start = time.perf_counter()
+        # Keep the messages of cleanup() out of the results
+        with contextlib.redirect_stdout(sys.stderr):
+            cleanup()
+        durations.append(time.perf_counter() - start)
+        assert not STARTED_TASKS
+
+    durations = []
+    for _ in range(repeat):
+        run()
+    return {'tasks': size, 'total': statistics.median(durations)}
+
+
+def bench_memory(size):
+    """Measure the memory used by the controller per task."""
+    results = {}
+    for name, make in [
+            ('SubprocessTask', lambda: SubprocessTask(['true'])),
+            ('RemoteTask', lambda: RemoteTask('localhost', ['true'])),
+            ('RemoteTask started', lambda: RemoteTask('localhost', ['true']))]:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        tasks = [make() for _ in range(size)]
+        if name.endswith('started'):
+            parallel = Parallel(tasks)
+            parallel.start()
+            after = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            parallel.wait()
+        else:
+            after = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+        results[name] = {'bytes_per_task': (after - before) / size}
+    return results
+
+
+def git_revision():
+    """Return the commit being benchmarked, if in a git checkout."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help="file to write the JSON results to")
+    parser.add_argument('--quick', action='store_true',
+                        help="fewer repetitions and smaller sizes")
+    args = parser.parse_args()
+
+    repeat = 3 if args.quick else 10
+    sizes = [10, 100] if args.quick else [10, 100, 1000]
+    directory = install_fakes()
+    try:
+        results = {
+            'start_latency': bench_start_latency(repeat * 5),
+            'parallel': bench_parallel(sizes, repeat),
+            'sequential': bench_sequential(20 if args.quick else 100, repeat),
+            'cleanup': bench_cleanup(sizes[-1], min(repeat, 3)),
+            'memory': bench_memory(100 if args.quick else 1000),
+        }
+    finally:
+        shutil.rmtree(directory)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
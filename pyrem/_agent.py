@@ -0,0 +1,182 @@
+"""_agent.py: The agent run on remote hosts by ``pyrem.agent``.
+
+This module is sent to the remote host over ssh and run there, so it must
+only use the standard library, and must work on any Python 3 the remote host
+might have.
+
+The agent reads requests from stdin and writes events to stdout, one JSON
+object per line:
+
+    {"op": "spawn", "id": 1, "cmd": "./server", "capture": true}
+    {"op": "signal", "id": 1, "sig": 9}
+    {"op": "stop", "id": 1, "grace": 1.0}
+
+    {"ev": "started", "id": 1, "pid": 4242}
+    {"ev": "output", "id": 1, "stream": "stdout", "data": "<base64>"}
+    {"ev": "exit", "id": 1, "code": 0}
+
+Each command runs in a shell, in a process group of its own, and signals are
+sent to the whole group. Stopping a command sends SIGTERM to its group, and
+SIGKILL to whatever is left of the group once the grace period (in seconds)
+has passed, even if the command itself has exited by then. An ``exit`` event
+is sent once the command has exited and all of its output has been sent.
+When stdin is closed (e.g. the ssh connection is lost), every command is
+killed and the agent exits.
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+
+import base64
+import json
+import os
+import select
+import signal
+import subprocess
+import time
+
+
+_READ_SIZE = 65536
+_POLL_INTERVAL = 0.05
+
+
+def _send(event):
+    line = (json.dumps(event) + '\n').encode()
+    while line:
+        line = line[os.write(1, line):]
+
+
+def _killpg(pgid, sig):
+    """Signal a process group, returning whether it still existed."""
+    try:
+        os.killpg(pgid, sig)
+    except OSError:
+        return False
+    return True
+
+
+class _Command(object):
+    """A command spawned by the agent."""
+    def __init__(self, command_id, command, capture):
+        self.id = command_id
+        output = subprocess.PIPE if capture else subprocess.DEVNULL
+        self.process = subprocess.Popen(
+            command, shell=True, stdin=subprocess.DEVNULL, stdout=output,
+            stderr=output, start_new_session=True)
+        self.pipes = {}
+        if capture:
+            for name in ['stdout', 'stderr']:
+                pipe = getattr(self.process, name)
+                self.pipes[pipe.fileno()] = (name, pipe)
+
+    def read(self, fd):
+        """Send the output available on a pipe, closing it at EOF."""
+        try:
+            data = os.read(fd, _READ_SIZE)
+        except OSError:
+            data = b''
+        name, pipe = self.pipes[fd]
+        if data:
+            _send({'ev': 'output', 'id': self.id, 'stream': name,
+                   'data': base64.b64encode(data).decode()})
+        else:
+            del self.pipes[fd]
+            pipe.close()
+
+    def signal(self, sig):
+        _killpg(self.process.pid, sig)
+
+    def finished(self):
+        """Send the exit event if the command is done, returning whether."""
+        if self.pipes or self.process.poll() is None:
+            return False
+        _send({'ev': 'exit', 'id': self.id, 'code': self.process.returncode})
+        return True
+
+
+def main():
+    """Serve requests until stdin is closed."""
+    commands = {}
+    # Maps the process groups being stopped to when to kill them
+    stopping = {}
+    try:
+        _serve(commands, stopping)
+    finally:
+        # Never leave commands behind, even if the controller went away while
+        # events were being sent to it
+        for command in commands.values():
+            command.signal(signal.SIGKILL)
+        for pgid in stopping:
+            _killpg(pgid, signal.SIGKILL)
+
+
+def _serve(commands, stopping):
+    buf = b''
+    stdin_open = True
+    while stdin_open or commands or stopping:
+        fds = {}
+        for command in commands.values():
+            for fd in command.pipes:
+                fds[fd] = command
+        waiting = [fd for fd in [0] if stdin_open] + list(fds)
+        # Poll for commands whose output is closed but which haven't exited,
+        # and for the groups being stopped
+        polling = stopping or any(not c.pipes for c in commands.values())
+        timeout = _POLL_INTERVAL if polling else None
+        readable, _, _ = select.select(waiting, [], [], timeout)
+
+        for fd in readable:
+            if fd in fds:
+                fds[fd].read(fd)
+                continue
+            data = os.read(0, _READ_SIZE)
+            if not data:
+                # The controller is gone, kill everything
+                stdin_open = False
+                for command in commands.values():
+                    command.signal(signal.SIGKILL)
+                for pgid in stopping:
+                    _killpg(pgid, signal.SIGKILL)
+                stopping.clear()
+                continue
+            buf += data
+            *lines, buf = buf.split(b'\n')
+            for line in lines:
+                request = json.loads(line.decode())
+                if request['op'] == 'spawn':
+                    try:
+                        command = _Command(request['id'], request['cmd'],
+                                           request['capture'])
+                    except OSError as e:
+                        _send({'ev': 'exit', 'id': request['id'],
+                               'code': 255, 'error': str(e)})
+                        continue
+                    commands[command.id] = command
+                    _send({'ev': 'started', 'id': command.id,
+                           'pid': command.process.pid})
+                elif request['op'] == 'signal':
+                    if request['id'] in commands:
+                        commands[request['id']].signal(request['sig'])
+                elif request['op'] == 'stop':
+                    if request['id'] in commands:
+                        pgid = commands[request['id']].process.pid
+                        _killpg(pgid, signal.SIGTERM)
+                        stopping.setdefault(
+                            pgid, time.monotonic() + request['grace'])
+
+        for command in list(commands.values()):
+            if command.finished():
+                del commands[command.id]
+
+        now = time.monotonic()
+        for pgid, deadline in list(stopping.items()):
+            if now >= deadline:
+                _killpg(pgid, signal.SIGKILL)
+                del stopping[pgid]
+            elif not _killpg(pgid, 0):
+                del stopping[pgid]
+
+
+if __name__ == '__main__':
+    main()
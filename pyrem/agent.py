@@ -0,0 +1,315 @@
+"""agent.py: Contains tasks run through an agent on the remote host.
+
+Rather than running every command with its own ssh command (and killing it
+with yet another one), a ``RemoteHost`` created with `use_agent=True` starts
+a small agent on the host, written in pure Python, over a single ssh
+connection. Commands are then started, streamed, signalled and reaped by
+sending messages to the agent, so starting a command takes a round trip over
+an open connection rather than an ssh handshake, and the exact exit code and
+PID of each command are reported.
+
+The agent needs a Python 3 interpreter on the remote host. See
+``pyrem._agent`` for the protocol.
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+__all__ = ['AgentConnection', 'AgentTask']
+
+import base64
+import itertools
+import json
+import os
+import shlex
+import signal
+import sys
+
+from subprocess import Popen, PIPE
+from threading import Lock
+
+from pyrem.reactor import REACTOR
+from pyrem.task import Task, CLEANUP_HOOKS, _REPR, _Output
+
+
+# Connections which might still be open
+_CONNECTIONS = set()
+
+def _close_connections():
+    """Close all agent connections, run by ``pyrem.task.cleanup()``."""
+    for connection in _CONNECTIONS.copy():
+        connection.close()
+
+CLEANUP_HOOKS.append(_close_connections)
+
+
+def _bootstrap_command(python):
+    """Return the shell command which runs the agent sent to its stdin."""
+    with open(os.path.join(os.path.dirname(__file__), '_agent.py'), 'rb') as f:
+        source = f.read() + b'\nmain()\n'
+    # Read exactly the source, leaving the requests which follow it unread
+    loader = ('import os;n=%d;s=b"";'
+              'exec("while len(s)<n:s+=os.read(0,n-len(s))");'
+              'exec(compile(s,"pyrem_agent","exec"))' % len(source))
+    return '%s -c %s' % (python, shlex.quote(loader)), source
+
+
+class AgentConnection(object):
+    """A connection to an agent running on a host.
+
+    The agent is started when the connection is created. If the connection is
+    lost, the commands running through it are killed by the agent, and are
+    reported to have exited with code `255`.
+
+    Args:
+        launcher (list of str): The command which runs a shell command given
+            as its last argument on the host, e.g. ``['ssh', 'host']``.
+
+        hostname (str): The name of the host. Default `None`.
+
+        python (str): The Python interpreter on the host. Default
+            `'python3'`.
+    """
+    def __init__(self, launcher, hostname=None, python='python3'):
+        self.hostname = hostname
+        self._lock = Lock()
+        self._handlers = {}
+        self._ids = itertools.count(1)
+        self._buffer = b''
+        self.closed = False
+
+        command, source = _bootstrap_command(python)
+        self._process = Popen(list(launcher) + [command], stdin=PIPE,
+                              stdout=PIPE)
+        self._process.stdin.write(source)
+        self._process.stdin.flush()
+        _CONNECTIONS.add(self)
+        REACTOR.add_reader(self._process.stdout, self._handle_data)
+
+    def spawn(self, command, capture, handler):
+        """Run a shell command through the agent.
+
+        Args:
+            command (str): The command.
+
+            capture (bool): Whether to send back the output of the command,
+                or to discard it.
+
+            handler (function): Called on PyREM's I/O thread with each event
+                about the command (see ``pyrem._agent``), as a dict.
+
+        Returns:
+            int: The id of the command, to signal it.
+        """
+        with self._lock:
+            command_id = next(self._ids)
+            self._handlers[command_id] = handler
+            if not self.closed:
+                self._send({'op': 'spawn', 'id': command_id, 'cmd': command,
+                            'capture': capture})
+                return command_id
+        handler({'ev': 'exit', 'id': command_id, 'code': 255})
+        return command_id
+
+    def signal(self, command_id, sig=signal.SIGKILL):
+        """Send a signal to the process group of a command."""
+        with self._lock:
+            if not self.closed and command_id in self._handlers:
+                self._send({'op': 'signal', 'id': command_id, 'sig': int(sig)})
+
+    def stop(self, command_id, grace_period):
+        """Send SIGTERM to the process group of a command, then SIGKILL.
+
+        The group is killed by the agent if any of it is left after
+        **grace_period** seconds.
+        """
+        with self._lock:
+            if not self.closed and command_id in self._handlers:
+                self._send({'op': 'stop', 'id': command_id,
+                            'grace': grace_period})
+
+    def _send(self, request):
+        """Send a request. Must be called with the lock held."""
+        try:
+            self._process.stdin.write((json.dumps(request) + '\n').encode())
+            self._process.stdin.flush()
+        except (OSError, ValueError):
+            # The connection is gone, which _handle_data will report
+            pass
+
+    def _handle_data(self, data):
+        if not data:
+            self._lost()
+            return
+        self._buffer += data
+        lines = self._buffer.split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            event = json.loads(line.decode())
+            with self._lock:
+                if event['ev'] == 'exit':
+                    handler = self._handlers.pop(event['id'], None)
+                else:
+                    handler = self._handlers.get(event['id'])
+            if handler:
+                handler(event)
+
+    def _lost(self):
+        """Report the commands still running as failed, once EOF is read."""
+        with self._lock:
+            self.closed = True
+            handlers, self._handlers = self._handlers, {}
+        _CONNECTIONS.discard(self)
+        for command_id, handler in handlers.items():
+            handler({'ev': 'exit', 'id': command_id, 'code': 255})
+
+    def close(self):
+        """Close the connection, killing the commands still running."""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+        self._process.wait()
+        _CONNECTIONS.discard(self)
+
+
+class AgentTask(Task):
+    """A task to run a command through an ``AgentConnection``.
+
+    Behaves like ``pyrem.task.RemoteTask``: the command is run by a shell on
+    the host, its processes (all of the processes in its process group) are
+    sent SIGTERM when the task is stopped, and SIGKILL if any are left after
+    **grace_period** seconds, and ``return_values`` holds the same
+    values. ``return_values[\'retcode\']`` is the exact exit code of the
+    command (negative if it was killed by a signal, `255` if the connection
+    was lost), and ``return_values[\'pid\']`` its PID on the host.
+
+    Attributes:
+        host (str): The name of the host the task will run on.
+
+    Args:
+        connection (``AgentConnection``): The connection to run through.
+
+        command (list of str): The command to execute.
+
+        quiet (bool): See ``pyrem.task.SubprocessTask``. Default `False`.
+
+        return_output (bool): See ``pyrem.task.SubprocessTask``. Default
+            `False`.
+
+        require_success (bool): See ``pyrem.task.SubprocessTask``. Default
+            `False`.
+
+        output_callback (function): See ``pyrem.task.SubprocessTask``.
+            Default `None`.
+
+        max_output_lines (int): See ``pyrem.task.SubprocessTask``. Default
+            `None`.
+
+        log (``pyrem.logs.LogMultiplexer``): See
+            ``pyrem.task.SubprocessTask``. Default `None`.
+
+        grace_period (float): See ``pyrem.task.SubprocessTask``. Default `1`.
+    """
+    __slots__ = ('host', '_connection', '_command', '_quiet',
+                 '_return_output', '_require_success', '_output_callback',
+                 '_max_output_lines', '_log', '_grace_period', '_id',
+                 '_output', '_retcode', '_pid')
+
+    _reports_done = True
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, connection, command, quiet=False, return_output=False,
+                 require_success=False, output_callback=None,
+                 max_output_lines=None, log=None, grace_period=1.0):
+        super(AgentTask, self).__init__()
+        assert isinstance(command, list)
+        self.host = connection.hostname
+        self._connection = connection
+        self._command = ' '.join(str(c) for c in command)
+        self._quiet = quiet
+        self._return_output = return_output
+        self._require_success = require_success
+        self._output_callback = output_callback
+        self._max_output_lines = max_output_lines
+        self._log = log
+        self._grace_period = grace_period
+        self._id = None
+        self._output = None
+        self._retcode = None
+        self._pid = None
+
+    def _start(self):
+        self._retcode = self._pid = None
+        if self._return_output or self._output_callback or self._log:
+            max_lines = self._max_output_lines if self._return_output else 0
+            self._output = _Output(max_lines, self._output_callback)
+            if self._log:
+                self._log.attach(self)
+        self._id = self._connection.spawn(
+            self._command, not self._quiet or self._output is not None,
+            self._handle_event)
+
+    def _handle_event(self, event):
+        if event['ev'] == 'started':
+            self._pid = event['pid']
+        elif event['ev'] == 'output':
+            data = base64.b64decode(event['data'])
+            if self._output:
+                getattr(self._output, event['stream']).feed(data)
+            elif not self._quiet:
+                stream = getattr(sys, event['stream'])
+                stream.write(data.decode(errors='replace'))
+                stream.flush()
+        elif event['ev'] == 'exit':
+            self._retcode = event['code']
+            if self._output:
+                for stream in [self._output.stdout, self._output.stderr]:
+                    if not stream.closed:
+                        stream.feed(b'')
+            self._set_done()
+
+    def iter_output(self):
+        """See ``pyrem.task.SubprocessTask.iter_output``."""
+        if self._output is None:
+            raise RuntimeError("The output of %s isn't being read" % self)
+        return self._output.iter_lines()
+
+    def _wait(self):
+        self._wait_done()
+        retcode = self.return_values['retcode'] = self._retcode
+        if self._require_success and retcode:
+            raise RuntimeError("Return code should have been 0, was %s" %
+                               retcode)
+        if self._return_output:
+            self.return_values['stdout'] = self._output.stdout.value()
+            self.return_values['stderr'] = self._output.stderr.value()
+        else:
+            self.return_values['stdout'] = None
+            self.return_values['stderr'] = None
+        self.return_values['pid'] = self._pid
+
+    def _begin_stop(self):
+        if not self.done():
+            self._connection.stop(self._id, self._grace_period)
+
+    def _wait_stopped(self):
+        self._wait_done()
+
+    def _when_stoppable(self, func):
+        self.add_done_callback(lambda _task: func())
+
+    def _reset(self):
+        self._output = None
+
+    def _cache_key(self):
+        return ('AgentTask', self.host, self._command)
+
+    def __repr__(self):
+        return "AgentTask(status=%s, return_values=%s, host=%s, command=%s)" % (
+            self._status, _REPR.repr(self.return_values), self.host,
+            _REPR.repr(self._command))
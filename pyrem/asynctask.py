@@ -0,0 +1,445 @@
+"""asynctask.py: Contains tasks driven by an asyncio event loop.
+
+These tasks mirror the tasks in ``pyrem.task``, but their methods are
+coroutines and their subprocesses are managed by the event loop, so a single
+thread can drive any number of them. Requires Python 3.5 or later.
+
+Example:
+
+    async def main():
+        servers = AsyncParallel([AsyncRemoteTask(host, ['./server'])
+                                 for host in SERVERS])
+        await servers.start()
+        await asyncio.gather(*[AsyncRemoteTask(host, ['./client'])
+                               for host in CLIENTS])
+        await servers.stop()
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+__all__ = ['AsyncTask', 'AsyncSubprocessTask', 'AsyncRemoteTask',
+           'AsyncParallel', 'AsyncSequential']
+
+import asyncio
+import os
+import signal
+
+from collections import defaultdict
+from subprocess import DEVNULL, PIPE
+
+from pyrem.task import (STARTED_TASKS, RemoteTask, TaskStatus,
+                        _NEW_PROCESS_GROUP, _RemoteKill)
+
+
+class AsyncTask(object):
+    """Abstract class, the asyncio counterpart of ``pyrem.task.Task``.
+
+    Subclasses should implement the ``_start``, ``_wait`` and ``_stop``
+    coroutines, the ``_reset`` method, and the ``kill`` method.
+
+    Tasks go through the same states as ``pyrem.task.Task`` and are also
+    registered in ``pyrem.task.STARTED_TASKS`` while started. A task must only
+    be used from a single event loop.
+
+    Awaiting a task starts it and waits on it, so tasks can be passed directly
+    to ``asyncio.gather`` and the like. If a coroutine waiting on a task is
+    cancelled, the task is stopped.
+
+    Attributes:
+        return_values (dict): See ``pyrem.task.Task``.
+    """
+
+    def __init__(self):
+        self._status = TaskStatus.IDLE
+        self._stopped = None
+        self.return_values = {}
+
+    async def start(self, wait=False):
+        """Start a task.
+
+        Args:
+            wait (bool): Whether or not to wait on the task to finish before
+                returning. Default `False`.
+
+        Raises:
+            RuntimeError: If the task has already been started without a
+                subsequent call to ``reset()``.
+        """
+        if self._status is not TaskStatus.IDLE:
+            raise RuntimeError("Cannot start %s in state %s" %
+                               (self, self._status))
+        self._status = TaskStatus.STARTED
+        STARTED_TASKS.add(self)
+        await self._start()
+
+        if wait:
+            await self.wait()
+
+        return self.return_values
+
+    async def _start(self):
+        raise NotImplementedError
+
+    async def wait(self):
+        """Wait on a task to finish and stop it when it has finished.
+
+        Raises:
+            RuntimeError: If the task hasn't been started or has already been
+                stopped.
+
+        Returns:
+            The ``return_values`` of the task.
+        """
+        if self._status is not TaskStatus.STARTED:
+            raise RuntimeError("Cannot wait on %s in state %s" %
+                               (self, self._status))
+        try:
+            await self._wait()
+        except asyncio.CancelledError:
+            await self.stop()
+            raise
+        await self.stop()
+        return self.return_values
+
+    async def _wait(self):
+        pass
+
+    async def stop(self):
+        """Stop a task immediately.
+
+        Raises:
+            RuntimeError: If the task hasn't been started.
+        """
+        if self._status is TaskStatus.STOPPED:
+            return
+
+        if self._status is TaskStatus.STARTED:
+            self._status = TaskStatus.STOPPING
+            self._stopped = asyncio.ensure_future(self._stop())
+        elif self._status is not TaskStatus.STOPPING:
+            raise RuntimeError("Cannot stop %s in state %s" %
+                               (self, self._status))
+
+        # Shield the teardown, so that it completes even if one of the
+        # coroutines waiting on it is cancelled
+        await asyncio.shield(self._stopped)
+        if self._status is TaskStatus.STOPPING:
+            STARTED_TASKS.discard(self)
+            self._status = TaskStatus.STOPPED
+
+    async def _stop(self):
+        pass
+
+    def kill(self, wait=True):
+        """Stop a task synchronously, without the event loop.
+
+        Used by ``pyrem.task.cleanup()`` to stop the task when Python exits,
+        after the event loop has stopped running.
+
+        Args:
+            wait (bool): Whether or not to wait on the task to be completely
+                killed before returning from this function. If `False`,
+                ``wait_killed()`` must be called later to finish killing the
+                task, which allows the remote processes of several tasks to be
+                killed at once (see ``pyrem.task.stop_all()``). Default `True`.
+        """
+        if self._status in [TaskStatus.STARTED, TaskStatus.STOPPING]:
+            self._kill()
+            STARTED_TASKS.discard(self)
+            self._status = TaskStatus.STOPPED
+        if wait:
+            self.wait_killed()
+
+    def _kill(self):
+        pass
+
+    def wait_killed(self):
+        """Wait on a task killed with ``kill(wait=False)`` to be completely
+        killed. Does nothing if there is nothing left to wait on.
+        """
+        self._wait_killed()
+
+    def _wait_killed(self):
+        pass
+
+    def reset(self):
+        """Reset a task.
+
+        Allows a task to be started again, clears the ``return_values``.
+
+        Raises:
+            RuntimeError: If the task has not been stopped.
+        """
+        if self._status is not TaskStatus.STOPPED:
+            raise RuntimeError("Cannot reset %s in state %s" %
+                               (self, self._status))
+        self._reset()
+        self.return_values = {}
+        self._stopped = None
+        self._status = TaskStatus.IDLE
+
+    def _reset(self):
+        pass
+
+    def __await__(self):
+        return self.start(wait=True).__await__()
+
+    def __repr__(self):
+        return "AsyncTask(status=%s, return_values=%s)" % (
+            self._status, self.return_values)
+
+
+class AsyncSubprocessTask(AsyncTask):
+    """A task to run a command as a subprocess on the local host.
+
+    The asyncio counterpart of ``pyrem.task.SubprocessTask``, see it for the
+    arguments and ``return_values``. The subprocess runs in a process group of
+    its own, which is killed as a whole, without a grace period.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, command, quiet=False, return_output=False, shell=False,
+                 require_success=False):
+        super(AsyncSubprocessTask, self).__init__()
+        assert isinstance(command, list)
+        self._command = [str(c) for c in command]
+        self._shell = shell
+        self._require_success = require_success
+
+        self._subprocess_kwargs = dict(_NEW_PROCESS_GROUP, stdin=DEVNULL)
+        if shell:
+            self._command = ' '.join(self._command)
+        if return_output:
+            self._subprocess_kwargs['stdout'] = PIPE
+            self._subprocess_kwargs['stderr'] = PIPE
+        elif quiet:
+            self._subprocess_kwargs['stdout'] = DEVNULL
+            self._subprocess_kwargs['stderr'] = DEVNULL
+
+        self._process = None
+
+    async def _start(self):
+        if self._shell:
+            self._process = await asyncio.create_subprocess_shell(
+                self._command, **self._subprocess_kwargs)
+        else:
+            self._process = await asyncio.create_subprocess_exec(
+                *self._command, **self._subprocess_kwargs)
+
+    async def _wait(self):
+        # Wait for process to finish
+        output = await self._process.communicate()
+        # Raise error if necessary
+        retcode = self._process.returncode
+        if self._require_success and retcode:
+            raise RuntimeError("Return code should have been 0, was %s" %
+                               retcode)
+        # Put return code and output in return_values
+        self.return_values['stdout'] = output[0]
+        self.return_values['stderr'] = output[1]
+        self.return_values['retcode'] = retcode
+
+    async def _stop(self):
+        self._kill()
+        await self._process.wait()
+
+    def _kill(self):
+        # The processes left in the group are killed even once the
+        # subprocess itself has exited
+        if self._process:
+            try:
+                os.killpg(self._process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def __repr__(self):
+        return ("AsyncSubprocessTask(status=%s, return_values=%s, command=%s)"
+                % (self._status, self.return_values, self._command))
+
+
+class AsyncRemoteTask(AsyncSubprocessTask):
+    """A task to run a command on a remote host over ssh.
+
+    The asyncio counterpart of ``pyrem.task.RemoteTask``, see it for the
+    arguments and ``return_values``.
+
+    Attributes:
+        host (str): The name of the host the task will run on.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, host, command, quiet=False, return_output=False,
+                 kill_remote=True, identity_file=None, ssh_options=None):
+        assert isinstance(command, list)
+        self.host = host
+
+        self._ssh_cmd = ['ssh']
+        if identity_file:
+            self._ssh_cmd += ['-i', os.path.expanduser(identity_file)]
+        self._ssh_cmd += list(ssh_options or [])
+
+        self._kill_remote = kill_remote
+        self._remote_kill = None
+        if kill_remote:
+            self._tmp_file_name = RemoteTask._new_tmp_file_name() # pylint: disable=W0212
+            command = RemoteTask._log_pids(command, self._tmp_file_name) # pylint: disable=W0212
+
+        super(AsyncRemoteTask, self).__init__(
+            self._ssh_cmd + [host, ' '.join(command)], quiet=quiet,
+            return_output=return_output)
+
+    async def _stop(self):
+        # First, stop the ssh command
+        await super(AsyncRemoteTask, self)._stop()
+
+        if self._kill_remote:
+            kill_proc = await asyncio.create_subprocess_exec(
+                *(self._ssh_cmd +
+                  [self.host, _RemoteKill.command([self._tmp_file_name])]),
+                stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+            await kill_proc.wait()
+
+    def _kill(self):
+        super(AsyncRemoteTask, self)._kill()
+        if self._kill_remote:
+            # Run along with those of the other tasks killed before waiting
+            self._remote_kill = _RemoteKill.schedule(
+                self._ssh_cmd + [self.host], self._tmp_file_name)
+
+    def _wait_killed(self):
+        kill, self._remote_kill = self._remote_kill, None
+        if kill is not None:
+            kill.wait()
+
+    def __repr__(self):
+        return ("AsyncRemoteTask(status=%s, return_values=%s, command=%s)"
+                % (self._status, self.return_values, self._command))
+
+
+class AsyncParallel(AsyncTask):
+    """A task that executes several given tasks in parallel.
+
+    The asyncio counterpart of ``pyrem.task.Parallel``.
+
+    Args:
+        tasks (list of ``AsyncTask``): Tasks to execute.
+
+        max_concurrency (int): See ``pyrem.task.Parallel``. Default `None`.
+
+        max_per_host (int): See ``pyrem.task.Parallel``. Default `None`.
+    """
+    def __init__(self, tasks, max_concurrency=None, max_per_host=None):
+        super(AsyncParallel, self).__init__()
+        self._tasks = tasks
+        self._max_concurrency = max_concurrency
+        self._max_per_host = max_per_host
+        self._runner = None
+
+    async def _start(self):
+        if self._max_concurrency is None and self._max_per_host is None:
+            await asyncio.gather(*[task.start() for task in self._tasks])
+        else:
+            self._runner = asyncio.ensure_future(self._run_limited())
+
+    async def _run_limited(self):
+        """Run all of the tasks, within the concurrency limits."""
+        everywhere = asyncio.Semaphore(self._max_concurrency or len(self._tasks)
+                                       or 1)
+        per_host = defaultdict(
+            lambda: asyncio.Semaphore(self._max_per_host or len(self._tasks)))
+
+        async def run(task):
+            host = getattr(task, 'host', None)
+            if host is None:
+                async with everywhere:
+                    await task.start(wait=True)
+                return
+            # Wait on the host first, so that tasks queued behind a busy host
+            # don't hold slots which tasks on other hosts could use
+            async with per_host[host]:
+                async with everywhere:
+                    await task.start(wait=True)
+
+        await asyncio.gather(*[run(task) for task in self._tasks])
+
+    async def _wait(self):
+        if self._runner:
+            await self._runner
+        else:
+            await asyncio.gather(*[task.wait() for task in self._tasks])
+
+    async def _stop(self):
+        if self._runner:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
+        await asyncio.gather(*[task.stop() for task in self._tasks
+                               if task._status is not TaskStatus.IDLE]) # pylint: disable=W0212
+
+    def _kill(self):
+        for task in self._tasks:
+            task.kill(wait=False)
+
+    def _wait_killed(self):
+        for task in self._tasks:
+            task.wait_killed()
+
+    def _reset(self):
+        for task in self._tasks:
+            if task._status is not TaskStatus.IDLE: # pylint: disable=W0212
+                task.reset()
+
+    def __repr__(self):
+        return "AsyncParallel(status=%s, return_values=%s, tasks=%s)" % (
+            self._status, self.return_values, self._tasks)
+
+
+class AsyncSequential(AsyncTask):
+    """A task that executes several given tasks in sequence.
+
+    The asyncio counterpart of ``pyrem.task.Sequential``. Stopping the task
+    stops the task currently running, and no later tasks are started.
+
+    Args:
+        tasks (list of ``AsyncTask``): Tasks to execute.
+    """
+    def __init__(self, tasks):
+        super(AsyncSequential, self).__init__()
+        assert isinstance(tasks, list)
+        self._tasks = tasks
+        self._runner = None
+
+    async def _start(self):
+        self._runner = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        for task in self._tasks:
+            await task.start(wait=True)
+
+    async def _wait(self):
+        await self._runner
+
+    async def _stop(self):
+        self._runner.cancel()
+        await asyncio.gather(self._runner, return_exceptions=True)
+        await asyncio.gather(*[task.stop() for task in self._tasks
+                               if task._status is not TaskStatus.IDLE]) # pylint: disable=W0212
+
+    def _kill(self):
+        if self._runner:
+            self._runner.cancel()
+        for task in self._tasks:
+            task.kill(wait=False)
+
+    def _wait_killed(self):
+        for task in self._tasks:
+            task.wait_killed()
+
+    def _reset(self):
+        for task in self._tasks:
+            if task._status is not TaskStatus.IDLE: # pylint: disable=W0212
+                task.reset()
+        self._runner = None
+
+    def __repr__(self):
+        return "AsyncSequential(status=%s, return_values=%s, tasks=%s)" % (
+            self._status, self.return_values, self._tasks)
@@ -0,0 +1,306 @@
+"""cache.py: Contains an opt-in cache of the results of tasks.
+
+Like make, a cached task is skipped when nothing it depends on has changed
+since it last ran successfully: the command it runs, the host it runs on, and
+the contents of the input files declared for it. Its ``return_values`` and the
+output files declared for it are then restored from the cache instead.
+
+Example:
+
+    cache = ResultCache('~/.cache/pyrem')
+    build = Cached(SubprocessTask(['make', '-C', 'server']), cache,
+                   inputs=['server/src'], outputs=['server/bin/server'])
+    send = Cached(host.send_file('server/bin/server'), cache,
+                  inputs=['server/bin/server'])
+    Sequential([build, send]).start(wait=True)
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+__all__ = ['ResultCache', 'Cached']
+
+import hashlib
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+
+from threading import Lock
+
+from pyrem.task import (Task, TaskStatus, _on_finish, _reraise,
+                        _wait_finished, _when_all_stoppable)
+
+
+def _hash_path(path, digest):
+    """Add the name and contents of a file or directory tree to a digest."""
+    if os.path.isdir(path):
+        digest.update(b'd')
+        for name in sorted(os.listdir(path)):
+            digest.update(name.encode() + b'\0')
+            _hash_path(os.path.join(path, name), digest)
+    elif os.path.exists(path):
+        digest.update(('f%d\0' % os.path.getsize(path)).encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    else:
+        digest.update(b'-')
+
+
+def _tree_size(path):
+    """Return the total size of the files under a path."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def _copy(source, destination):
+    """Copy a file or directory tree, replacing the destination."""
+    if os.path.isdir(destination) and not os.path.islink(destination):
+        shutil.rmtree(destination)
+    elif os.path.lexists(destination):
+        os.remove(destination)
+    if os.path.isdir(source):
+        shutil.copytree(source, destination, symlinks=True)
+    else:
+        parent = os.path.dirname(destination)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        shutil.copy2(source, destination)
+
+
+class ResultCache(object):
+    """A directory on the local host holding the results of tasks.
+
+    Each entry holds the pickled ``return_values`` of a task and copies of its
+    output files. When the entries take up more than **max_bytes**, the least
+    recently used ones are evicted. Several processes can share a cache
+    directory, entries are added atomically.
+
+    Args:
+        directory (str): The directory of the cache, created if needed.
+
+        max_bytes (int): The maximum total size of the entries, in bytes.
+            Default `1 GiB`.
+    """
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    @staticmethod
+    def key(task, inputs=()):
+        """Compute the cache key of a task.
+
+        Args:
+            task (``pyrem.task.Task``): The task, which must support caching
+                (see ``Task._cache_key()``).
+
+            inputs (list of str): Paths of the files and directories the task
+                depends on, whose contents are part of the key. Default `()`.
+
+        Returns:
+            str: The key, as a hex digest.
+
+        Raises:
+            ValueError: If the task can't be cached.
+        """
+        task_key = task._cache_key() # pylint: disable=W0212
+        if task_key is None:
+            raise ValueError("%s can't be cached" % task)
+        digest = hashlib.sha256(repr(task_key).encode())
+        for path in inputs:
+            digest.update(b'\0' + os.path.abspath(path).encode() + b'\0')
+            _hash_path(path, digest)
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, outputs=()):
+        """Look up an entry, restoring its output files.
+
+        Args:
+            key (str): The key of the entry.
+
+            outputs (list of str): Where to restore the output files stored
+                with the entry, in the order they were stored. Default `()`.
+
+        Returns:
+            dict: The ``return_values`` stored with the entry, or `None` if
+                there is no such entry.
+        """
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, 'values.pickle'), 'rb') as f:
+                return_values = pickle.load(f)
+            for i, path in enumerate(outputs):
+                _copy(os.path.join(entry, 'outputs', str(i)), path)
+            # Mark the entry as recently used
+            os.utime(entry, None)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # Missing, partially evicted or corrupt
+            return None
+        return return_values
+
+    def put(self, key, return_values, outputs=()):
+        """Add an entry, then evict entries if the cache is too big.
+
+        Entries whose ``return_values`` can't be pickled are silently not
+        added.
+
+        Args:
+            key (str): The key of the entry.
+
+            return_values (dict): The ``return_values`` to store.
+
+            outputs (list of str): Paths of the output files to store.
+                Default `()`.
+        """
+        try:
+            values = pickle.dumps(return_values, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        staging = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with open(os.path.join(staging, 'values.pickle'), 'wb') as f:
+                f.write(values)
+            for i, path in enumerate(outputs):
+                _copy(path, os.path.join(staging, 'outputs', str(i)))
+            entry = self._entry(key)
+            with self._lock:
+                if os.path.isdir(entry):
+                    shutil.rmtree(entry, ignore_errors=True)
+                os.rename(staging, entry)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Evict the least recently used entries until the cache fits."""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.startswith('.'):
+                    continue
+                path = self._entry(name)
+                try:
+                    entries.append((os.path.getmtime(path), _tree_size(path),
+                                    path))
+                except OSError:
+                    continue
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        """Remove all of the entries."""
+        with self._lock:
+            for name in os.listdir(self.directory):
+                shutil.rmtree(self._entry(name), ignore_errors=True)
+
+
+class Cached(Task):
+    """A task which is skipped if its result is in a ``ResultCache``.
+
+    When started, the key of the wrapped task is computed from its command,
+    its host and the contents of its **inputs**. On a hit, the wrapped task is
+    never started; its ``return_values`` and **outputs** are restored from the
+    cache. On a miss, it is run, and if it succeeds (it raises no exception
+    and its return code, if it has one, is `0`) its results are added to the
+    cache.
+
+    The ``return_values`` are those of the wrapped task, with
+    ``return_values[\'cached\']`` set to whether they came from the cache.
+
+    Only the local files declared as **outputs** are restored. A cached
+    ``RemoteTask`` or file transfer is assumed to have left its effects on the
+    remote host in place.
+
+    Args:
+        task (``pyrem.task.Task``): The task to run.
+
+        cache (``ResultCache``): The cache to use.
+
+        inputs (list of str): Local files and directories the task depends on.
+            Default `()`.
+
+        outputs (list of str): Local files and directories the task produces.
+            Default `()`.
+
+    Raises:
+        ValueError: If the task can't be cached.
+    """
+    __slots__ = ('_task', '_cache', '_inputs', '_outputs', '_key',
+                 '_exception')
+
+    _reports_done = True
+
+    def __init__(self, task, cache, inputs=(), outputs=()):
+        super(Cached, self).__init__()
+        if task._cache_key() is None: # pylint: disable=W0212
+            raise ValueError("%s can't be cached" % task)
+        self._task = task
+        self._cache = cache
+        self._inputs = list(inputs)
+        self._outputs = list(outputs)
+        self._key = None
+        self._exception = None
+
+    def _start(self):
+        self._exception = None
+        self._key = self._cache.key(self._task, self._inputs)
+        return_values = self._cache.get(self._key, self._outputs)
+        if return_values is not None:
+            self.return_values = dict(return_values, cached=True)
+            self._set_done()
+        else:
+            self._task.start()
+            _on_finish(self._task, self._task_finished)
+
+    def _task_finished(self, task):
+        try:
+            _wait_finished(task)
+            if (task._status is TaskStatus.STOPPED and # pylint: disable=W0212
+                    self._status is TaskStatus.STARTED and
+                    not task.return_values.get('retcode')):
+                self._cache.put(self._key, task.return_values, self._outputs)
+        except: # pylint: disable=W0702
+            self._exception = sys.exc_info()
+        self.return_values = dict(task.return_values, cached=False)
+        self._set_done()
+
+    def _wait(self):
+        self._wait_done()
+        if self._exception:
+            _reraise(self._exception)
+
+    def _begin_stop(self):
+        if self._task._status is TaskStatus.STARTED: # pylint: disable=W0212
+            self._task.stop(wait=False)
+
+    def _wait_stopped(self):
+        if self._task._status is TaskStatus.STOPPING: # pylint: disable=W0212
+            self._task.wait_stopped()
+
+    def _when_stoppable(self, func):
+        _when_all_stoppable([self._task], func)
+
+    def _reset(self):
+        if self._task._status is not TaskStatus.IDLE: # pylint: disable=W0212
+            self._task.reset()
+
+    def _cache_key(self):
+        return self._task._cache_key() # pylint: disable=W0212
+
+    def __repr__(self):
+        return "Cached(status=%s, task=%s)" % (self._status, self._task)
@@ -0,0 +1,287 @@
+"""cas.py: Contains a content-addressed store of files on remote hosts.
+
+Files deployed through a ``ContentStore`` are uploaded once per host, to
+``<remote root>/<sha256 of the contents>``, and then hardlinked to wherever
+they are needed. The store remembers which blobs each host has in a local
+manifest, so deploying files a host already has (e.g. the same binary for
+another experiment, or to another path) only takes one ssh command to create
+the links.
+
+Example:
+
+    store = ContentStore()
+    deploys = [store.deploy(host, {'build/server': 'exp1/server',
+                                   'conf/exp1.json': 'exp1/conf.json'})
+               for host in HOSTS]
+    Parallel(deploys).start(wait=True)
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+__all__ = ['ContentStore', 'Deploy']
+
+import hashlib
+import json
+import os
+import posixpath
+import shlex
+import shutil
+import sys
+import tempfile
+
+from threading import Lock
+
+from pyrem.task import (Task, TaskStatus, RemoteTask, SubprocessTask,
+                        Sequential, _REPR, _accepted_kwargs, _on_finish,
+                        _reraise, _wait_finished, _when_all_stoppable)
+
+
+# Hashes of local files, by path, size and modification time
+_HASHES = {}
+
+def _file_hash(path):
+    """Return the sha256 of a local file, remembering it while unchanged."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    cache_key = (path, stat.st_size, stat.st_mtime_ns)
+    if cache_key not in _HASHES:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        _HASHES[cache_key] = digest.hexdigest()
+    return _HASHES[cache_key]
+
+
+class ContentStore(object):
+    """A content-addressed store of files on remote hosts.
+
+    Args:
+        remote_root (str): The directory holding the blobs on each host,
+            relative to the remote home directory unless absolute. Default
+            `'.pyrem/cas'`.
+
+        manifest (str): The local file in which the blobs known to be on each
+            host are recorded across runs. If `None`, they are only
+            remembered in memory. Default `'~/.cache/pyrem/cas.json'`.
+    """
+    def __init__(self, remote_root='.pyrem/cas',
+                 manifest='~/.cache/pyrem/cas.json'):
+        self.remote_root = remote_root
+        self._manifest_file = manifest and os.path.expanduser(manifest)
+        self._lock = Lock()
+        self._blobs = {}
+        if self._manifest_file and os.path.exists(self._manifest_file):
+            with open(self._manifest_file) as f:
+                self._blobs = {host: set(blobs)
+                               for host, blobs in json.load(f).items()}
+
+    def blobs(self, hostname):
+        """Return the set of blobs known to be on a host."""
+        with self._lock:
+            return set(self._blobs.get(hostname, ()))
+
+    def add(self, hostname, blobs):
+        """Record that a host has the given blobs."""
+        with self._lock:
+            self._blobs.setdefault(hostname, set()).update(blobs)
+            self._save()
+
+    def forget(self, hostname, blobs=None):
+        """Forget the blobs of a host, e.g. if its disk was wiped.
+
+        Args:
+            hostname (str): The host.
+
+            blobs (list of str): The blobs to forget. Default `None`, for all
+                of them.
+        """
+        with self._lock:
+            if blobs is None:
+                self._blobs.pop(hostname, None)
+            else:
+                self._blobs.get(hostname, set()).difference_update(blobs)
+            self._save()
+
+    def _save(self):
+        """Write the manifest. Must be called with the lock held."""
+        if not self._manifest_file:
+            return
+        directory = os.path.dirname(self._manifest_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory or None)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({host: sorted(blobs)
+                       for host, blobs in self._blobs.items()}, f)
+        os.rename(tmp, self._manifest_file)
+
+    def deploy(self, host, files, **kwargs):
+        """Build a task placing local files on a host through the store.
+
+        Args:
+            host (``pyrem.host.RemoteHost``): The host.
+
+            files (dict or list of str): Maps the local files to their
+                destinations on the host (relative to the remote home
+                directory unless absolute). A list of files is deployed to the
+                same paths.
+
+            **kwargs: Passed to the init methods of the underlying tasks (e.g.
+                **quiet**), each ignoring those it doesn't accept: the upload
+                is a ``pyrem.task.SubprocessTask``, and the linking a
+                ``pyrem.task.RemoteTask``.
+
+        Returns:
+            ``Deploy``: The resulting task.
+        """
+        return Deploy(self, host, files, **kwargs)
+
+    def _link_command(self, destinations):
+        """Return the remote command linking blobs to their destinations."""
+        directories = sorted(set(posixpath.dirname(d) for d in destinations)
+                             - set(['']))
+        commands = []
+        if directories:
+            commands.append('mkdir -p ' +
+                            ' '.join(shlex.quote(d) for d in directories))
+        for destination, blob in sorted(destinations.items()):
+            # Hardlinks can't cross filesystems, copy the blob there instead
+            commands.append('{ ln -f %(blob)s %(dest)s 2>/dev/null || '
+                            'cp -f %(blob)s %(dest)s; }' % {
+                                'blob': shlex.quote(posixpath.join(
+                                    self.remote_root, blob)),
+                                'dest': shlex.quote(destination)})
+        return ' && '.join(commands)
+
+
+class Deploy(Task):
+    """A task placing local files on a host through a ``ContentStore``.
+
+    Built by ``ContentStore.deploy()``. When started, the files are hashed,
+    the blobs the host is missing are uploaded with a single rsync, and the
+    destinations are hardlinked to the blobs with a single ssh command (or
+    copied, if they are on another filesystem than the store).
+
+    Since a destination shares its contents with the blob, it should be
+    replaced rather than modified in place.
+
+    If the deploy fails, the blobs it uploaded are still recorded in the
+    manifest, and the blobs it expected the host to have are dropped from it,
+    so that they are uploaded again next time.
+
+    ``return_values[\'uploaded\']`` holds the number of blobs uploaded.
+    """
+    __slots__ = ('_store', '_host', '_files', '_kwargs', '_task', '_hashes',
+                 '_upload', '_missing', '_staging', '_exception')
+
+    _reports_done = True
+
+    def __init__(self, store, host, files, **kwargs):
+        super(Deploy, self).__init__()
+        self._store = store
+        self._host = host
+        if not isinstance(files, dict):
+            files = {name: name for name in files}
+        self._files = files
+        self._kwargs = kwargs
+        self._task = None
+        self._hashes = None
+        self._upload = None
+        self._missing = None
+        self._staging = None
+        self._exception = None
+
+    def _start(self):
+        self._exception = None
+        hashes = {destination: _file_hash(source)
+                  for source, destination in self._files.items()}
+        known = self._store.blobs(self._host.hostname)
+        missing = {}
+        for source, destination in self._files.items():
+            if hashes[destination] not in known:
+                missing[hashes[destination]] = os.path.abspath(source)
+
+        tasks = []
+        self._upload = None
+        if missing:
+            # rsync follows the symlinks, uploading the files under their hash
+            self._staging = tempfile.mkdtemp(prefix='pyrem-cas-')
+            for blob, source in missing.items():
+                os.symlink(source, os.path.join(self._staging, blob))
+            root = shlex.quote(self._store.remote_root)
+            self._upload = SubprocessTask(
+                self._host._rsync_cmd() + # pylint: disable=W0212
+                ['-L', '--ignore-existing',
+                 '--rsync-path', 'mkdir -p %s && rsync' % root,
+                 self._staging + '/',
+                 '%s:%s/' % (self._host.hostname, self._store.remote_root)],
+                require_success=True,
+                **_accepted_kwargs(SubprocessTask, self._kwargs))
+            tasks.append(self._upload)
+        tasks.append(self._host.run(
+            [self._store._link_command(hashes)], # pylint: disable=W0212
+            require_success=True,
+            **_accepted_kwargs(RemoteTask, self._kwargs)))
+
+        self.return_values['uploaded'] = len(missing)
+        self._hashes = hashes
+        self._missing = set(missing)
+        self._task = Sequential(tasks)
+        self._task.start()
+        _on_finish(self._task, self._task_finished)
+
+    def _task_finished(self, task):
+        try:
+            _wait_finished(task)
+            # Unless this task was stopped
+            if self._status is TaskStatus.STARTED:
+                self._store.add(self._host.hostname, self._hashes.values())
+        except: # pylint: disable=W0702
+            self._exception = sys.exc_info()
+            if self._status is TaskStatus.STARTED:
+                self._update_manifest()
+        self._remove_staging()
+        self._set_done()
+
+    def _update_manifest(self):
+        """Record what is known to be on the host after a failed deploy."""
+        hostname = self._host.hostname
+        upload = self._upload
+        if upload is not None and upload.return_values.get('retcode') == 0:
+            self._store.add(hostname, self._missing)
+        # The link step fails if a blob the manifest listed is gone
+        self._store.forget(hostname,
+                           set(self._hashes.values()) - self._missing)
+
+    def _remove_staging(self):
+        if self._staging:
+            shutil.rmtree(self._staging, ignore_errors=True)
+            self._staging = None
+
+    def _wait(self):
+        self._wait_done()
+        if self._exception:
+            _reraise(self._exception)
+
+    def _begin_stop(self):
+        # pylint: disable=W0212
+        if self._task and self._task._status is TaskStatus.STARTED:
+            self._task.stop(wait=False)
+
+    def _wait_stopped(self):
+        # pylint: disable=W0212
+        if self._task and self._task._status is TaskStatus.STOPPING:
+            self._task.wait_stopped()
+        self._remove_staging()
+
+    def _when_stoppable(self, func):
+        _when_all_stoppable([self._task] if self._task else [], func)
+
+    def _reset(self):
+        self._task = None
+
+    def __repr__(self):
+        return "Deploy(status=%s, host=%s, files=%s)" % (
+            self._status, self._host.hostname, _REPR.repr(self._files))
@@ -9,8 +9,38 @@ __email__ = "emichael@cs.washington.edu"
 
 import os
 import platform
+import random
+import shlex
+import shutil
+import tempfile
+import time
+
+from subprocess import Popen
+from threading import Lock
+
+from pyrem.agent import AgentConnection, AgentTask
+from pyrem.task import (SubprocessTask, RemoteTask, Parallel, TaskGraph,
+                        CLEANUP_HOOKS, _REPR, _accepted_kwargs)
+
+
+# Directory holding the control sockets of shared ssh connections, created on
+# first use.
+_CONTROL_DIR = None
+
+# RemoteHosts which might have an open shared ssh connection.
+_CONNECTED_HOSTS = set()
+
+def _close_connections():
+    """Close all shared ssh connections, run by ``pyrem.task.cleanup()``."""
+    global _CONTROL_DIR # pylint: disable=W0603
+    for host in _CONNECTED_HOSTS.copy():
+        host.close()
+    if _CONTROL_DIR:
+        shutil.rmtree(_CONTROL_DIR, ignore_errors=True)
+        _CONTROL_DIR = None
+
+CLEANUP_HOOKS.append(_close_connections)
 
-from pyrem.task import SubprocessTask, RemoteTask
 
 class Host(object):
     """Abstract class, an object representing some host.
@@ -40,29 +70,115 @@ class Host(object):
 class RemoteHost(Host):
     """A remote host.
 
+    All of the tasks created by a ``RemoteHost`` (commands, file transfers and
+    the commands which kill remote processes) share a single ssh connection to
+    the host, which is opened by the first task that needs it. The connection
+    is closed when it has been idle for **control_persist** seconds, when
+    ``close()`` is called, or when Python exits.
+
     Args:
         hostname (str): The hostname of the remote host.
 
         identity_file (str): Path to identity file passed to ssh. Default
             `None`.
+
+        control_persist (int): Number of seconds the shared ssh connection is
+            kept open while idle. If `0`, it is kept open until ``close()`` is
+            called or Python exits. If `None`, every task opens its own ssh
+            connection. Default `60`.
+
+        use_agent (bool): If `True`, the commands given to ``run()`` are run
+            through an agent started on the host by the first of them (see
+            ``pyrem.agent``), which starts commands much faster than ssh. The
+            host needs a Python 3 interpreter. Default `False`.
     """
-    def __init__(self, hostname, identity_file=None):
+    def __init__(self, hostname, identity_file=None, control_persist=60,
+                 use_agent=False):
         super(RemoteHost, self).__init__(hostname)
         self._identity_file = identity_file
+        self._control_persist = control_persist
+        self._use_agent = use_agent
+        self._agent = None
+        self._agent_lock = Lock()
+
+    def _ssh_options(self):
+        """Helper method to generate the ssh options shared by all tasks."""
+        global _CONTROL_DIR # pylint: disable=W0603
+        if self._control_persist is None:
+            return []
+        if not _CONTROL_DIR:
+            _CONTROL_DIR = tempfile.mkdtemp(prefix='pyrem-')
+        _CONNECTED_HOSTS.add(self)
+
+        # %C is a hash of the user, host and port, which keeps the socket path
+        # short and lets RemoteHosts for the same host share a connection
+        return ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=' + os.path.join(_CONTROL_DIR, '%C'),
+                '-o', 'ControlPersist=%d' % self._control_persist]
 
     def run(self, command, **kwargs):
         """Run a command on the remote host.
 
-        This is just a wrapper around ``RemoteTask(self.hostname, ...)``
+        This is just a wrapper around ``RemoteTask(self.hostname, ...)``, or
+        ``pyrem.agent.AgentTask`` with **use_agent**, in which case the ssh
+        specific arguments (**kill_remote** and **ssh_options**) are ignored.
+        Tasks run through the agent can't be sampled.
         """
+        if self._use_agent:
+            if kwargs.get('sampler'):
+                raise ValueError("Commands run through the agent can't be "
+                                 "sampled")
+            kwargs.pop('kill_remote', None)
+            kwargs.pop('ssh_options', None)
+            return AgentTask(self._agent_connection(), command, **kwargs)
+        kwargs['ssh_options'] = (list(kwargs.get('ssh_options') or []) +
+                                 self._ssh_options())
         return RemoteTask(self.hostname, command,
                           identity_file=self._identity_file, **kwargs)
 
+    def _agent_connection(self):
+        """Return the connection to the agent, starting it if needed."""
+        with self._agent_lock:
+            if self._agent is None or self._agent.closed:
+                launcher = ['ssh']
+                if self._identity_file:
+                    launcher += ['-i', os.path.expanduser(self._identity_file)]
+                launcher += self._ssh_options() + [self.hostname]
+                self._agent = AgentConnection(launcher, self.hostname)
+            return self._agent
+
+    def close(self):
+        """Close the shared ssh connection to the host, if there is one.
+
+        Closing the connection to the agent kills the commands still running
+        through it. Tasks started afterwards will open a new connection as
+        needed.
+        """
+        with self._agent_lock:
+            if self._agent:
+                self._agent.close()
+                self._agent = None
+        if self not in _CONNECTED_HOSTS:
+            return
+        with open(os.devnull, 'w') as devnull:
+            Popen(['ssh'] + self._ssh_options() + ['-O', 'exit', self.hostname],
+                  stdin=devnull, stdout=devnull, stderr=devnull).wait()
+        _CONNECTED_HOSTS.discard(self)
+
+    def _ssh_cmd(self):
+        """Helper method to generate the base ssh command for the host."""
+        ssh_cmd = ['ssh']
+        if self._identity_file:
+            ssh_cmd += ['-i', os.path.expanduser(self._identity_file)]
+        return ssh_cmd + self._ssh_options()
+
     def _rsync_cmd(self):
         """Helper method to generate base rsync command."""
+        ssh_cmd = self._ssh_cmd()
+
         cmd = ['rsync']
-        if self._identity_file:
-            cmd += ['-e', 'ssh -i ' + os.path.expanduser(self._identity_file)]
+        if len(ssh_cmd) > 1:
+            cmd += ['-e', ' '.join(shlex.quote(arg) for arg in ssh_cmd)]
         return cmd
 
     def send_file(self, file_name, remote_destination=None, **kwargs):
@@ -89,6 +205,58 @@ class RemoteHost(Host):
             ['-ut', file_name, '%s:%s' % (self.hostname, remote_destination)],
             **kwargs)
 
+    def send_files(self, file_names, remote_directory=None, **kwargs):
+        """Send several files (or directories) to a remote host with one rsync.
+
+        The files keep their relative paths (``rsync -R``): a relative path is
+        placed at the same path below **remote_directory**, and an absolute
+        path below **remote_directory** as well.
+
+        Args:
+            file_names (list of str): The files on the local host.
+
+            remote_directory (str): The directory on the remote host to send
+                the files to. If `None`, the remote home directory. Default
+                `None`.
+
+            **kwargs: Passed to ``SubprocessTask``'s init method.
+
+        Return:
+            ``pyrem.task.SubprocessTask``: The resulting task.
+        """
+        return SubprocessTask(
+            self._rsync_cmd() + ['-rutR'] + list(file_names) +
+            ['%s:%s' % (self.hostname, remote_directory or '')],
+            **kwargs)
+
+    def relay_files(self, file_names, target, remote_directory=None,
+                    **kwargs):
+        """Send files this host received with ``send_files`` to another host.
+
+        The rsync runs on this host, so this host must be able to ssh to
+        **target** by its hostname without a password (e.g. with agent
+        forwarding or host-based authentication).
+
+        Args:
+            file_names (list of str): The files, as given to ``send_files``.
+
+            target (``RemoteHost``): The host to send them to.
+
+            remote_directory (str): See ``send_files``. Default `None`.
+
+            **kwargs: Passed to ``RemoteTask``'s init method.
+
+        Return:
+            ``pyrem.task.RemoteTask``: The resulting task.
+        """
+        # Relative to remote_directory, the files are where -R put them
+        paths = [shlex.quote(name.lstrip('/') or '.') for name in file_names]
+        command = ['rsync', '-rutR'] + paths + [
+            shlex.quote('%s:%s' % (target.hostname, remote_directory or ''))]
+        if remote_directory:
+            command = ['cd', shlex.quote(remote_directory), '&&'] + command
+        return self.run(command, **kwargs)
+
     def get_file(self, file_name, local_destination=None, **kwargs):
         """Get a file from a remote host with rsync.
 
@@ -113,6 +281,294 @@ class RemoteHost(Host):
             ['-ut', '%s:%s' % (self.hostname, file_name), local_destination],
             **kwargs)
 
+    def get_files(self, file_names, local_directory, compress=True, **kwargs):
+        """Get several files (or directories) from the remote host at once.
+
+        The files are sent as a single tar archive over one ssh command, and
+        unpacked into **local_directory**, where they keep their relative
+        paths, like with ``send_files``: a relative path (to the remote home
+        directory) is placed at the same path below **local_directory**, and
+        an absolute path below it as well.
+
+        ``return_values[\'bytes\']`` holds the size of the archive as it was
+        sent, ``return_values[\'duration\']`` the seconds the transfer took,
+        and ``return_values[\'throughput\']`` the bytes sent per second.
+
+        Args:
+            file_names (list of str): The files on the remote host.
+
+            local_directory (str): The directory to unpack the files in,
+                created if needed.
+
+            compress (bool): If `True`, the archive is compressed with gzip.
+                Default `True`.
+
+            **kwargs: Passed to ``SubprocessTask``'s init method.
+
+        Return:
+            ``pyrem.task.SubprocessTask``: The resulting task.
+        """
+        return _FileCollection(self, file_names, local_directory, compress,
+                               **kwargs)
+
+
+class HostGroup(object):
+    """A group of ``RemoteHost``s, to act on all of them at once.
+
+    Args:
+        hosts (list of ``RemoteHost`` or str): The hosts, or their hostnames.
+
+    Attributes:
+        hosts (list of ``RemoteHost``): The hosts of the group.
+    """
+    def __init__(self, hosts):
+        self.hosts = [h if isinstance(h, Host) else RemoteHost(h)
+                      for h in hosts]
+
+    def run(self, command, **kwargs):
+        """Run a command on all of the hosts.
+
+        Args:
+            command (list of str): The command to execute.
+
+            **kwargs: Passed to ``RemoteHost.run``.
+
+        Returns:
+            ``pyrem.task.Parallel``: The resulting task.
+        """
+        return Parallel([host.run(command, **kwargs) for host in self.hosts])
+
+    def broadcast_files(self, file_names, remote_directory=None, hosts=None,
+                        tree=False, max_concurrency=None, **kwargs):
+        """Send the same files to many hosts.
+
+        All of the files are sent to each host with a single rsync (see
+        ``RemoteHost.send_files``).
+
+        With **tree**, the files are only uploaded from the local host to one
+        host, and hosts which already have the files relay them to the
+        others, doubling the number of hosts with the files with each round,
+        so that the time to reach every host grows with the logarithm of the
+        number of hosts rather than linearly. Each transfer starts as soon as
+        its source has the files. The hosts must be able to ssh to each other
+        (see ``RemoteHost.relay_files``).
+
+        Args:
+            file_names (list of str): The files on the local host.
+
+            remote_directory (str): See ``RemoteHost.send_files``. Default
+                `None`.
+
+            hosts (list of ``RemoteHost``): The hosts to send the files to,
+                if not all of the hosts of the group. Default `None`.
+
+            tree (bool): Whether to relay the files between hosts. Default
+                `False`.
+
+            max_concurrency (int): The maximum number of transfers at once.
+                Default `None`.
+
+            **kwargs: Passed to the init method of each transfer's task,
+                which ignores those it doesn't accept: uploads are
+                ``SubprocessTask``s (e.g. **shell** only applies to them),
+                and relays are ``RemoteTask``s (e.g. **kill_remote**).
+
+        Returns:
+            ``pyrem.task.Task``: A ``Parallel`` of the transfers or, with
+                **tree**, a ``pyrem.task.TaskGraph``.
+        """
+        hosts = list(self.hosts if hosts is None else hosts)
+        send_kwargs = _accepted_kwargs(SubprocessTask, kwargs)
+        if not tree:
+            return Parallel([host.send_files(file_names, remote_directory,
+                                             **send_kwargs)
+                             for host in hosts],
+                            max_concurrency=max_concurrency)
+
+        relay_kwargs = _accepted_kwargs(RemoteTask, kwargs)
+        graph = TaskGraph(max_concurrency=max_concurrency)
+        # The last transfer to or from each host which has (or will have) the
+        # files, where None stands for the local host. Each host sends to one
+        # host at a time, once it has the files.
+        last = {None: None}
+        remaining = hosts[::-1]
+        while remaining:
+            for source in list(last):
+                if not remaining:
+                    break
+                target = remaining.pop()
+                if source is None:
+                    task = target.send_files(file_names, remote_directory,
+                                             **send_kwargs)
+                else:
+                    task = source.relay_files(file_names, target,
+                                              remote_directory, **relay_kwargs)
+                graph.add(task, after=[last[source]] if last[source] else [])
+                last[source] = last[target] = task
+        return graph
+
+    def collect_files(self, file_names, local_directory, hosts=None,
+                      max_concurrency=None, compress=True, **kwargs):
+        """Get the same files from many hosts.
+
+        The files of each host are fetched with a single ssh command (see
+        ``RemoteHost.get_files``) and unpacked into a directory of their own,
+        named after the host, in **local_directory**.
+
+        Once the returned task has been waited on,
+        ``return_values[\'hosts\']`` maps the hostname of each host whose
+        transfer finished to the ``'bytes'``, ``'duration'`` and
+        ``'throughput'`` of the transfer, and ``return_values[\'bytes\']``
+        and ``return_values[\'throughput\']`` hold the total bytes and the
+        overall bytes per second.
+
+        Args:
+            file_names (list of str): The files on the remote hosts.
+
+            local_directory (str): The local directory to unpack the files in.
+
+            hosts (list of ``RemoteHost``): The hosts to get the files from,
+                if not all of the hosts of the group. Default `None`.
+
+            max_concurrency (int): The maximum number of transfers at once.
+                Default `None`.
+
+            compress (bool): See ``RemoteHost.get_files``. Default `True`.
+
+            **kwargs: Passed to the init method of each transfer's task.
+
+        Returns:
+            ``pyrem.task.Parallel``: The resulting task.
+        """
+        hosts = list(self.hosts if hosts is None else hosts)
+        return _Collection([
+            host.get_files(file_names,
+                           os.path.join(local_directory, host.hostname),
+                           compress, **kwargs)
+            for host in hosts], max_concurrency=max_concurrency)
+
+
+class _FileCollection(SubprocessTask):
+    """Gets files from a remote host as a tar archive, see ``get_files``.
+
+    The archive is written to a hidden file in the local directory and then
+    unpacked, so that its size is known, and so that the exit code of ssh is
+    the one reported if ssh itself fails.
+    """
+    __slots__ = ('_host', '_file_names', '_local_directory', '_compress',
+                 '_archive', '_start_time', '_end_time')
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, host, file_names, local_directory, compress,
+                 **kwargs):
+        self._host = host.hostname
+        self._file_names = tuple(file_names)
+        self._local_directory = local_directory
+        self._compress = compress
+        name = '.pyrem-collect-%08x.tar' % random.getrandbits(32)
+        self._archive = os.path.join(local_directory, name)
+        self._start_time = None
+        self._end_time = None
+
+        # Relative paths are relative to the remote home directory, and
+        # absolute paths to the root, without their leading '/'
+        relative = [name for name in file_names if not name.startswith('/')]
+        absolute = [name.lstrip('/') or '.' for name in file_names
+                    if name.startswith('/')]
+        flags = 'czf' if compress else 'cf'
+        remote = ['tar', flags, '-'] + [shlex.quote(n) for n in relative]
+        if absolute:
+            remote += ['-C', '/'] + [shlex.quote(n) for n in absolute]
+
+        archive = shlex.quote(self._archive)
+        ssh_cmd = host._ssh_cmd() # pylint: disable=W0212
+        command = [shlex.quote(arg) for arg in ssh_cmd] + [
+            shlex.quote(self._host), shlex.quote(' '.join(remote)),
+            '>', archive, ';', 'r=$?', ';',
+            # 255 is ssh failing, which pyrem.retry knows to retry
+            'if [ $r -ne 255 ] ; then',
+            'tar', 'xzf' if compress else 'xf', archive,
+            '-C', shlex.quote(local_directory), '|| r=$? ;',
+            'fi', ';', 'exit $r']
+        kwargs['shell'] = True
+        super(_FileCollection, self).__init__(command, **kwargs)
+
+    @property
+    def host(self):
+        return self._host
+
+    def _start(self):
+        os.makedirs(os.path.dirname(self._archive), exist_ok=True)
+        self._start_time = time.monotonic()
+        self._end_time = None
+        super(_FileCollection, self)._start()
+
+    def _process_exited(self):
+        self._end_time = time.monotonic()
+        super(_FileCollection, self)._process_exited()
+
+    def _record_transfer(self):
+        """Set the size and speed of the transfer, and remove the archive."""
+        try:
+            size = os.path.getsize(self._archive)
+            os.remove(self._archive)
+        except OSError:
+            size = 0
+        duration = (self._end_time or time.monotonic()) - self._start_time
+        self.return_values['bytes'] = size
+        self.return_values['duration'] = duration
+        self.return_values['throughput'] = size / duration if duration else 0.0
+
+    def _wait(self):
+        try:
+            super(_FileCollection, self)._wait()
+        finally:
+            self._record_transfer()
+
+    def _stop(self):
+        super(_FileCollection, self)._stop()
+        # Unless it was waited on
+        if 'bytes' not in self.return_values:
+            self._record_transfer()
+
+    def _cache_key(self):
+        # Not the command, which names a random archive
+        return ('FileCollection', self._host, self._file_names,
+                self._local_directory, self._compress)
+
+    def __repr__(self):
+        return ("FileCollection(status=%s, return_values=%s, host=%s, "
+                "archive=%s)" % (self._status, _REPR.repr(self.return_values),
+                                 self._host, self._archive))
+
+
+class _Collection(Parallel):
+    """The ``Parallel`` of ``HostGroup.collect_files``, summing transfers."""
+    __slots__ = ('_start_time',)
+
+    def __init__(self, tasks, max_concurrency=None):
+        super(_Collection, self).__init__(tasks,
+                                          max_concurrency=max_concurrency)
+        self._start_time = None
+
+    def _start(self):
+        self._start_time = time.monotonic()
+        super(_Collection, self)._start()
+
+    def _wait(self):
+        try:
+            super(_Collection, self)._wait()
+        finally:
+            hosts = {task.host: {key: task.return_values[key] for key in
+                                 ['bytes', 'duration', 'throughput']}
+                     for task in self._tasks if 'bytes' in task.return_values}
+            total = sum(transfer['bytes'] for transfer in hosts.values())
+            duration = time.monotonic() - self._start_time
+            self.return_values['hosts'] = hosts
+            self.return_values['bytes'] = total
+            self.return_values['throughput'] = (total / duration if duration
+                                                else 0.0)
+
 
 class LocalHost(Host):
     """The local host."""
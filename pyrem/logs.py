@@ -0,0 +1,318 @@
+"""logs.py: Contains a multiplexer writing the output of tasks to log files.
+
+Without **return_output**, the output of every command goes to the terminal
+of the controller, where the output of hundreds of tasks is interleaved and
+printing it becomes the bottleneck. Tasks given a ``LogMultiplexer`` with
+their **log** argument have their output written to log files instead:
+
+    logs = LogMultiplexer('logs', console=True)
+    servers = [host.run(['./server'], log=logs) for host in HOSTS]
+
+Their output is read by PyREM's I/O thread, like all output, and written to
+the files in large buffered writes, from memory buffers flushed when they are
+full and every **flush_interval** seconds. There is one log file per task, or
+one per host, with each line prefixed by the task it comes from. Log files
+can be rotated once they reach a given size, and the rotated files
+compressed.
+
+Optionally, a summary of the output is printed to the console every few
+seconds: the last line of each task which printed something, prefixed by the
+name of the task, up to a given number of lines.
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+__all__ = ['LogMultiplexer']
+
+import gzip
+import itertools
+import os
+import re
+import shutil
+import sys
+
+from collections import deque
+from threading import Condition, Lock
+
+from pyrem.reactor import REACTOR
+from pyrem.task import SCHEDULER
+
+
+def _label(task, index):
+    """Return a name for a task, usable in file names."""
+    # pylint: disable=W0212
+    command = getattr(task, '_remote_command', None) or task._command
+    if not isinstance(command, str):
+        command = ' '.join(command)
+    words = command.split()
+    name = os.path.basename(words[0]) if words else 'task'
+    label = '%s-%s-%d' % (getattr(task, 'host', None) or 'local', name, index)
+    return re.sub(r'[^A-Za-z0-9._-]', '_', label)
+
+
+def _last_rotation(path):
+    """Return the suffix of the last rotated file of a log file, or `0`."""
+    directory, name = os.path.split(path)
+    pattern = re.compile(re.escape(name) + r'\.(\d+)(\.gz)?$')
+    matches = [pattern.match(n) for n in os.listdir(directory)]
+    return max([int(m.group(1)) for m in matches if m], default=0)
+
+
+def _remove_expired(path):
+    """Remove a rotated log file, compressed or not, if it exists."""
+    for name in [path, path + '.gz']:
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+
+def _compress(path):
+    """Compress a rotated log file, replacing it with a ``.gz`` file."""
+    try:
+        with open(path, 'rb') as f_in, gzip.open(path + '.gz', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(path)
+    except OSError:
+        # Rotated away in the meantime
+        pass
+
+
+class _LogFile(object):
+    """A log file, written through a memory buffer."""
+    __slots__ = ('path', 'buffer', 'size', 'rotations', 'sources', 'jobs')
+
+    def __init__(self, path):
+        self.path = path
+        self.buffer = bytearray()
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        # Carry on from the rotated files of an earlier run, if any
+        self.rotations = _last_rotation(path)
+        self.sources = 0
+        # The (rotated, expired) files left to compress and remove, in order
+        self.jobs = deque()
+
+
+class _Source(object):
+    """The output of one task, for the console summary."""
+    __slots__ = ('label', 'prefix', 'log_file', 'last_line', 'new_lines')
+
+    def __init__(self, label, prefix, log_file):
+        self.label = label
+        self.prefix = prefix
+        self.log_file = log_file
+        self.last_line = None
+        self.new_lines = 0
+
+
+class LogMultiplexer(object):
+    """Writes the output of tasks to log files.
+
+    Tasks are added by giving them the multiplexer as their **log** argument
+    (see ``pyrem.task.SubprocessTask``). The path of the log file of a task
+    is stored in ``return_values[\'log\']`` when it is started.
+
+    Args:
+        directory (str): The directory for the log files, created if needed.
+
+        per_host (bool): If `True`, the output of all of the tasks on a host
+            goes to a single file, named after the host, with every line
+            prefixed by the name of its task. Otherwise, each task gets a file
+            of its own. Default `False`.
+
+        buffer_size (int): The number of bytes buffered per file before they
+            are written. Default 1 MiB.
+
+        flush_interval (float): Seconds after which buffered output is written
+            anyway. Default `1`.
+
+        max_bytes (int): If given, a log file reaching this size is rotated:
+            it is renamed with a suffix (``.1``, ``.2``, ...) and a new file
+            is started. Default `None`.
+
+        backups (int): The number of rotated files kept per log file. Default
+            `5`.
+
+        compress (bool): If `True`, rotated files are compressed with gzip.
+            Default `False`.
+
+        console (bool): If `True`, print a summary of new output to stdout
+            every **console_interval** seconds. Default `False`.
+
+        console_interval (float): Seconds between summaries. Default `2`.
+
+        console_lines (int): The maximum number of lines of each summary.
+            Default `10`.
+    """
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, directory, per_host=False, buffer_size=1 << 20,
+                 flush_interval=1.0, max_bytes=None, backups=5,
+                 compress=False, console=False, console_interval=2.0,
+                 console_lines=10):
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.per_host = per_host
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.console = console
+        self.console_interval = console_interval
+        self.console_lines = console_lines
+
+        self._lock = Lock()
+        self._jobs_done = Condition(self._lock)
+        self._num_busy_files = 0
+        self._indices = itertools.count(1)
+        self._files = {}
+        self._sources = []
+        self._timer = None
+        self._ticks = 0
+
+    def attach(self, task):
+        """Start logging the output of a started task.
+
+        Called by the task itself, once its output is being read.
+        """
+        # pylint: disable=W0212
+        label = _label(task, next(self._indices))
+        if self.per_host:
+            name = getattr(task, 'host', None) or 'localhost'
+            path = os.path.join(self.directory, '%s.log' % name)
+            prefix = label.encode() + b'| '
+        else:
+            path = os.path.join(self.directory, '%s.log' % label)
+            prefix = b''
+        with self._lock:
+            log_file = self._files.get(path)
+            if log_file is None:
+                log_file = self._files[path] = _LogFile(path)
+            log_file.sources += 1
+            source = _Source(label, prefix, log_file)
+            self._sources.append(source)
+            if self._timer is None:
+                self._timer = REACTOR.call_later(self._tick_interval(),
+                                                 self._tick)
+        task.return_values['log'] = path
+        task._output.add_listener(
+            lambda stream, line: self._write(source, line))
+        task._output.when_closed(lambda: self._detach(source))
+
+    def _write(self, source, line):
+        """Buffer a line of output. Run on PyREM's I/O thread."""
+        with self._lock:
+            source.log_file.buffer += source.prefix + line
+            source.last_line = line
+            source.new_lines += 1
+            if len(source.log_file.buffer) >= self.buffer_size:
+                self._flush_file(source.log_file)
+
+    def _detach(self, source):
+        """Write out the output of a task once it is closed."""
+        with self._lock:
+            log_file = source.log_file
+            log_file.sources -= 1
+            if not log_file.sources:
+                self._flush_file(log_file)
+                if not self.per_host:
+                    del self._files[log_file.path]
+            if not (self.console and source.new_lines):
+                self._sources.remove(source)
+            else:
+                # Removed by the next summary, once shown
+                source.log_file = None
+
+    def _flush_file(self, log_file):
+        """Write the buffer of a file. Must be called with the lock held."""
+        if not log_file.buffer:
+            return
+        if (self.max_bytes is not None and log_file.size and
+                log_file.size + len(log_file.buffer) > self.max_bytes):
+            self._rotate(log_file)
+        with open(log_file.path, 'ab') as f:
+            f.write(log_file.buffer)
+        log_file.size += len(log_file.buffer)
+        log_file.buffer = bytearray()
+
+    def _rotate(self, log_file):
+        log_file.rotations += 1
+        rotated = '%s.%d' % (log_file.path, log_file.rotations)
+        os.rename(log_file.path, rotated)
+        log_file.size = 0
+        expired = '%s.%d' % (log_file.path,
+                             log_file.rotations - self.backups)
+        if not (self.compress or log_file.jobs):
+            _remove_expired(expired)
+            return
+        # Removed after the compression, which could otherwise recreate it
+        log_file.jobs.append((rotated if self.compress else None, expired))
+        if len(log_file.jobs) == 1:
+            self._num_busy_files += 1
+            SCHEDULER.submit(self._run_jobs, log_file)
+
+    def _run_jobs(self, log_file):
+        """Compress and remove the rotated files of a log file, in order."""
+        while True:
+            with self._lock:
+                rotated, expired = log_file.jobs[0]
+            if rotated is not None:
+                _compress(rotated)
+            _remove_expired(expired)
+            with self._lock:
+                log_file.jobs.popleft()
+                if not log_file.jobs:
+                    self._num_busy_files -= 1
+                    self._jobs_done.notify_all()
+                    return
+
+    def _tick_interval(self):
+        return (min(self.flush_interval, self.console_interval)
+                if self.console else self.flush_interval)
+
+    def _tick(self):
+        """Flush the buffers and print the summary, on a timer."""
+        with self._lock:
+            for log_file in self._files.values():
+                self._flush_file(log_file)
+            self._ticks += 1
+            summary = []
+            if self.console and (self._ticks * self._tick_interval() >=
+                                 self.console_interval):
+                self._ticks = 0
+                summary = self._summary()
+            if self._sources or any(f.buffer for f in self._files.values()):
+                self._timer = REACTOR.call_later(self._tick_interval(),
+                                                 self._tick)
+            else:
+                self._timer = None
+        if summary:
+            sys.stdout.write(''.join(summary))
+            sys.stdout.flush()
+
+    def _summary(self):
+        """Return the lines of the console summary. Must hold the lock."""
+        updated = [s for s in self._sources if s.new_lines]
+        lines = []
+        for source in updated[:self.console_lines]:
+            lines.append('[%s] %s\n' % (
+                source.label,
+                source.last_line.decode(errors='replace').rstrip('\n')))
+        if len(updated) > self.console_lines:
+            lines.append('... and %d more tasks\n' %
+                         (len(updated) - self.console_lines))
+        for source in updated:
+            source.new_lines = 0
+        self._sources = [s for s in self._sources if s.log_file is not None]
+        return lines
+
+    def flush(self):
+        """Write all buffered output to the log files, and wait on the rotated
+        files to be compressed.
+        """
+        with self._lock:
+            for log_file in self._files.values():
+                self._flush_file(log_file)
+            while self._num_busy_files:
+                self._jobs_done.wait()
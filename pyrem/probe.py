@@ -0,0 +1,308 @@
+"""probe.py: Contains readiness probes, telling when a started task is ready.
+
+Rather than sleeping for a while after starting servers, and hoping they are
+up by then, wait until they say so:
+
+    server = host.run(['./server'], return_output=True)
+    server.start()
+    server.wait_ready(OutputMatches('listening on'), timeout=60)
+    clients.start(wait=True)
+
+Or, with ``Ready`` as a barrier between the servers and the clients, so that
+the clients start the moment every server is up:
+
+    Sequential([Parallel([Ready(s, PortOpen(s.host, 8080), timeout=60)
+                          for s in servers]),
+                clients]).start(wait=True)
+
+Probes on output are notified of every line by PyREM's I/O thread; the other
+probes are polled by the ``PROBES`` pool, every **interval** seconds, so that
+blocking checks (connecting to ports, running ssh) never hold up the
+``SCHEDULER``.
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+__all__ = ['Probe', 'OutputMatches', 'PortOpen', 'FileExists', 'Ready']
+
+import os
+import re
+import socket
+import time
+
+from threading import Lock
+
+from pyrem.host import RemoteHost
+from pyrem.reactor import REACTOR
+from pyrem.task import Task, TaskStatus, SCHEDULER, _when_all_stoppable
+from pyrem.utils import CancellationToken, WorkerPool
+
+# The threads polling probes, apart from the SCHEDULER's, as checks can block
+PROBES = WorkerPool(max_workers=32)
+
+
+class Probe(object):
+    """Abstract class, a condition telling that a started task is ready.
+
+    Subclasses should implement ``check``, which is polled every **interval**
+    seconds, or ``watch`` if they can be notified instead.
+
+    Args:
+        interval (float): Seconds between checks. Default `0.2`.
+    """
+    def __init__(self, interval=0.2):
+        self.interval = interval
+
+    def check(self, task):
+        """Return whether a task is ready. Can block for a short while."""
+        raise NotImplementedError
+
+    def watch(self, task, token, callback):
+        """Call ``callback()`` once a task is ready.
+
+        Args:
+            task (``pyrem.task.Task``): The started task.
+
+            token (``pyrem.utils.CancellationToken``): Cancelled when the
+                probe is no longer needed.
+
+            callback (function): Called at most once, with no arguments once
+                the task is ready, or with the exception raised by ``check``
+                if checking fails. It doesn't block.
+        """
+        def poll():
+            if token.cancelled:
+                return
+            try:
+                ready = self.check(task)
+            except Exception as e: # pylint: disable=W0703
+                callback(e)
+                return
+            if ready:
+                callback()
+            else:
+                REACTOR.call_later(self.interval, PROBES.submit, poll)
+        PROBES.submit(poll)
+
+
+class OutputMatches(Probe):
+    """Ready once a line of output of the task matches a regular expression.
+
+    The task must be a ``SubprocessTask``, ``RemoteTask`` or ``AgentTask``
+    started with **return_output** or **output_callback**. Lines printed
+    before the probe is watching are only seen if they are still kept in
+    ``return_values`` (see **max_output_lines**), i.e. with **return_output**.
+
+    Args:
+        pattern (str): The regular expression, searched for in each line.
+
+        stream (str): ``'stdout'`` or ``'stderr'`` to only search one of the
+            streams. Default `None`, for both.
+    """
+    def __init__(self, pattern, stream=None):
+        super(OutputMatches, self).__init__()
+        self.pattern = re.compile(pattern)
+        self.stream = stream
+
+    def check(self, task):
+        raise NotImplementedError("OutputMatches is only watched")
+
+    def watch(self, task, token, callback):
+        output = getattr(task, '_output', None)
+        if output is None:
+            raise ValueError("The output of %s isn't being read" % task)
+        lock = Lock()
+        matched = []
+
+        def listener(stream, line):
+            if self.stream not in [None, stream]:
+                return
+            if not self.pattern.search(line.decode(errors='replace')):
+                return
+            with lock:
+                if matched or token.cancelled:
+                    return
+                matched.append(True)
+            output.remove_listener(listener)
+            callback()
+
+        output.add_listener(listener)
+        token.add_callback(lambda: output.remove_listener(listener))
+
+
+class PortOpen(Probe):
+    """Ready once a TCP port accepts connections from this machine.
+
+    Args:
+        host (str): The host to connect to.
+
+        port (int): The port.
+
+        interval (float): See ``Probe``. Default `0.2`.
+    """
+    def __init__(self, host, port, interval=0.2):
+        super(PortOpen, self).__init__(interval)
+        self.host = host
+        self.port = port
+
+    def check(self, task):
+        try:
+            socket.create_connection((self.host, self.port),
+                                     timeout=max(self.interval, 1)).close()
+        except OSError:
+            return False
+        return True
+
+
+class FileExists(Probe):
+    """Ready once a file exists, e.g. a PID file or a socket.
+
+    Args:
+        path (str): The path of the file.
+
+        host (``pyrem.host.Host``): The host to look on. Each check runs
+            ``test -e`` there with ``host.run()``, so a ``RemoteHost`` with a
+            shared connection or an agent makes checks cheap. Default `None`,
+            to look on the local host directly.
+
+        interval (float): See ``Probe``. Default `0.5`.
+    """
+    def __init__(self, path, host=None, interval=0.5):
+        super(FileExists, self).__init__(interval)
+        self.path = path
+        self.host = host
+
+    def check(self, task):
+        if self.host is None:
+            return os.path.exists(self.path)
+        # Nothing is left to kill once test exits, so skip the remote kill
+        kwargs = {'kill_remote': False} if isinstance(
+            self.host, RemoteHost) else {}
+        test = self.host.run(['test', '-e', self.path], quiet=True, **kwargs)
+        return test.start(wait=True)['retcode'] == 0
+
+
+class Ready(Task):
+    """A task which starts a task, and finishes as soon as it is ready.
+
+    Meant as a barrier in a ``Sequential`` (or under a ``Parallel``): the
+    tasks after it start as soon as the task is ready, while the task keeps
+    running. Once ready, the task is no longer managed by this one, and must
+    be stopped on its own (it is stopped on exit like any other task). If the
+    task was already started, it is only waited on to be ready.
+
+    If the task finishes before being ready, or isn't ready within
+    **timeout** seconds, it is stopped, and waiting on this task raises a
+    ``RuntimeError`` or a ``TimeoutError``. Likewise if the probe fails, with
+    the exception it raised. It is also stopped if this task is stopped
+    before it is ready.
+
+    ``return_values[\'ready_after\']`` holds the number of seconds it took
+    for the task to be ready, once it is.
+
+    Args:
+        task (``pyrem.task.Task``): The task to start.
+
+        probe (``Probe``): Tells when it is ready.
+
+        timeout (float): The maximum number of seconds to wait for it to be
+            ready, or `None` to wait indefinitely. Default `None`.
+    """
+    __slots__ = ('_task', '_probe', '_timeout', '_step_lock', '_token',
+                 '_start_time', '_ready', '_exception')
+
+    _reports_done = True
+
+    def __init__(self, task, probe, timeout=None):
+        super(Ready, self).__init__()
+        self._task = task
+        self._probe = probe
+        self._timeout = timeout
+        self._step_lock = Lock()
+        self._token = None
+        self._start_time = None
+        self._ready = False
+        self._exception = None
+
+    def _start(self):
+        self._token = token = CancellationToken()
+        self._start_time = time.monotonic()
+        self._ready = False
+        self._exception = None
+        if self._task._status is TaskStatus.IDLE: # pylint: disable=W0212
+            self._task.start()
+        if self._timeout is not None:
+            timer = REACTOR.call_later(
+                self._timeout, self._finish, token, TimeoutError(
+                    "%s wasn't ready after %s seconds" % (self._task,
+                                                          self._timeout)))
+            token.add_callback(timer.cancel)
+        # Watch first, so that output the task printed before finishing
+        # counts
+        self._probe.watch(self._task, token,
+                          lambda exception=None: self._finish(token,
+                                                              exception))
+        self._task.add_done_callback(lambda task: self._finish(
+            token, RuntimeError("%s finished before being ready" % task)))
+
+    def _finish(self, token, exception):
+        """Record the outcome, if it is the first one. Doesn't block."""
+        with self._step_lock:
+            if token.cancelled:
+                return
+            self._ready = exception is None
+            self._exception = exception
+            if self._ready:
+                self.return_values['ready_after'] = (
+                    time.monotonic() - self._start_time)
+            token.cancel()
+        if exception is None:
+            self._set_done()
+        else:
+            SCHEDULER.submit(self._stop_task)
+
+    def _stop_task(self):
+        """Stop the task, which won't be ready, then finish."""
+        # pylint: disable=W0212
+        try:
+            if self._task._status is TaskStatus.STARTED:
+                self._task.stop(wait=False)
+        finally:
+            _when_all_stoppable([self._task], lambda: SCHEDULER.submit(
+                self._task_stopped))
+
+    def _task_stopped(self):
+        # pylint: disable=W0212
+        try:
+            if self._task._status is TaskStatus.STOPPING:
+                self._task.wait_stopped()
+        finally:
+            self._set_done()
+
+    def _wait(self):
+        self._wait_done()
+        if self._exception is not None:
+            raise self._exception
+
+    def _begin_stop(self):
+        with self._step_lock:
+            self._token.cancel()
+            ready = self._ready
+        # pylint: disable=W0212
+        if not ready and self._task._status is TaskStatus.STARTED:
+            self._task.stop(wait=False)
+
+    def _wait_stopped(self):
+        if self._task._status is TaskStatus.STOPPING: # pylint: disable=W0212
+            self._task.wait_stopped()
+
+    def _when_stoppable(self, func):
+        _when_all_stoppable([self._task], func)
+
+    def _reset(self):
+        if self._task._status is TaskStatus.STOPPED: # pylint: disable=W0212
+            self._task.reset()
+
+    def __repr__(self):
+        return "Ready(status=%s, task=%s)" % (self._status, self._task)
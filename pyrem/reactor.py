@@ -0,0 +1,264 @@
+"""reactor.py: Contains the background thread which handles I/O for tasks.
+
+Rather than dedicating a thread (or a blocking call) to every subprocess, all
+of the pipes PyREM reads from and all of the subprocesses it waits on are
+multiplexed on a single thread, the ``REACTOR``, using the ``selectors``
+module. Subprocess exits are detected with pidfds where the platform supports
+them, and by polling otherwise. Timers (e.g. task timeouts) are kept in a
+single heap, handled by the same thread.
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+
+import fcntl
+import heapq
+import itertools
+import os
+import selectors
+import sys
+import time
+
+from collections import deque
+from threading import Lock, Thread
+from traceback import print_exc
+
+
+def _set_nonblocking(fd):
+    """Put a file descriptor in non-blocking mode (``os.set_blocking`` is
+    only available from Python 3.5).
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Timer(object):
+    """A call scheduled with ``Reactor.call_later()``.
+
+    Attributes:
+        when (float): When the call is due, in ``time.monotonic()`` time.
+
+        active (bool): Whether the call is still to be made, i.e. it is not
+            due yet and hasn't been cancelled.
+    """
+    __slots__ = ('when', 'active', '_reactor', '_func', '_args')
+
+    def __init__(self, reactor, when, func, args):
+        self.when = when
+        self.active = True
+        self._reactor = reactor
+        self._func = func
+        self._args = args
+
+    def cancel(self):
+        """Cancel the call, if it hasn't been made yet."""
+        self._reactor._cancel(self) # pylint: disable=W0212
+
+
+class Reactor(object):
+    """Runs callbacks on a single background thread on I/O and process exits.
+
+    The thread is started when the reactor is first used. All methods are
+    thread-safe. Callbacks are run on the reactor thread, so they should never
+    block.
+    """
+    _READ_SIZE = 65536
+    _POLL_INTERVAL = 0.05
+
+    def __init__(self):
+        self._lock = Lock()
+        self._selector = selectors.DefaultSelector()
+        self._calls = deque()
+        self._thread = None
+        # Heap of (when, sequence number, timer), with the cancelled timers
+        # left in place until there are too many of them
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._num_cancelled = 0
+        # Processes whose exit can't be selected on, with their callbacks
+        self._polled = []
+
+        # Writing to this pipe wakes up the reactor thread
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        _set_nonblocking(self._wakeup_read)
+        _set_nonblocking(self._wakeup_write)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+
+    def call_soon(self, func, *args):
+        """Run ``func(*args)`` on the reactor thread."""
+        with self._lock:
+            self._calls.append((func, args))
+            self._start_thread()
+        self._wake_up()
+
+    def call_later(self, delay, func, *args):
+        """Run ``func(*args)`` on the reactor thread in **delay** seconds.
+
+        Returns:
+            ``Timer``: The scheduled call, which can be cancelled.
+        """
+        timer = Timer(self, time.monotonic() + delay, func, args)
+        with self._lock:
+            heapq.heappush(self._timers,
+                           (timer.when, next(self._timer_ids), timer))
+            earliest = self._timers[0][2] is timer
+            self._start_thread()
+        if earliest:
+            self._wake_up()
+        return timer
+
+    def _cancel(self, timer):
+        with self._lock:
+            if not timer.active:
+                return
+            timer.active = False
+            self._num_cancelled += 1
+            # Don't let timers which will never fire pile up
+            if self._num_cancelled > len(self._timers) // 2:
+                self._timers = [entry for entry in self._timers
+                                if entry[2].active]
+                heapq.heapify(self._timers)
+                self._num_cancelled = 0
+
+    def _start_thread(self):
+        """Start the reactor thread if needed. Must hold the lock."""
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='pyrem-reactor')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _wake_up(self):
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except BlockingIOError:
+            # The reactor thread already has a wakeup pending
+            pass
+
+    def add_reader(self, fileobj, callback):
+        """Read from a pipe until EOF, passing the data to a callback.
+
+        Args:
+            fileobj: The file object (or file descriptor) to read from. It is
+                closed once EOF is reached.
+
+            callback (function): Called with each chunk of bytes read, and then
+                with ``b''`` at EOF.
+        """
+        self.call_soon(self._selector.register, fileobj, selectors.EVENT_READ,
+                       (self._handle_read, callback))
+
+    def add_process(self, process, callback):
+        """Call a callback once a subprocess has exited.
+
+        The subprocess is not reaped, ``process.wait()`` or ``process.poll()``
+        should still be used to get its return code.
+
+        Args:
+            process (``subprocess.Popen``): The subprocess to watch.
+
+            callback (function): Called with no arguments.
+        """
+        self.call_soon(self._watch_process, process, callback)
+
+    def _watch_process(self, process, callback):
+        if process.returncode is not None:
+            self._run_callback(callback)
+            return
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except ProcessLookupError:
+            # Already exited and reaped
+            self._run_callback(callback)
+        except (AttributeError, OSError):
+            # No pidfd support in Python or in the kernel
+            self._polled.append((process, callback))
+        else:
+            self._selector.register(pidfd, selectors.EVENT_READ,
+                                    (self._handle_exit, callback))
+
+    def _handle_read(self, key, callback):
+        try:
+            data = os.read(key.fd, self._READ_SIZE)
+        except OSError:
+            data = b''
+        if not data:
+            self._selector.unregister(key.fileobj)
+            if isinstance(key.fileobj, int):
+                os.close(key.fileobj)
+            else:
+                key.fileobj.close()
+        self._run_callback(callback, data)
+
+    def _handle_exit(self, key, callback):
+        self._selector.unregister(key.fd)
+        os.close(key.fd)
+        self._run_callback(callback)
+
+    def _poll_processes(self):
+        still_running = []
+        for process, callback in self._polled:
+            if process.poll() is None:
+                still_running.append((process, callback))
+            else:
+                self._run_callback(callback)
+        self._polled = still_running
+
+    @staticmethod
+    def _run_callback(func, *args):
+        try:
+            func(*args)
+        except: # pylint: disable=W0702
+            # Never let a callback kill the reactor thread
+            print_exc(file=sys.stderr)
+
+    def _next_timeout(self):
+        """Return how long the reactor thread can sleep for."""
+        timeout = self._POLL_INTERVAL if self._polled else None
+        with self._lock:
+            if self._timers:
+                delay = max(0, self._timers[0][0] - time.monotonic())
+                timeout = delay if timeout is None else min(timeout, delay)
+        return timeout
+
+    def _run_timers(self):
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._timers and self._timers[0][0] <= now:
+                timer = heapq.heappop(self._timers)[2]
+                if timer.active:
+                    timer.active = False
+                    due.append(timer)
+                else:
+                    self._num_cancelled -= 1
+        for timer in due:
+            self._run_callback(timer._func, *timer._args) # pylint: disable=W0212
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select(self._next_timeout()):
+                if key.fd == self._wakeup_read:
+                    try:
+                        while os.read(self._wakeup_read, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    handler, callback = key.data
+                    handler(key, callback)
+
+            if self._polled:
+                self._poll_processes()
+
+            self._run_timers()
+
+            while True:
+                with self._lock:
+                    if not self._calls:
+                        break
+                    func, args = self._calls.popleft()
+                self._run_callback(func, *args)
+
+
+REACTOR = Reactor()
@@ -0,0 +1,252 @@
+"""retry.py: Contains the retrying of tasks which fail for transient reasons.
+
+Under load, ssh connections get reset or refused (e.g. by ``MaxStartups``),
+and the commands and file transfers run over them fail with nothing wrong
+with the commands themselves. A ``Retry`` runs a task again, after a growing
+and randomized delay, when it fails in a way its ``RetryPolicy`` considers
+transient. By default, only transport failures are retried (see
+``transport_failure()``), so a command which really fails still fails right
+away.
+
+Example:
+
+    policy = RetryPolicy(max_attempts=5)
+    Sequential([Retry(host.send_file('server'), policy),
+                Retry(host.run(['./server', '--check']), policy)])
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+__all__ = ['RetryPolicy', 'Retry', 'transport_failure']
+
+import os
+import random
+import sys
+import time
+
+from threading import Lock
+
+from pyrem.agent import AgentTask
+from pyrem.reactor import REACTOR
+from pyrem.task import (Task, TaskStatus, RemoteTask, SubprocessTask,
+                        SCHEDULER, _REPR, _on_finish, _reraise, _wait_finished,
+                        _when_all_stoppable, stop_all)
+from pyrem.utils import CancellationToken
+
+
+# The exit code of ssh when it fails itself, rather than the remote command
+SSH_FAILURE = 255
+
+# The exit codes of rsync for failed connections and transfers: socket I/O
+# error, protocol data stream error, timeouts, and ssh failures
+RSYNC_TRANSPORT_FAILURES = frozenset([10, 12, 30, 35, SSH_FAILURE])
+
+
+def transport_failure(task, exc_info): # pylint: disable=W0613
+    """Tell whether a task failed because of its connection to a host.
+
+    This is the default predicate of a ``RetryPolicy``: a ``RemoteTask`` or
+    ``pyrem.agent.AgentTask`` which exited with code `255` (ssh failed, or the
+    agent's connection was lost), a local ssh (e.g. ``get_files()``) which
+    exited with code `255`, and a local rsync (e.g. ``send_file()`` and
+    ``get_file()``) which exited with one of ``RSYNC_TRANSPORT_FAILURES``.
+
+    Args:
+        task (``pyrem.task.Task``): The task, which has been waited on.
+
+        exc_info (tuple): The ``sys.exc_info()`` of the exception raised by
+            waiting on the task, or `None`.
+
+    Returns:
+        bool: Whether the task should be retried.
+    """
+    retcode = task.return_values.get('retcode')
+    if isinstance(task, (RemoteTask, AgentTask)):
+        return retcode == SSH_FAILURE
+    if isinstance(task, SubprocessTask):
+        command = task._command # pylint: disable=W0212
+        if isinstance(command, str):
+            command = command.split()
+        program = os.path.basename(command[0]) if command else None
+        if program == 'ssh':
+            return retcode == SSH_FAILURE
+        return program == 'rsync' and retcode in RSYNC_TRANSPORT_FAILURES
+    return False
+
+
+class RetryPolicy(object):
+    """When, and how many times, to retry a task.
+
+    The delay before attempt `n + 1` is ``backoff * multiplier ** (n - 1)``
+    seconds, at most **max_backoff**, and reduced by a random fraction of up
+    to **jitter** of itself, so that tasks which failed together don't all
+    retry at the same time.
+
+    Args:
+        max_attempts (int): The maximum number of times to run the task,
+            including the first. Default `3`.
+
+        backoff (float): The delay before the second attempt, in seconds.
+            Default `1`.
+
+        multiplier (float): The factor between successive delays. Default
+            `2`.
+
+        max_backoff (float): The maximum delay, in seconds. Default `60`.
+
+        jitter (float): The maximum fraction of each delay taken off at
+            random, between `0` and `1`. Default `0.5`.
+
+        retry_if (function): Called as ``retry_if(task, exc_info)`` after
+            every failed attempt, to tell whether it should be retried. See
+            ``transport_failure()``, the default.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, max_attempts=3, backoff=1.0, multiplier=2.0,
+                 max_backoff=60.0, jitter=0.5, retry_if=transport_failure):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_if = retry_if
+
+    def delay(self, attempt):
+        """Return the delay before retrying after a given attempt (from 1)."""
+        delay = min(self.max_backoff,
+                    self.backoff * self.multiplier ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def should_retry(self, task, exc_info, attempt):
+        """Tell whether to retry a task after a given attempt (from 1)."""
+        return (attempt < self.max_attempts and
+                bool(self.retry_if(task, exc_info)))
+
+
+class Retry(Task):
+    """A task which runs another task again when it fails transiently.
+
+    After each attempt which its **policy** says should be retried, the
+    wrapped task is stopped and reset, and started again after a delay. The
+    delays are handled by the ``REACTOR``'s timers, so a waiting ``Retry``
+    doesn't hold a thread.
+
+    The ``return_values`` are those of the last attempt, with
+    ``return_values[\'attempts\']`` set to the number of attempts, and
+    ``return_values[\'attempt_timings\']`` to a list with a dict per attempt
+    holding its ``'start'`` and ``'end'`` times, in seconds since this task
+    was started, and its ``'duration'``. Waiting on this task raises the
+    exception of the last attempt, if it raised one.
+
+    Args:
+        task (``pyrem.task.Task``): The task to run.
+
+        policy (``RetryPolicy``): When to retry it. Default `None`, for a
+            ``RetryPolicy()``.
+    """
+    __slots__ = ('_task', '_policy', '_step_lock', '_token', '_start_time',
+                 '_timings', '_exception')
+
+    _reports_done = True
+
+    def __init__(self, task, policy=None):
+        super(Retry, self).__init__()
+        self._task = task
+        self._policy = policy or RetryPolicy()
+        self._step_lock = Lock()
+        self._token = None
+        self._start_time = None
+        self._timings = []
+        self._exception = None
+
+    def _start(self):
+        self._token = CancellationToken()
+        self._start_time = time.monotonic()
+        self._timings = []
+        self._exception = None
+        self._attempt(self._token)
+
+    def _attempt(self, token):
+        """Start an attempt, unless this task is being stopped."""
+        # pylint: disable=W0212
+        with self._step_lock:
+            if token.cancelled:
+                return
+            if self._task._status is not TaskStatus.IDLE:
+                self._task.stop()
+                self._task.reset()
+            self._timings.append(
+                {'start': time.monotonic() - self._start_time})
+            try:
+                self._task.start()
+            except: # pylint: disable=W0702
+                finished = self._attempt_done(token, sys.exc_info())
+            else:
+                finished = False
+                _on_finish(self._task, self._attempt_finished, token)
+        if finished:
+            self._set_done()
+
+    def _attempt_finished(self, task, token):
+        exc_info = None
+        try:
+            _wait_finished(task)
+        except: # pylint: disable=W0702
+            exc_info = sys.exc_info()
+        with self._step_lock:
+            if token.cancelled:
+                return
+            finished = self._attempt_done(token, exc_info)
+        if finished:
+            self._set_done()
+
+    def _attempt_done(self, token, exc_info):
+        """Schedule the next attempt if the last one should be retried.
+
+        Must be called with ``_step_lock`` held.
+
+        Returns:
+            bool: Whether this task has finished instead.
+        """
+        timing = self._timings[-1]
+        timing['end'] = time.monotonic() - self._start_time
+        timing['duration'] = timing['end'] - timing['start']
+        attempt = len(self._timings)
+        if self._policy.should_retry(self._task, exc_info, attempt):
+            timer = REACTOR.call_later(self._policy.delay(attempt),
+                                       SCHEDULER.submit, self._attempt, token)
+            token.add_callback(timer.cancel)
+            return False
+        self._exception = exc_info
+        self.return_values = dict(self._task.return_values, attempts=attempt,
+                                  attempt_timings=self._timings)
+        return True
+
+    def _wait(self):
+        self._wait_done()
+        if self._exception:
+            _reraise(self._exception)
+
+    def _begin_stop(self):
+        with self._step_lock:
+            self._token.cancel()
+        if self._task._status is TaskStatus.STARTED: # pylint: disable=W0212
+            self._task.stop(wait=False)
+
+    def _wait_stopped(self):
+        stop_all([self._task])
+
+    def _when_stoppable(self, func):
+        _when_all_stoppable([self._task], func)
+
+    def _reset(self):
+        if self._task._status is not TaskStatus.IDLE: # pylint: disable=W0212
+            self._task.reset()
+
+    def _cache_key(self):
+        return self._task._cache_key() # pylint: disable=W0212
+
+    def __repr__(self):
+        return "Retry(status=%s, return_values=%s, task=%s)" % (
+            self._status, _REPR.repr(self.return_values), self._task)
@@ -0,0 +1,257 @@
+"""sampler.py: Contains a sampler of the resources used by running tasks.
+
+A ``Sampler`` given to ``SubprocessTask``s or ``RemoteTask``s periodically
+measures the CPU time, resident memory and I/O of the process tree of each of
+their commands, from ``/proc``. All of the local tasks are sampled together,
+by a single thread, and all of the remote tasks on a host with a single ssh
+command per interval, so sampling barely disturbs the workload being measured.
+Only Linux hosts are supported.
+
+The samples are stored in ``return_values[\'resources\']`` once the task is
+waited on or stopped, as a dict of ``array.array('d')`` series of the same
+length:
+
+* ``'time'``: Seconds since the task was started.
+* ``'cpu'``: CPU time (user and system) used so far, in seconds.
+* ``'rss'``: Resident memory, in bytes.
+* ``'read_bytes'``: Bytes read from storage so far.
+* ``'write_bytes'``: Bytes written to storage so far.
+
+Example:
+
+    sampler = Sampler(interval=0.5)
+    server = host.run(['./server'], sampler=sampler)
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+__all__ = ['Sampler']
+
+import os
+import time
+
+from array import array
+from collections import defaultdict
+from subprocess import Popen, PIPE, DEVNULL
+from threading import Lock, Thread
+
+from pyrem.task import RemoteTask
+
+
+_SERIES = ['time', 'cpu', 'rss', 'read_bytes', 'write_bytes']
+
+
+def _parse_stat(line):
+    """Parse a line of ``/proc/<pid>/stat``.
+
+    Returns:
+        tuple: The pid, parent pid, CPU time in clock ticks, and resident
+            memory in pages.
+    """
+    # The command name is in parentheses and may contain anything
+    end = line.rfind(')')
+    fields = line[end + 2:].split()
+    return (int(line[:line.index(' ')]), int(fields[1]),
+            int(fields[11]) + int(fields[12]), int(fields[21]))
+
+
+def _totals(stats, io, roots, ticks, page_size):
+    """Sum the resources used by the process trees rooted at some pids.
+
+    Returns:
+        tuple: The CPU time, resident memory, bytes read and bytes written,
+            or `None` if none of the roots exist.
+    """
+    children = defaultdict(list)
+    for pid, (ppid, _, _) in stats.items():
+        children[ppid].append(pid)
+    pending = [pid for pid in roots if pid in stats]
+    if not pending:
+        return None
+    cpu = rss = read = written = 0
+    seen = set()
+    while pending:
+        pid = pending.pop()
+        if pid in seen:
+            continue
+        seen.add(pid)
+        _, pid_ticks, pages = stats[pid]
+        cpu += pid_ticks
+        rss += pages
+        read += io.get(pid, (0, 0))[0]
+        written += io.get(pid, (0, 0))[1]
+        pending.extend(children[pid])
+    return (float(cpu) / ticks, float(rss * page_size), float(read),
+            float(written))
+
+
+def _local_processes():
+    """Read the stats and I/O counters of all local processes."""
+    stats = {}
+    io = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name, 'rb') as f:
+                pid, ppid, ticks, pages = _parse_stat(
+                    f.read().decode(errors='replace'))
+            stats[pid] = (ppid, ticks, pages)
+            with open('/proc/%s/io' % name) as f:
+                counters = dict(line.split(': ') for line in f)
+            io[pid] = (int(counters['read_bytes']),
+                       int(counters['write_bytes']))
+        except (OSError, ValueError, KeyError, IndexError):
+            # Gone, or not ours to read
+            continue
+    return stats, io
+
+
+def _remote_script(pid_files):
+    """Return the remote command printing what a remote pass needs."""
+    return ' ; '.join([
+        'getconf CLK_TCK',
+        'getconf PAGESIZE',
+        'for f in %s ; do echo F $f `cat $f 2>/dev/null` ; done' %
+        ' '.join(pid_files),
+        'echo STAT',
+        'cat /proc/[0-9]*/stat 2>/dev/null',
+        'echo IO',
+        'grep -H -s _bytes /proc/[0-9]*/io'])
+
+
+def _parse_remote(output):
+    """Parse the output of ``_remote_script``.
+
+    Returns:
+        tuple: The clock ticks per second, page size, pids by pid file, and
+            the stats and I/O counters of the processes.
+    """
+    lines = output.decode(errors='replace').splitlines()
+    ticks, page_size = int(lines[0]), int(lines[1])
+    roots = {}
+    stats = {}
+    io = defaultdict(lambda: [0, 0])
+    section = None
+    for line in lines[2:]:
+        if line in ['STAT', 'IO']:
+            section = line
+        elif section is None and line.startswith('F '):
+            fields = line.split()
+            roots[fields[1]] = [int(pid) for pid in fields[2:]]
+        elif section == 'STAT':
+            try:
+                pid, ppid, pid_ticks, pages = _parse_stat(line)
+            except (ValueError, IndexError):
+                continue
+            stats[pid] = (ppid, pid_ticks, pages)
+        elif section == 'IO':
+            # /proc/<pid>/io:read_bytes: <n>
+            path, name, value = line.split(':')
+            if name in ['read_bytes', 'write_bytes']:
+                io[int(path.split('/')[2])][name == 'write_bytes'] = int(value)
+    return ticks, page_size, roots, stats, io
+
+
+class _Series(object):
+    """The samples of one task."""
+    def __init__(self):
+        self.start = time.monotonic()
+        self.series = {name: array('d') for name in _SERIES}
+
+    def append(self, now, totals):
+        if totals is None:
+            return
+        self.series['time'].append(now - self.start)
+        for name, value in zip(_SERIES[1:], totals):
+            self.series[name].append(value)
+
+
+class Sampler(object):
+    """Samples the resources used by tasks, every **interval** seconds.
+
+    The sampling thread runs while there are tasks to sample.
+
+    Args:
+        interval (float): Seconds between samples. Default `1`.
+    """
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._lock = Lock()
+        self._tasks = {}
+        self._thread = None
+
+    def add(self, task):
+        """Start sampling a started task."""
+        with self._lock:
+            self._tasks[task] = _Series()
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='pyrem-sampler')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def remove(self, task):
+        """Stop sampling a task.
+
+        Returns:
+            dict: The series of samples of the task (see ``pyrem.sampler``),
+                or `None` if it wasn't being sampled.
+        """
+        with self._lock:
+            samples = self._tasks.pop(task, None)
+        return samples and samples.series
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._tasks:
+                    self._thread = None
+                    return
+                tasks = list(self._tasks.items())
+            began = time.monotonic()
+            self._sample(tasks)
+            time.sleep(max(0, self.interval - (time.monotonic() - began)))
+
+    @staticmethod
+    def _sample(tasks):
+        """Take one sample of every task."""
+        # pylint: disable=W0212
+        local = []
+        remote = defaultdict(list)
+        for task, series in tasks:
+            if isinstance(task, RemoteTask):
+                remote[task._ssh_cmd + (task.host,)].append(
+                    (task, series))
+            elif task._process:
+                local.append((task, series))
+
+        # One command per host, all hosts at once
+        passes = []
+        for ssh_cmd, group in remote.items():
+            script = _remote_script([t._tmp_file_name for t, _ in group])
+            passes.append((group, Popen(list(ssh_cmd) + [script],
+                                        stdin=DEVNULL, stdout=PIPE,
+                                        stderr=DEVNULL)))
+
+        if local:
+            stats, io = _local_processes()
+            now = time.monotonic()
+            ticks = os.sysconf('SC_CLK_TCK')
+            page_size = os.sysconf('SC_PAGESIZE')
+            for task, series in local:
+                series.append(now, _totals(stats, io, [task._process.pid],
+                                           ticks, page_size))
+
+        for group, process in passes:
+            output = process.communicate()[0]
+            now = time.monotonic()
+            try:
+                ticks, page_size, roots, stats, io = _parse_remote(output)
+            except (ValueError, IndexError):
+                # The host couldn't be reached this time
+                continue
+            for task, series in group:
+                series.append(now, _totals(
+                    stats, io, roots.get(task._tmp_file_name, []), ticks,
+                    page_size))
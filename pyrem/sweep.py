@@ -0,0 +1,384 @@
+"""sweep.py: Contains a runner for parameter sweeps over a pool of hosts.
+
+A ``Sweep`` runs a command for every combination of a grid of parameters,
+spread over a pool of hosts, and collects a row of results per run:
+
+    sweep = Sweep(['./bench', '--threads={threads}', '--size={size}'],
+                  {'threads': [1, 2, 4, 8], 'size': [64, 4096]},
+                  HostGroup(['node1', 'node2', 'node3']),
+                  extractor=lambda output, params: {
+                      'ops': float(output.split()[-1])})
+    results = sweep.start(wait=True)['results']
+    results['ops']  # array('d', [...]), one value per run
+
+Runs are handed out to the hosts as they become free, rather than split
+between them up front, so that no host sits idle while there are runs left,
+however long each run takes. With an estimate of the cost of each run, the
+most expensive runs are started first, which keeps a long run from being the
+only one still going at the end.
+
+The results are kept in columns rather than in a dict per run: a
+``ColumnStore`` keeps them in memory, in ``array.array``s for numbers, and
+can hand them to NumPy; a ``CsvStore`` writes them to a CSV file as the runs
+finish.
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+__all__ = ['Sweep', 'ColumnStore', 'CsvStore', 'grid_points']
+
+import csv
+import itertools
+import numbers
+import sys
+import time
+
+from array import array
+from collections import deque
+from threading import Lock
+
+from pyrem.task import (Task, TaskStatus, _REPR, _on_finish, _reraise,
+                        _wait_finished, _when_all_stoppable, stop_all)
+from pyrem.utils import CancellationToken
+
+
+def grid_points(grid):
+    """Expand a grid of parameters into every combination of their values.
+
+    Args:
+        grid (dict): Maps the name of each parameter to a list of its values.
+
+    Returns:
+        list of dict: A dict of parameter values per combination, with the
+            last parameter of the grid varying fastest.
+    """
+    names = list(grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[grid[n] for n in names])]
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+class ColumnStore(object):
+    """Keeps results in memory, as a column per name.
+
+    Columns whose values are all numbers are ``array.array('d')``s (integers
+    are stored as floats), the others are lists. Rows missing a column hold
+    `nan` (or `None` in lists) in it, and so do the earlier rows of a column
+    which first appears in a later row.
+    """
+    def __init__(self):
+        self.columns = {}
+        self._rows = 0
+
+    def append(self, row):
+        """Add a row, given as a dict mapping column names to values."""
+        for name, value in row.items():
+            column = self.columns.get(name)
+            if column is None:
+                column = (array('d', [float('nan')] * self._rows)
+                          if _is_number(value) else [None] * self._rows)
+                self.columns[name] = column
+            elif isinstance(column, array) and not _is_number(value):
+                column = self.columns[name] = [
+                    None if v != v else v for v in column]
+            column.append(value)
+        for column in self.columns.values():
+            if len(column) == self._rows:
+                column.append(float('nan') if isinstance(column, array)
+                              else None)
+        self._rows += 1
+
+    def to_numpy(self):
+        """Return the columns as NumPy arrays. Requires NumPy.
+
+        Returns:
+            dict: Maps the name of each column to a ``numpy.ndarray``.
+        """
+        import numpy # pylint: disable=import-error
+        return {name: numpy.array(column)
+                for name, column in self.columns.items()}
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return self._rows
+
+    def __repr__(self):
+        return "ColumnStore(rows=%d, columns=%s)" % (
+            self._rows, _REPR.repr(list(self.columns)))
+
+
+class CsvStore(object):
+    """Writes results to a CSV file, a row at a time, as they are added.
+
+    The header is written with the first row, and lists its columns (after
+    **columns**). Each row is flushed to the file once written, so that the
+    results of a sweep which is interrupted are kept. A row with columns
+    which aren't in the header yet (e.g. the first successful run of a sweep,
+    after failed runs without metrics) has the file rewritten with the new
+    columns added, which only happens as often as new columns appear.
+
+    Args:
+        path (str): The path of the file, which is overwritten.
+
+        columns (list of str): The first columns of the file, in order.
+            Default `None`.
+    """
+    def __init__(self, path, columns=None):
+        self.path = path
+        self.columns = list(columns or [])
+        self._file = None
+        self._writer = None
+        self._rows = 0
+
+    def append(self, row):
+        """Write a row, given as a dict mapping column names to values."""
+        if self._file is None:
+            self._file = open(self.path, 'a' if self._rows else 'w',
+                              newline='')
+            self._writer = csv.writer(self._file)
+            if not self._rows:
+                self.columns += [name for name in row
+                                 if name not in self.columns]
+                self._writer.writerow(self.columns)
+        new = [name for name in row if name not in self.columns]
+        if new:
+            self._add_columns(new)
+        self._writer.writerow([row.get(name, '') for name in self.columns])
+        self._file.flush()
+        self._rows += 1
+
+    def _add_columns(self, names):
+        """Rewrite the file with more columns, empty in the earlier rows."""
+        self._file.close()
+        with open(self.path, newline='') as f:
+            rows = list(csv.reader(f))[1:]
+        self.columns = self.columns + names
+        with open(self.path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns)
+            writer.writerows(row + [''] * len(names) for row in rows)
+        self._file = open(self.path, 'a', newline='')
+        self._writer = csv.writer(self._file)
+
+    def close(self):
+        """Close the file. Adding another row opens it anew."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return self._rows
+
+    def __repr__(self):
+        return "CsvStore(path=%s, rows=%d)" % (self.path, self._rows)
+
+
+class Sweep(Task):
+    """A task which runs a command for every point of a parameter grid.
+
+    The runs are spread over a pool of hosts: each host runs up to
+    **runs_per_host** of them at once, and takes the next run as soon as one
+    finishes. Each run adds a row to the **store**, with a column per
+    parameter, and the columns ``'repetition'`` (from `0`), ``'host'``,
+    ``'retcode'`` and ``'duration'`` (in seconds), followed by the metrics
+    returned by the **extractor**. A run which fails (a non-zero
+    ``'retcode'``) is recorded like any other, without metrics.
+
+    Once the sweep is waited on, ``return_values[\'results\']`` holds the
+    store and ``return_values[\'runs\']`` the number of runs recorded. If
+    starting a run or the extractor raises an exception, no more runs are
+    started, and waiting on the sweep raises it once the running ones have
+    finished.
+
+    Args:
+        command (list of str or function): The command of each run. Each
+            element of a list is formatted with the parameters of the run
+            (e.g. ``'--threads={threads}'``, see ``str.format``). A function
+            is called with the dict of parameters and returns the command.
+
+        grid (dict or list of dict): Maps the name of each parameter to its
+            list of values, to run every combination (see
+            ``grid_points()``), or the list of parameter dicts to run.
+
+        hosts (list of ``pyrem.host.Host`` or ``pyrem.host.HostGroup``): The
+            hosts to run on. The commands are run with ``host.run()``.
+
+        extractor (function): Called as ``extractor(output, params)`` with
+            the standard output of each successful run, as a ``str``, and its
+            parameters. Returns a dict of metrics to add to its row. Default
+            `None`.
+
+        store (``ColumnStore`` or ``CsvStore``): Where to put the results.
+            Anything with an ``append(row)`` method works. Default `None`,
+            for a new ``ColumnStore``.
+
+        repetitions (int): The number of times to run each point. Default
+            `1`.
+
+        runs_per_host (int): The maximum number of runs at once on each
+            host. Default `1`.
+
+        cost (function): If given, called with the parameters of each run
+            to estimate how long it takes, and the most expensive runs are
+            started first. Otherwise, runs are started in grid order. Default
+            `None`.
+
+        **kwargs: Passed to ``host.run()`` for every run. The output of the
+            runs is always returned.
+    """
+    __slots__ = ('_command', '_points', '_hosts', '_extractor', '_store',
+                 '_runs_per_host', '_run_kwargs', '_step_lock', '_queue',
+                 '_running', '_active', '_runs', '_exception', '_token')
+
+    _reports_done = True
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, command, grid, hosts, extractor=None, store=None,
+                 repetitions=1, runs_per_host=1, cost=None, **kwargs):
+        super(Sweep, self).__init__()
+        self._command = command
+        points = grid_points(grid) if isinstance(grid, dict) else list(grid)
+        if cost is not None:
+            # Stable, so that runs of the same cost keep their order
+            points.sort(key=cost, reverse=True)
+        self._points = [(params, repetition) for params in points
+                        for repetition in range(repetitions)]
+        self._hosts = list(getattr(hosts, 'hosts', hosts))
+        self._extractor = extractor
+        self._store = store if store is not None else ColumnStore()
+        self._runs_per_host = runs_per_host
+        kwargs['return_output'] = True
+        self._run_kwargs = kwargs
+
+        self._step_lock = Lock()
+        self._queue = deque()
+        self._running = set()
+        self._active = 0
+        self._runs = 0
+        self._exception = None
+        self._token = None
+
+    def _start(self):
+        token = self._token = CancellationToken()
+        with self._step_lock:
+            self._queue = deque(self._points)
+            self._running = set()
+            self._runs = 0
+            self._exception = None
+            slots = [host for host in self._hosts
+                     for _ in range(self._runs_per_host)]
+            self._active = len(slots)
+        if not slots:
+            self._set_done()
+        for host in slots:
+            self._next_run(host, token)
+
+    def _format(self, params):
+        if callable(self._command):
+            return list(self._command(params))
+        return [str(arg).format(**params) for arg in self._command]
+
+    def _next_run(self, host, token):
+        """Start the next run on a host which has a free slot."""
+        with self._step_lock:
+            # The runs of an earlier start finish after it was stopped
+            if token is not self._token:
+                return
+            task = None
+            if not token.cancelled and self._queue:
+                params, repetition = self._queue.popleft()
+                # Start the run while holding the lock so that _begin_stop
+                # never misses it
+                try:
+                    task = host.run(self._format(params), **self._run_kwargs)
+                    task.start()
+                except: # pylint: disable=W0702
+                    task = None
+                    self._fail(sys.exc_info())
+                else:
+                    self._running.add(task)
+            if task is None:
+                self._active -= 1
+                done = not self._active
+        if task is None:
+            if done:
+                self._set_done()
+            return
+        _on_finish(task, self._run_finished, host, params, repetition,
+                   time.monotonic(), token)
+
+    # pylint: disable=too-many-arguments
+    def _run_finished(self, task, host, params, repetition, started, token):
+        try:
+            _wait_finished(task)
+        except: # pylint: disable=W0702
+            # E.g. require_success, the return code is recorded anyway
+            task.stop()
+        duration = time.monotonic() - started
+        values = task.return_values
+        row = dict(params)
+        row['repetition'] = repetition
+        row['host'] = host.hostname
+        row['retcode'] = values.get('retcode')
+        row['duration'] = duration
+        try:
+            if self._extractor is not None and row['retcode'] == 0:
+                output = (values.get('stdout') or b'').decode(errors='replace')
+                row.update(self._extractor(output, params))
+            with self._step_lock:
+                self._running.discard(task)
+                if not token.cancelled:
+                    self._store.append(row)
+                    self._runs += 1
+        except: # pylint: disable=W0702
+            with self._step_lock:
+                self._running.discard(task)
+                if token is self._token:
+                    self._fail(sys.exc_info())
+        self._next_run(host, token)
+
+    def _fail(self, exc_info):
+        """Record the first exception and stop starting runs.
+
+        Must be called with ``self._step_lock`` held.
+        """
+        if self._exception is None:
+            self._exception = exc_info
+        self._queue.clear()
+
+    def _wait(self):
+        self._wait_done()
+        self.return_values['results'] = self._store
+        self.return_values['runs'] = self._runs
+        if self._exception:
+            _reraise(self._exception)
+
+    def _begin_stop(self):
+        with self._step_lock:
+            self._token.cancel()
+            self._queue.clear()
+            running = list(self._running)
+        for task in running:
+            if task._status is TaskStatus.STARTED: # pylint: disable=W0212
+                task.stop(wait=False)
+
+    def _wait_stopped(self):
+        with self._step_lock:
+            running = list(self._running)
+        stop_all(running)
+
+    def _when_stoppable(self, func):
+        with self._step_lock:
+            running = list(self._running)
+        _when_all_stoppable(running, func)
+
+    def __repr__(self):
+        return "Sweep(status=%s, return_values=%s, runs=%d, hosts=%d)" % (
+            self._status, _REPR.repr(self.return_values), len(self._points),
+            len(self._hosts))
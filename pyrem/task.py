@@ -4,32 +4,196 @@ __author__ = "Ellis Michael"
 __email__ = "emichael@cs.washington.edu"
 
 __all__ = ['Task', 'SubprocessTask', 'RemoteTask', 'Parallel',
-           'Sequential']
+           'Sequential', 'TaskGraph', 'stop_all', 'as_completed',
+           'wait_any']
 
 import atexit
+import heapq
+import inspect
+import math
 import os
 import random
+import reprlib
+import shlex
 import string
 import signal
 import sys
+import time
+import weakref
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from enum import Enum
+from queue import Empty, Queue
 from subprocess import Popen, PIPE
-from threading import RLock, Thread
+from threading import Condition, Event, Lock, RLock, Thread
 from traceback import format_exception
 
-from pyrem.utils import synchronized
+from pyrem.reactor import REACTOR
+from pyrem.utils import CancellationToken, WorkerPool, synchronized
 
 
-TaskStatus = Enum('TaskStatus', 'IDLE STARTED STOPPED') # pylint: disable=C0103
+TaskStatus = Enum('TaskStatus', 'IDLE STARTED STOPPING STOPPED') # pylint: disable=C0103
 
-STARTED_TASKS = set()
+
+class _TaskRegistry(object):
+    """The tasks which have been started and not stopped yet.
+
+    Behaves like a set of tasks, but keeps the tasks grouped by their ``host``
+    attribute (`None` for local and composite tasks), so that the tasks
+    running on one host can be found without going through every started
+    task.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._by_host = {}
+
+    def add(self, task):
+        host = getattr(task, 'host', None)
+        with self._lock:
+            tasks = self._by_host.get(host)
+            if tasks is None:
+                tasks = self._by_host[host] = set()
+            tasks.add(task)
+
+    def discard(self, task):
+        host = getattr(task, 'host', None)
+        with self._lock:
+            tasks = self._by_host.get(host)
+            if tasks is None or task not in tasks:
+                return False
+            tasks.remove(task)
+            if not tasks:
+                del self._by_host[host]
+            return True
+
+    def remove(self, task):
+        if not self.discard(task):
+            raise KeyError(task)
+
+    def hosts(self):
+        """Return the hosts with started tasks."""
+        with self._lock:
+            return [host for host in self._by_host if host is not None]
+
+    def tasks_on(self, host):
+        """Return the started tasks on a host (`None` for local tasks)."""
+        with self._lock:
+            return set(self._by_host.get(host, ()))
+
+    def copy(self):
+        """Return all of the started tasks, as a set."""
+        with self._lock:
+            return set().union(*self._by_host.values())
+
+    def __contains__(self, task):
+        return task in self._by_host.get(getattr(task, 'host', None), ())
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(tasks) for tasks in self._by_host.values())
+
+
+STARTED_TASKS = _TaskRegistry()
+
+# Functions run by cleanup() after all started tasks have been stopped.
+CLEANUP_HOOKS = []
+
+# Runs the work that has to be done when tasks finish (e.g. starting the next
+# task of a Sequential), for all tasks. Set SCHEDULER.max_workers to resize it.
+SCHEDULER = WorkerPool(max_workers=32)
+
+# Records the lifecycle of every task while tracing is enabled, see
+# pyrem.trace. Tasks only check whether it is set when tracing is disabled.
+TRACER = None
+
+# Immutable values used by many tasks (e.g. ssh commands), so that each
+# distinct value is only stored once, however many tasks there are
+_SHARED = {}
+
+def _shared(value):
+    """Return the shared copy of a hashable, immutable value."""
+    return _SHARED.setdefault(value, value)
+
+
+class _BoundedRepr(reprlib.Repr):
+    """Truncates the reprs of tasks, which can end up in any log message."""
+    def __init__(self):
+        reprlib.Repr.__init__(self)
+        self.maxstring = self.maxother = 80
+        self.maxlist = self.maxtuple = self.maxdict = 8
+
+    def repr_bytes(self, x, level): # pylint: disable=W0613
+        if len(x) <= self.maxstring:
+            return repr(x)
+        return repr(x[:self.maxstring - 3]) + '...'
+
+_REPR = _BoundedRepr()
+
+# Popen arguments running a subprocess in a process group of its own. Unlike
+# a new session, the group keeps the controlling terminal, so that ssh can
+# still prompt for passwords and host keys
+if sys.version_info >= (3, 11):
+    _NEW_PROCESS_GROUP = {'process_group': 0}
+else:
+    _NEW_PROCESS_GROUP = {'preexec_fn': os.setpgrp}
+
+# The ssh options which only choose how to connect, not what is run: the
+# ControlPath of a RemoteHost is in a fresh temporary directory every run
+_TRANSPORT_OPTIONS = ('ControlMaster=', 'ControlPath=', 'ControlPersist=')
+
+def _without_transport(command):
+    """Return a command without the ssh options in ``_TRANSPORT_OPTIONS``.
+
+    Used for cache keys. Identity files are dropped too, as are the options
+    of ssh commands passed as a single argument (e.g. ``rsync -e``), and that
+    argument altogether if only ``ssh`` is left of it.
+    """
+    if isinstance(command, str):
+        return command
+    result = []
+    args = iter(command)
+    in_ssh = False
+    for arg in args:
+        if in_ssh and arg == '-i':
+            next(args, None)
+            continue
+        if in_ssh and arg == '-o':
+            option = next(args, '')
+            if not option.startswith(_TRANSPORT_OPTIONS):
+                result += [arg, option]
+            continue
+        if arg.startswith('ssh '):
+            arg = ' '.join(shlex.quote(a)
+                           for a in _without_transport(shlex.split(arg)))
+        if arg == 'ssh' and result and result[-1] == '-e':
+            # rsync's default remote shell, as without any ssh options
+            result.pop()
+            continue
+        in_ssh = (arg == 'ssh' if not result else
+                  in_ssh and arg.startswith('-'))
+        result.append(arg)
+    return tuple(result)
+
+def _accepted_kwargs(cls, kwargs):
+    """Return the keyword arguments, out of **kwargs**, which the init method
+    of a task class accepts.
+
+    Used by helpers which build tasks of several types from the same options,
+    some of which only apply to one type (e.g. **shell**, **kill_remote**).
+    """
+    parameters = inspect.signature(cls.__init__).parameters
+    return {k: v for k, v in kwargs.items() if k in parameters}
 
 @atexit.register
 def cleanup():
     """Stop all started tasks on system exit.
 
+    Once the tasks are stopped, every function in ``CLEANUP_HOOKS`` is called
+    (e.g. to close shared ssh connections).
+
     Note: This only handles signals caught by the atexit module by default.
     SIGKILL, for instance, will not be caught, so cleanup is not guaranteed in
     all cases.
@@ -37,15 +201,15 @@ def cleanup():
     to_stop = STARTED_TASKS.copy()
     if to_stop:
         print("Cleaning up...")
-    for task in to_stop:
+    for etype, value, trace in _stop_all(to_stop):
+        # Disregard no such process exceptions, print out the rest
+        if not (isinstance(value, OSError) and value.errno == 3):
+            print(''.join(format_exception(etype, value, trace, None)))
+    for hook in CLEANUP_HOOKS:
         try:
-            task.stop()
+            hook()
         except: # pylint: disable=W0702
-            etype, value, trace = sys.exc_info()
-            # Disregard no such process exceptions, print out the rest
-            if not (isinstance(value, OSError) and value.errno == 3):
-                print(''.join(format_exception(etype, value, trace, None)))
-            continue
+            print(''.join(format_exception(*sys.exc_info())))
 
 def sigterm_handler(_sig, _frame):
     sys.exit(0)
@@ -55,31 +219,392 @@ def sigterm_handler(_sig, _frame):
 if not signal.getsignal(signal.SIGTERM):
     signal.signal(signal.SIGTERM, sigterm_handler)
 
-# TODO: create a wait_stopped() so that Tasks can be stopped in parallel
+def _reraise(exc_info):
+    """Raise an exception recorded with ``sys.exc_info()`` in another thread."""
+    raise exc_info[1].with_traceback(exc_info[2])
+
+def _stop_all(tasks):
+    """Stop the given tasks concurrently, returning the exceptions raised.
+
+    Returns:
+        list: The ``sys.exc_info()`` of every exception raised while stopping
+            the tasks.
+    """
+    # pylint: disable=W0212
+    errors = []
+    killing = []
+    stopping = []
+    for task in tasks:
+        try:
+            if not isinstance(task, Task):
+                # Tasks driven by an event loop (see pyrem.asynctask), which
+                # can only be stopped synchronously by killing them
+                task.kill(wait=False)
+                killing.append(task)
+            elif task._status in [TaskStatus.STARTED, TaskStatus.STOPPING]:
+                task.stop(wait=False)
+                stopping.append(task)
+        except: # pylint: disable=W0702
+            errors.append(sys.exc_info())
+    for task in killing:
+        try:
+            task.wait_killed()
+        except: # pylint: disable=W0702
+            errors.append(sys.exc_info())
+    for task in stopping:
+        try:
+            task.wait_stopped()
+        except: # pylint: disable=W0702
+            errors.append(sys.exc_info())
+    return errors
+
+def stop_all(tasks):
+    """Stop several tasks at once.
+
+    Every task is asked to stop before waiting on any of them, so the tasks
+    are torn down concurrently, and the remote processes of all ``RemoteTask``s
+    on the same host are killed with a single ssh command. Tasks which haven't
+    been started or which are already stopped are skipped.
+
+    Args:
+        tasks (list of ``Task``): The tasks to stop.
+
+    Raises:
+        The first exception raised while stopping a task, once all of the
+        tasks have been stopped.
+    """
+    errors = _stop_all(tasks)
+    if errors:
+        _reraise(errors[0])
+
+
+def _stop_started(tasks):
+    """Stop those of the given tasks which are running, after a failure.
+
+    Also waits on the tasks which are already being stopped. Errors raised
+    while stopping them are dropped, the failure is what gets reported.
+    """
+    _stop_all(tasks)
+
+
+def _when_all_stoppable(tasks, func):
+    """Call ``func()`` once none of the given tasks which are being stopped
+    would block ``wait_stopped()`` (see ``Task._when_stoppable()``).
+    """
+    # pylint: disable=W0212
+    stopping = [t for t in tasks if t._status is TaskStatus.STOPPING]
+    if not stopping:
+        func()
+        return
+    lock = Lock()
+    remaining = [len(stopping)]
+
+    def stoppable():
+        with lock:
+            remaining[0] -= 1
+            last = not remaining[0]
+        if last:
+            func()
+
+    for task in stopping:
+        task._when_stoppable(stoppable)
+
+
+class _Waiter(object):
+    """Waits on a task once, and stops it, for everyone who needs it done.
+
+    Waiting on a task which doesn't report when it finishes blocks for as long
+    as it runs, so it is done by a thread of its own rather than by the
+    ``SCHEDULER``, whose threads are needed by other tasks (e.g. those the task
+    itself is waiting on) to make progress. A task which reports when it
+    finishes is waited on by the ``SCHEDULER`` once it has, and then stopped
+    without blocking it: the slow parts of stopping (e.g. the grace period of
+    leftover processes, or killing remote processes over ssh) are finished by
+    the reactor (see ``Task._when_stoppable()``).
+
+    Either way, the task is stopped even if waiting on it raises. There is at
+    most one waiter per run of a task (see ``_waiter_for()``), so that the
+    task is only waited on once.
+    """
+    def __init__(self, task):
+        self._lock = Lock()
+        self._finished = False
+        self._event = Event()
+        self._exc_info = None
+        self._callbacks = []
+        # The task and its callbacks hold the waiter, the waiter must not hold
+        # the task (see _WAITERS)
+        if task._reports_done: # pylint: disable=W0212
+            task.add_done_callback(
+                lambda t: SCHEDULER.submit(self._wait_reported, t))
+        else:
+            thread = Thread(target=self._run, args=(task,),
+                            name='pyrem-waiter')
+            thread.daemon = True
+            thread.start()
+
+    def _run(self, task):
+        try:
+            task.wait()
+        except: # pylint: disable=W0702
+            self._exc_info = sys.exc_info()
+            if task._status is TaskStatus.STARTED: # pylint: disable=W0212
+                try:
+                    task.stop()
+                except: # pylint: disable=W0702
+                    pass
+        self._finish()
+
+    def _wait_reported(self, task):
+        # pylint: disable=W0212
+        if task._status is TaskStatus.STARTED:
+            try:
+                task._wait_traced()
+            except: # pylint: disable=W0702
+                self._exc_info = sys.exc_info()
+            try:
+                task.stop(wait=False)
+            except: # pylint: disable=W0702
+                self._exc_info = self._exc_info or sys.exc_info()
+        if task._status is TaskStatus.STOPPING:
+            task._when_stoppable(
+                lambda: SCHEDULER.submit(self._stopped, task))
+        else:
+            self._finish()
+
+    def _stopped(self, task):
+        try:
+            task.wait_stopped()
+        except: # pylint: disable=W0702
+            self._exc_info = self._exc_info or sys.exc_info()
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._finished = True
+            callbacks, self._callbacks = self._callbacks, []
+        self._event.set()
+        for func in callbacks:
+            func()
+
+    def add_callback(self, func):
+        """Call ``func()`` once the task has been waited on (or now)."""
+        with self._lock:
+            if not self._finished:
+                self._callbacks.append(func)
+                return
+        func()
+
+    def remove_callback(self, func):
+        with self._lock:
+            if func in self._callbacks:
+                self._callbacks.remove(func)
+
+    def result(self):
+        """Raise the exception raised by waiting on the task, if any, once
+        the task has been waited on and stopped.
+        """
+        self._event.wait()
+        if self._exc_info:
+            _reraise(self._exc_info)
+
+
+# The waiters of the tasks, by task, until the tasks are reset
+_WAITERS = weakref.WeakKeyDictionary()
+_WAITERS_LOCK = Lock()
+
+def _waiter_for(task):
+    """Return the waiter of a started task, starting it if needed."""
+    with _WAITERS_LOCK:
+        waiter = _WAITERS.get(task)
+        if waiter is None:
+            waiter = _WAITERS[task] = _Waiter(task)
+    return waiter
+
+def _wait_finished(task):
+    """Wait on a task which has finished, e.g. in a function of ``_on_finish``.
+
+    A task which was waited on by its waiter isn't waited on again, the
+    exception raised then (if any) is raised instead, and the task has been
+    stopped either way.
+    """
+    with _WAITERS_LOCK:
+        waiter = _WAITERS.get(task)
+    if waiter is not None:
+        waiter.result()
+    elif task._status is TaskStatus.STARTED: # pylint: disable=W0212
+        task.wait()
+
+def _on_finish(task, func, *args):
+    """Call ``func(task, *args)`` on the ``SCHEDULER`` once a task finishes.
+
+    **func** should get the outcome of the task with ``_wait_finished()``.
+    The task is waited on and stopped by its waiter first (see ``_Waiter``),
+    which never blocks the scheduler.
+    """
+    _waiter_for(task).add_callback(lambda: SCHEDULER.submit(func, task, *args))
+
+
+class _Completions(object):
+    """Collects tasks as they finish, for ``as_completed()`` and ``wait_any()``.
+
+    Tasks that report when they have finished are waited on once they have,
+    by the thread consuming the completions. Other tasks are waited on by
+    their waiter (see ``_Waiter``), which is shared with every other caller,
+    so that they are only waited on once. The callbacks added to the tasks
+    are removed by ``close()``.
+    """
+    def __init__(self, tasks):
+        self._queue = Queue()
+        self.pending = set(tasks)
+        self._callbacks = []
+        for task in self.pending:
+            # pylint: disable=W0212
+            if task._reports_done or task.done():
+                func = self._queue.put
+                self._callbacks.append((task.remove_done_callback, func))
+                task.add_done_callback(func)
+            else:
+                waiter = _waiter_for(task)
+                func = lambda task=task: self._queue.put(task)
+                self._callbacks.append((waiter.remove_callback, func))
+                waiter.add_callback(func)
+
+    def next(self, timeout=None):
+        """Return the next task to finish, after waiting on it.
+
+        Returns `None` if no task finished within **timeout** seconds.
+        """
+        try:
+            task = self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+        self.pending.discard(task)
+        _wait_finished(task)
+        return task
+
+    def close(self):
+        """Remove the callbacks added to the tasks which are still pending."""
+        for remove, func in self._callbacks:
+            remove(func)
+        self._callbacks = []
+
+def as_completed(tasks):
+    """Iterate over started tasks in the order in which they finish.
+
+    Each task is waited on (and therefore stopped) as soon as it finishes,
+    and then yielded with its ``return_values`` filled in. Tasks which were
+    stopped by someone else are yielded as they are stopped. The built-in
+    tasks report when they finish, so any number of them can be tracked
+    without additional threads; other tasks are waited on by a thread each,
+    once, however many times they are tracked.
+
+    Args:
+        tasks (list of ``Task``): The tasks to wait on.
+
+    Raises:
+        Any exception raised while waiting on a task, when that task finishes.
+    """
+    completions = _Completions(tasks)
+    try:
+        while completions.pending:
+            yield completions.next()
+    finally:
+        completions.close()
+
+def wait_any(tasks, timeout=None):
+    """Wait on the first of several started tasks to finish.
+
+    The finished task is waited on (and therefore stopped) before it is
+    returned, the others keep running. See ``as_completed()``.
+
+    Args:
+        tasks (list of ``Task``): The tasks to wait on.
+
+        timeout (float): The maximum number of seconds to wait, or `None` to
+            wait indefinitely. Default `None`.
+
+    Returns:
+        ``Task``: The task which finished, or `None` if no task finished in
+            time.
+
+    Raises:
+        Any exception raised while waiting on the task which finished.
+    """
+    completions = _Completions(tasks)
+    try:
+        return completions.next(timeout)
+    finally:
+        completions.close()
+
 
 class Task(object):
     """Abstract class, the main unit of execution in PyREM.
 
     If you would like to define your own type of ``Task``, you should at least
     implement the ``_start``, ``_wait``, ``_stop``, and ``_reset`` methods.
+    Tasks whose teardown takes a while can instead implement ``_begin_stop``,
+    which should only initiate the teardown, and ``_wait_stopped``, which
+    waits for it to finish, so that they can be stopped concurrently.
+
+    Tasks which can tell when they have finished without blocking should set
+    ``_reports_done`` to `True` and call ``_set_done()`` when they finish, so
+    that they can be waited on by ``as_completed()`` and ``wait_any()``
+    without a thread each. Other tasks are only considered done once they are
+    stopped.
 
     Every task that gets started will be stopped on Python exit, as long as that
     exit can be caught by the ``atexit`` module (e.g. pressing `Ctrl+C` will be
     caught, but sending `SIGKILL` will not be caught).
 
+    The built-in tasks use ``__slots__`` and only allocate their lock once
+    they are used, so that very large numbers of tasks can be created.
+    Subclasses which don't declare ``__slots__`` work all the same.
+
+    A task can be given a time limit, with the **timeout** of ``start()`` or
+    ``wait()`` (or the **deadline** of ``Parallel``, ``Sequential`` and
+    ``TaskGraph``). A task still running when its time is up is stopped, and
+    ``return_values[\'timed_out\']`` is set to `True`. The time limits of all
+    tasks are handled by the ``REACTOR``, without a thread per task.
+
     Attributes:
         return_values (dict): Subclasses of ``Task`` should store all of their
             results in this field and document what the possible return values
             are.
     """
 
+    __slots__ = ('_rlock', '_status', 'return_values', '_done',
+                 '_done_callbacks', '_timeouts', '__weakref__')
+
+    _reports_done = False
+
+    # Protects the done state of all tasks, which is set from PyREM's I/O
+    # thread, which must not wait on a task's lock
+    _done_lock = Lock()
+
+    # Protects the creation of the locks of all tasks
+    _create_lock = Lock()
+
     def __init__(self):
-        self._lock = RLock()
+        self._rlock = None
         self._status = TaskStatus.IDLE
         self.return_values = {}
-
-    @synchronized
-    def start(self, wait=False):
+        self._done = False
+        self._done_callbacks = None
+        self._timeouts = None
+
+    @property
+    def _lock(self):
+        """The lock of the task, created the first time it is needed."""
+        lock = self._rlock
+        if lock is None:
+            with self._create_lock:
+                if self._rlock is None:
+                    self._rlock = RLock()
+                lock = self._rlock
+        return lock
+
+    def start(self, wait=False, timeout=None):
         """Start a task.
 
         This function depends on the underlying implementation of _start, which
@@ -89,17 +614,33 @@ class Task(object):
             wait (bool): Whether or not to wait on the task to finish before
                 returning from this function. Default `False`.
 
+            timeout (float): If given, the task is stopped if it is still
+                running **timeout** seconds after being started, and
+                ``return_values[\'timed_out\']`` is set to `True`. Default
+                `None`.
+
         Raises:
             RuntimeError: If the task has already been started without a
                 subsequent call to ``reset()``.
         """
-        if self._status is not TaskStatus.IDLE:
-            raise RuntimeError("Cannot start %s in state %s" %
-                               (self, self._status))
-        self._status = TaskStatus.STARTED
-        STARTED_TASKS.add(self)
-        self._start()
-
+        with self._lock:
+            if self._status is not TaskStatus.IDLE:
+                raise RuntimeError("Cannot start %s in state %s" %
+                                   (self, self._status))
+            tracer = TRACER
+            if tracer:
+                tracer.begin(self, 'run')
+                tracer.begin(self, 'start')
+            self._status = TaskStatus.STARTED
+            STARTED_TASKS.add(self)
+            self._start()
+            if timeout is not None:
+                self._set_timeout(timeout)
+            if tracer:
+                tracer.end(self, 'start')
+
+        # Don't hold the lock while waiting, so that another thread can still
+        # stop the task
         if wait:
             self.wait()
 
@@ -108,10 +649,15 @@ class Task(object):
     def _start(self):
         raise NotImplementedError
 
-    @synchronized
-    def wait(self):
+    def wait(self, timeout=None):
         """Wait on a task to finish and stop it when it has finished.
 
+        Args:
+            timeout (float): If given, the task is stopped if it is still
+                running after **timeout** seconds, and
+                ``return_values[\'timed_out\']`` is set to `True`. Default
+                `None`.
+
         Raises:
             RuntimeError: If the task hasn't been started or has already been
                 stopped.
@@ -119,38 +665,226 @@ class Task(object):
         Returns:
             The ``return_values`` of the task.
         """
-        if self._status is not TaskStatus.STARTED:
-            raise RuntimeError("Cannot wait on %s in state %s" %
-                               (self, self._status))
-        self._wait()
+        with self._lock:
+            if self._status is not TaskStatus.STARTED:
+                raise RuntimeError("Cannot wait on %s in state %s" %
+                                   (self, self._status))
+            if timeout is not None:
+                self._set_timeout(timeout)
+        # Don't hold the lock while waiting, so that another thread can still
+        # stop the task
+        self._wait_traced()
         self.stop()
         return self.return_values
 
+    def _wait_traced(self):
+        tracer = TRACER
+        if tracer:
+            tracer.begin(self, 'wait')
+        self._wait()
+        if tracer:
+            tracer.end(self, 'wait')
+
     def _wait(self):
         pass
 
+    def wait_ready(self, probe, timeout=None):
+        """Wait until a started task is ready, without waiting on it to finish.
+
+        Args:
+            probe (``pyrem.probe.Probe``): Tells when the task is ready, e.g.
+                ``OutputMatches('listening on')``.
+
+            timeout (float): The maximum number of seconds to wait, or `None`
+                to wait indefinitely. Default `None`.
+
+        Raises:
+            RuntimeError: If the task hasn't been started, or if it finishes
+                or is stopped before being ready.
+
+            TimeoutError: If the task isn't ready within **timeout** seconds.
+
+            Exception: Whatever the probe raised, if it fails.
+        """
+        if self._status is TaskStatus.IDLE:
+            raise RuntimeError("Cannot wait on %s to be ready in state %s" %
+                               (self, self._status))
+        ready = []
+        event = Event()
+        token = CancellationToken()
+
+        def became_ready(exception=None):
+            ready.append(exception)
+            event.set()
+
+        def finished(_task):
+            event.set()
+
+        probe.watch(self, token, became_ready)
+        self.add_done_callback(finished)
+        try:
+            if not event.wait(timeout):
+                raise TimeoutError("%s wasn't ready after %s seconds" %
+                                   (self, timeout))
+        finally:
+            token.cancel()
+            self.remove_done_callback(finished)
+        if not ready:
+            raise RuntimeError("%s finished before being ready" % self)
+        if ready[0] is not None:
+            raise ready[0]
+
+    def _set_timeout(self, delay):
+        """Stop the task, as timed out, if it is still running in **delay**
+        seconds. Must be called with the lock held, while the task is started.
+        """
+        if self._timeouts is None:
+            # Cancelled (along with its timers) when the task is stopped
+            self._timeouts = CancellationToken()
+        timer = REACTOR.call_later(max(0, delay), SCHEDULER.submit,
+                                   self._time_out, self._timeouts)
+        self._timeouts.add_callback(timer.cancel)
+
+    @synchronized
+    def _time_out(self, timeouts):
+        if timeouts.cancelled or self._status is not TaskStatus.STARTED:
+            return
+        if self._reports_done and self._done:
+            # It finished in time, it just hasn't been waited on yet
+            return
+        self.return_values['timed_out'] = True
+        # Finish stopping the task off the SCHEDULER thread running this
+        self.stop(wait=False)
+        self._when_stoppable(lambda: SCHEDULER.submit(self.wait_stopped))
+
     @synchronized
-    def stop(self):
+    def stop(self, wait=True):
         """Stop a task immediately.
 
+        Args:
+            wait (bool): Whether or not to wait on the task to be completely
+                stopped before returning from this function. If `False`,
+                ``wait_stopped()`` must be called later to finish stopping the
+                task, which allows several tasks to be stopped in parallel (see
+                ``stop_all()``). Default `True`.
+
         Raises:
-            RuntimeError: If the task hasn't been started or has already been
-                stopped.
+            RuntimeError: If the task hasn't been started.
         """
         if self._status is TaskStatus.STOPPED:
             return
 
-        if self._status is not TaskStatus.STARTED:
+        if self._status is TaskStatus.STARTED:
+            tracer = TRACER
+            if tracer:
+                tracer.begin(self, 'stop')
+            self._status = TaskStatus.STOPPING
+            if self._timeouts is not None:
+                self._timeouts.cancel()
+                self._timeouts = None
+            self._begin_stop()
+        elif self._status is not TaskStatus.STOPPING:
             raise RuntimeError("Cannot stop %s in state %s" %
                                (self, self._status))
+
+        if wait:
+            self.wait_stopped()
+
+    def _begin_stop(self):
         self._stop()
 
+    def _stop(self):
+        pass
+
+    @synchronized
+    def wait_stopped(self):
+        """Wait on a task which is being stopped to be completely stopped.
+
+        Raises:
+            RuntimeError: If ``stop()`` hasn't been called on the task.
+        """
+        if self._status is TaskStatus.STOPPED:
+            return
+
+        if self._status is not TaskStatus.STOPPING:
+            raise RuntimeError("Cannot wait on %s to stop in state %s" %
+                               (self, self._status))
+        self._wait_stopped()
+
         STARTED_TASKS.remove(self)
         self._status = TaskStatus.STOPPED
+        self._set_done()
+        tracer = TRACER
+        if tracer:
+            tracer.end(self, 'stop')
 
-    def _stop(self):
+    def _wait_stopped(self):
         pass
 
+    def _when_stoppable(self, func):
+        """Call ``func()`` once ``_wait_stopped()`` won't block, without
+        blocking, after ``_begin_stop()``.
+
+        **func** may be called from PyREM's I/O thread, so it should not
+        block. Tasks whose ``_wait_stopped()`` can block for long (e.g. on
+        processes exiting) should override this, so that they can be stopped
+        without holding up a thread of the ``SCHEDULER``.
+        """
+        func()
+
+    def done(self):
+        """Return whether the task has finished running or been stopped."""
+        return self._done
+
+    def add_done_callback(self, func):
+        """Call a function once the task has finished running or been stopped.
+
+        If the task is already done, the function is called immediately. The
+        function may be called from PyREM's I/O thread, so it should not block.
+        The callbacks are cleared when the task is reset.
+
+        Args:
+            func (function): Called with the task as its only argument.
+        """
+        with self._done_lock:
+            if not self._done:
+                if self._done_callbacks is None:
+                    self._done_callbacks = []
+                self._done_callbacks.append(func)
+                return
+        func(self)
+
+    def remove_done_callback(self, func):
+        """Remove a function added with ``add_done_callback()``.
+
+        Does nothing if the function was already called, or never added.
+        """
+        with self._done_lock:
+            callbacks = self._done_callbacks
+            if callbacks and func in callbacks:
+                callbacks.remove(func)
+                if not callbacks:
+                    self._done_callbacks = None
+
+    def _wait_done(self, timeout=None):
+        """Block until the task is done, returning whether it is."""
+        event = Event()
+        self.add_done_callback(lambda _task: event.set())
+        return event.wait(timeout)
+
+    def _set_done(self):
+        """Mark the task as done and run its done callbacks."""
+        with self._done_lock:
+            if self._done:
+                return
+            self._done = True
+            callbacks, self._done_callbacks = self._done_callbacks or [], None
+        tracer = TRACER
+        if tracer:
+            tracer.end(self, 'run')
+        for func in callbacks:
+            func(self)
+
     @synchronized
     def reset(self):
         """Reset a task.
@@ -163,24 +897,176 @@ class Task(object):
         if self._status is not TaskStatus.STOPPED:
             raise RuntimeError("Cannot reset %s in state %s" %
                                (self, self._status))
+        tracer = TRACER
+        if tracer:
+            tracer.begin(self, 'reset')
         self._reset()
         self.return_values = {}
+        with _WAITERS_LOCK:
+            _WAITERS.pop(self, None)
+        with self._done_lock:
+            self._done = False
+            self._done_callbacks = None
         self._status = TaskStatus.IDLE
+        if tracer:
+            tracer.end(self, 'reset')
 
     def _reset(self):
         pass
 
+    def _cache_key(self):
+        """Return a description of the work done by the task, or `None`.
+
+        Used by ``pyrem.cache`` to recognize tasks doing the same work. Tasks
+        which can be cached should return a hashable value built from
+        everything which determines what they do (e.g. their command and
+        host); tasks returning `None` can't be cached.
+        """
+        return None
+
     def __repr__(self):
-        # TODO: don't make the reprs so verbose, add a user defined name option?
         return "Task(status=%s, return_values=%s)" % (
-            self._status, self.return_values)
+            self._status, _REPR.repr(self.return_values))
+
+
+class _OutputStream(object):
+    """One output stream of a subprocess, as read by the ``REACTOR``."""
+    __slots__ = ('name', '_output', '_lines', '_partial', 'closed')
+
+    def __init__(self, name, output, max_lines):
+        self.name = name
+        self._output = output
+        self._lines = deque(maxlen=max_lines)
+        # Chunks of the last line, which hasn't ended yet
+        self._partial = []
+        self.closed = False
+
+    def feed(self, data):
+        """Handle a chunk of output, or EOF if **data** is empty."""
+        lines = []
+        if data:
+            pieces = data.split(b'\n')
+            if len(pieces) > 1:
+                self._partial.append(pieces[0])
+                lines.append(b''.join(self._partial) + b'\n')
+                lines.extend(piece + b'\n' for piece in pieces[1:-1])
+                self._partial = []
+            if pieces[-1]:
+                self._partial.append(pieces[-1])
+        elif self._partial:
+            lines.append(b''.join(self._partial))
+            self._partial = []
+        self._lines.extend(lines)
+        self._output.publish(self, lines, not data)
+
+    def value(self):
+        """Return the kept output as ``bytes``."""
+        lines = list(self._lines)
+        if self._partial:
+            lines.append(b''.join(self._partial))
+            if self._lines.maxlen is not None:
+                lines = lines[-self._lines.maxlen:]
+        return b''.join(lines)
+
+    def kept_lines(self):
+        return list(self._lines)
+
+
+class _Output(object):
+    """The stdout and stderr of a subprocess, and their consumers."""
+    __slots__ = ('_cond', '_callback', '_listeners', '_queues',
+                 '_closed_callbacks', 'stdout', 'stderr')
+
+    def __init__(self, max_lines, callback):
+        self._cond = Condition()
+        self._callback = callback
+        self._listeners = []
+        self._queues = []
+        self._closed_callbacks = []
+        self.stdout = _OutputStream('stdout', self, max_lines)
+        self.stderr = _OutputStream('stderr', self, max_lines)
+
+    def publish(self, stream, lines, closed):
+        """Pass new lines of a stream to the callbacks and iterators."""
+        if self._callback:
+            for line in lines:
+                self._callback(stream.name, line)
+        for func in list(self._listeners):
+            for line in lines:
+                func(stream.name, line)
+        with self._cond:
+            stream.closed = closed
+            done = self.stdout.closed and self.stderr.closed
+            for queue in self._queues:
+                queue.extend((stream.name, line) for line in lines)
+                if done:
+                    queue.append(None)
+            self._cond.notify_all()
+            callbacks = self._closed_callbacks if done else []
+        for func in callbacks:
+            func()
+
+    def add_listener(self, func):
+        """Call ``func(stream, line)`` with the lines kept so far, then with
+        every new line, until ``remove_listener()`` is called.
+        """
+        with self._cond:
+            self._listeners.append(func)
+            kept = [(stream.name, line) for stream in [self.stdout, self.stderr]
+                    for line in stream.kept_lines()]
+        for name, line in kept:
+            func(name, line)
+
+    def remove_listener(self, func):
+        with self._cond:
+            if func in self._listeners:
+                self._listeners.remove(func)
+
+    def when_closed(self, func):
+        """Call a function once both streams have reached EOF."""
+        with self._cond:
+            if not (self.stdout.closed and self.stderr.closed):
+                self._closed_callbacks.append(func)
+                return
+        func()
+
+    def wait_closed(self):
+        """Wait for both streams to reach EOF."""
+        with self._cond:
+            while not (self.stdout.closed and self.stderr.closed):
+                self._cond.wait()
+
+    def iter_lines(self):
+        """Generator of ``(stream, line)`` tuples until both streams close."""
+        with self._cond:
+            queue = deque()
+            for stream in [self.stdout, self.stderr]:
+                queue.extend((stream.name, line)
+                             for line in stream.kept_lines())
+            if self.stdout.closed and self.stderr.closed:
+                queue.append(None)
+            else:
+                self._queues.append(queue)
+
+        while True:
+            with self._cond:
+                while not queue:
+                    self._cond.wait()
+                item = queue.popleft()
+            if item is None:
+                return
+            yield item
 
 
-# TODO: option for sending output to file
 class SubprocessTask(Task):
     """A task to run a command as a subprocess on the local host.
 
-    This process will be killed when this task is stopped.
+    The subprocess runs in a process group of its own, keeping the controlling
+    terminal (so that e.g. ssh can still prompt for a password). When this
+    task is stopped, every process in the group (the subprocess, and the
+    processes it started which haven't left the group) is sent SIGTERM, and
+    those still running after **grace_period** seconds are sent SIGKILL. This
+    also happens to the processes left behind by a subprocess which finished.
     The return code of the process will be stored in
     ``return_values[\'retcode\']``.
 
@@ -206,57 +1092,205 @@ class SubprocessTask(Task):
         require_success (bool): If `True` and if this task is waited on instead
             of being stopped, raises a ``RuntimeError`` if the subprocess has
             a return code other than `0`. Default `False`.
+
+        output_callback (function): If given, called as
+            ``output_callback(stream, line)`` with each line of output while
+            the subprocess runs, where **stream** is ``'stdout'`` or
+            ``'stderr'`` and **line** is a ``bytes`` ending in a newline
+            (except possibly the last line). The callback is run on PyREM's
+            I/O thread, so it should not block. Default `None`.
+
+        max_output_lines (int): If given with **return_output**, only the last
+            **max_output_lines** lines of each stream are kept in
+            ``return_values``, so that the memory used doesn't grow with the
+            output of the subprocess. Default `None`.
+
+        sampler (``pyrem.sampler.Sampler``): If given, the resources used by
+            the subprocess and its descendants are sampled while it runs, and
+            stored in ``return_values[\'resources\']`` when the task is waited
+            on or stopped. Default `None`.
+
+        log (``pyrem.logs.LogMultiplexer``): If given, the output of the
+            subprocess is written to a log file rather than printed, and the
+            path of the file is stored in ``return_values[\'log\']``. Default
+            `None`.
+
+        grace_period (float): Seconds given to the processes of the command to
+            exit after SIGTERM when the task is stopped, before they are
+            killed. Default `1`.
+
+    The output of a command run with **return_output**, **output_callback**
+    or **log** is read as it is produced, by a single thread shared by all
+    tasks, and can also be consumed while the task is running with
+    ``iter_output()``.
     """
+    __slots__ = ('_command', '_quiet', '_require_success', '_return_output',
+                 '_output_callback', '_max_output_lines', '_sampler', '_log',
+                 '_grace_period', '_popen_kwargs', '_process', '_output',
+                 '_kill_deadline')
+
     _DEVNULL = open(os.devnull, 'w')
+    _reports_done = True
 
-    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
     def __init__(self, command, quiet=False, return_output=False, shell=False,
-                 require_success=False):
+                 require_success=False, output_callback=None,
+                 max_output_lines=None, sampler=None, log=None,
+                 grace_period=1.0):
         super(SubprocessTask, self).__init__()
-        assert isinstance(command, list)
-        self._command = [str(c) for c in command]
+        assert isinstance(command, (list, tuple))
+        command = tuple(str(c) for c in command)
+        self._command = ' '.join(command) if shell else command
+        self._quiet = quiet
         self._require_success = require_success
+        self._return_output = return_output
+        self._output_callback = output_callback
+        self._max_output_lines = max_output_lines
+        self._sampler = sampler
+        self._log = log
+        self._grace_period = grace_period
+        self._popen_kwargs = self._shared_popen_kwargs(
+            shell, bool(return_output or output_callback or log), quiet)
+        self._process = None
+        self._output = None
+        self._kill_deadline = None
 
-        self._popen_kwargs = {}
-        self._popen_kwargs['stdin'] = self._DEVNULL
-        if shell:
-            self._popen_kwargs['shell'] = True
-            self._command = ' '.join(self._command)
-        if return_output:
-            self._popen_kwargs['stdout'] = PIPE
-            self._popen_kwargs['stderr'] = PIPE
-        elif quiet:
-            self._popen_kwargs['stdout'] = self._DEVNULL
-            self._popen_kwargs['stderr'] = self._DEVNULL
+    @classmethod
+    def _shared_popen_kwargs(cls, shell, pipe, quiet):
+        """Return the keyword arguments of ``Popen``, shared between tasks.
 
-        self._process = None
+        The returned dict must not be modified.
+        """
+        key = ('popen_kwargs', shell, pipe, quiet and not pipe)
+        kwargs = _SHARED.get(key)
+        if kwargs is None:
+            kwargs = dict(_NEW_PROCESS_GROUP, stdin=cls._DEVNULL)
+            if shell:
+                kwargs['shell'] = True
+            if pipe:
+                kwargs['stdout'] = kwargs['stderr'] = PIPE
+            elif quiet:
+                kwargs['stdout'] = kwargs['stderr'] = cls._DEVNULL
+            kwargs = _SHARED.setdefault(key, kwargs)
+        return kwargs
 
     def _start(self):
         self._process = Popen(self._command, **self._popen_kwargs)
+        if self._popen_kwargs.get('stdout') is PIPE:
+            max_lines = self._max_output_lines if self._return_output else 0
+            self._output = _Output(max_lines, self._output_callback)
+            if self._log:
+                self._log.attach(self)
+            REACTOR.add_reader(self._process.stdout,
+                               self._output.stdout.feed)
+            REACTOR.add_reader(self._process.stderr,
+                               self._output.stderr.feed)
+        REACTOR.add_process(self._process, self._process_exited)
+        if self._sampler:
+            self._sampler.add(self)
+
+    def _collect_samples(self):
+        if self._sampler:
+            samples = self._sampler.remove(self)
+            if samples is not None:
+                self.return_values['resources'] = samples
+
+    def _process_exited(self):
+        if self._output:
+            self._output.when_closed(self._set_done)
+        else:
+            self._set_done()
+
+    def iter_output(self):
+        """Iterate over the output of the task while it is running.
+
+        Yields the lines of output of the subprocess as ``(stream, line)``
+        tuples, like the arguments of **output_callback**, until the
+        subprocess has closed its output. Lines produced before the iteration
+        started are yielded first, as far as they are still kept in memory
+        (see **max_output_lines**). The task must have been started, with
+        **return_output** or **output_callback** set. With only
+        **output_callback**, no lines are kept, so the lines read before the
+        iteration started are lost to it (they only went to the callback).
+
+        Lines are queued for the iterator until they are consumed, so the
+        iterator should be consumed as fast as the output is produced.
+        """
+        if self._output is None:
+            raise RuntimeError("The output of %s isn't being read" % self)
+        return self._output.iter_lines()
 
     def _wait(self):
         # Wait for process to finish
-        output = self._process.communicate()
+        self._process.wait()
+        if self._output:
+            self._output.wait_closed()
+        self._collect_samples()
         # Raise error if necessary
-        retcode = self._process.returncode
+        # The return code is kept even on failure, e.g. for pyrem.retry
+        retcode = self.return_values['retcode'] = self._process.returncode
         if self._require_success and retcode:
             raise RuntimeError("Return code should have been 0, was %s" %
                                retcode)
-        # Put return code and output in return_values
-        self.return_values['stdout'] = output[0]
-        self.return_values['stderr'] = output[1]
-        self.return_values['retcode'] = retcode
+        # Put output in return_values
+        if self._return_output:
+            self.return_values['stdout'] = self._output.stdout.value()
+            self.return_values['stderr'] = self._output.stderr.value()
+        else:
+            self.return_values['stdout'] = None
+            self.return_values['stderr'] = None
 
     def _stop(self):
-        if self._process.returncode is None:
-            self._process.terminate()
-            self._process.kill()
+        self._collect_samples()
+        self._signal_group(signal.SIGTERM)
+        self._kill_deadline = time.monotonic() + self._grace_period
+
+    def _group_stopped(self):
+        """Return whether the process group is gone, killing it if it is
+        still there after the grace period.
+        """
+        # Reap the subprocess, so that it doesn't count as running
+        self._process.poll()
+        if not self._signal_group(0):
+            return True
+        if time.monotonic() >= self._kill_deadline:
+            self._signal_group(signal.SIGKILL)
+            return True
+        return False
+
+    def _wait_stopped(self):
+        while not self._group_stopped():
+            time.sleep(0.05)
+        self._process.wait()
+
+    def _when_stoppable(self, func):
+        def poll():
+            if self._group_stopped():
+                func()
+            else:
+                REACTOR.call_later(0.05, poll)
+        poll()
+
+    def _signal_group(self, sig):
+        """Send a signal to the process group of the subprocess.
+
+        Returns:
+            bool: Whether there were processes left in the group.
+        """
+        try:
+            os.killpg(self._process.pid, sig)
+        except OSError:
+            return False
+        return True
+
+    def _cache_key(self):
+        return ('SubprocessTask', _without_transport(self._command))
 
     def __repr__(self):
         return ("SubprocessTask(status=%s, return_values=%s, command=%s, "
                 "popen_kwargs=%s)" % (
-                    self._status, self.return_values, self._command,
-                    self._popen_kwargs))
+                    self._status, _REPR.repr(self.return_values),
+                    _REPR.repr(self._command), self._popen_kwargs))
 
 
 # TODO: option for sending remote output to remote file
@@ -264,13 +1298,18 @@ class RemoteTask(SubprocessTask):
     """A task to run a command on a remote host over ssh.
 
     Any processes started on the remote host will be killed when this task is
-    stopped (unless `kill_remote=False` is specified).
+    stopped (unless `kill_remote=False` is specified): the command is run
+    with ``setsid``, in a session and process group of its own, and the whole
+    group is sent SIGTERM, then SIGKILL after **grace_period** seconds, like
+    the local processes of a ``SubprocessTask``. The remote host needs
+    ``setsid`` (part of util-linux).
 
-    ``return_values[\'retcode\']`` will contain the return code of the ssh
-    command, which should currently be ignored.
+    ``return_values[\'retcode\']`` will contain the return code of the remote
+    command (as long as `kill_remote=True`, otherwise that of the ssh command),
+    or `255` if ssh itself failed.
 
     Attributes:
-        host (str): The name of the host the task will run on.
+        host (str): The name of the host the task will run on. Read-only.
 
     Args:
         host (str): The host to run on.
@@ -286,70 +1325,370 @@ class RemoteTask(SubprocessTask):
 
         identity_file (str): Path to identity file passed to ssh. Default
             `None`.
+
+        ssh_options (list of str): Extra command-line options passed to ssh,
+            both for running the command and for killing the remote
+            processes. ``RemoteHost`` uses these to share a single ssh
+            connection between its tasks. Default `None`.
+
+        output_callback (function): See ``SubprocessTask``.
+
+        max_output_lines (int): See ``SubprocessTask``.
+
+        require_success (bool): See ``SubprocessTask``. Default `False`.
+
+        sampler (``pyrem.sampler.Sampler``): See ``SubprocessTask``. The
+            remote processes are found through the PIDs logged for
+            **kill_remote**, which must be `True`. Default `None`.
+
+        log (``pyrem.logs.LogMultiplexer``): See ``SubprocessTask``. Default
+            `None`.
+
+        grace_period (float): See ``SubprocessTask``. Applies to both the
+            local ssh command and the remote processes. Default `1`.
     """
+    __slots__ = ('_host', '_identity_file', '_ssh_cmd', '_remote_command',
+                 '_kill_remote', '_kill_command', '_tmp_file_name')
+
+    # pylint: disable=too-many-arguments
     def __init__(self, host, command, quiet=False, return_output=False,
-                 kill_remote=True, identity_file=None):
+                 kill_remote=True, identity_file=None, ssh_options=None,
+                 output_callback=None, max_output_lines=None,
+                 require_success=False, sampler=None, log=None,
+                 grace_period=1.0):
         assert isinstance(command, list)
-        self.host = host # TODO: disallow changing this attribute
+        if sampler and not kill_remote:
+            raise ValueError("Sampling a RemoteTask requires kill_remote")
+        self._host = host
 
         # Expand the path to the identity file
         if identity_file:
             identity_file = os.path.expanduser(identity_file)
         self._identity_file = identity_file
 
-        # Log the other args
-        self._remote_command = list(command)
-        self._quiet = quiet
-        self._return_output = return_output
+        # Base ssh command, shared by the task itself and the kill command,
+        # and by all of the tasks with the same options
+        ssh_cmd = ('ssh',)
+        if identity_file:
+            ssh_cmd += ('-i', identity_file)
+        self._ssh_cmd = _shared(ssh_cmd + tuple(ssh_options or ()))
+
+        self._remote_command = tuple(command)
         self._kill_remote = kill_remote
+        self._kill_command = None
+        self._tmp_file_name = None
 
         # If kill remote, add the PID logging script to the command
-        self._kill_remote = kill_remote
         if kill_remote:
             # Temp file holds the PIDs of processes started on remote host
-            self._tmp_file_name = '/tmp/pyrem_procs-' + ''.join(
-                random.SystemRandom().choice(
-                    string.ascii_lowercase + string.digits)
-                for _ in range(8))
-            # TODO: Ending the user's command with ' & jobs ...' might not be
-            #       safe. If the command ends in a &, for instance, this will
-            #       just fail on the spot. Try to figure out a good way around
-            #       this, but at least warn the user in RemoteTask's docstring\
-
-            # TODO: handle shells like zsh where the -p flag doesn't just print
-            #       out the PIDs
-            command.append(' & jobs -p >%s ; wait' % self._tmp_file_name)
+            self._tmp_file_name = self._new_tmp_file_name()
+            command = self._log_pids(command, self._tmp_file_name)
 
-        if identity_file:
-            ssh_cmd = ['ssh', '-i', identity_file, host, ' '.join(command)]
-        else:
-            ssh_cmd = ['ssh', host, ' '.join(command)]
+        ssh_cmd = self._ssh_cmd + (host, ' '.join(command))
 
         super(RemoteTask, self).__init__(ssh_cmd,
                                          quiet=quiet,
                                          return_output=return_output,
-                                         shell=False)
-
-    # TODO: capture the return code of the remote command
-
-    def _stop(self):
+                                         shell=False,
+                                         require_success=require_success,
+                                         output_callback=output_callback,
+                                         max_output_lines=max_output_lines,
+                                         sampler=sampler,
+                                         log=log,
+                                         grace_period=grace_period)
+
+    @property
+    def host(self):
+        return self._host
+
+    @property
+    def _ssh_options(self):
+        """The extra options passed to ssh."""
+        return list(self._ssh_cmd[3 if self._identity_file else 1:])
+
+    @staticmethod
+    def _new_tmp_file_name():
+        """Generate the name of a remote temp file for a task's PIDs."""
+        return '/tmp/pyrem_procs-' + ''.join(
+            random.SystemRandom().choice(
+                string.ascii_lowercase + string.digits)
+            for _ in range(8))
+
+    @staticmethod
+    def _log_pids(command, tmp_file_name):
+        """Run a remote command in its own session, logging its PGID."""
+        # The shell started by setsid leads the new session and process
+        # group, so its PID is the group's ID. Waiting on the job explicitly
+        # makes its exit status that of the remote shell, and therefore of
+        # ssh
+        script = 'echo $$ >%s ; %s' % (tmp_file_name, ' '.join(command))
+        return ['setsid', '${SHELL:-sh}', '-c', shlex.quote(script),
+                '& wait $!']
+
+    def _begin_stop(self):
         # First, stop the ssh command
-        super(RemoteTask, self)._stop()
+        super(RemoteTask, self)._begin_stop()
 
-        # Silence the kill_proc to prevent messages about already killed procs
         if self._kill_remote:
-            kill_proc = Popen(
-                ['ssh', self.host, 'kill -9 `cat %s` ; rm %s' %
-                 (self._tmp_file_name, self._tmp_file_name)],
-                stdout=self._DEVNULL, stderr=self._DEVNULL, stdin=self._DEVNULL)
-            kill_proc.wait()
+            self._kill_command = _RemoteKill.schedule(
+                self._ssh_cmd + (self._host,), self._tmp_file_name,
+                self._grace_period)
+
+    def _wait_stopped(self):
+        if self._kill_remote:
+            self._kill_command.wait()
+            self._kill_command = None
+        super(RemoteTask, self)._wait_stopped()
+
+    def _when_stoppable(self, func):
+        stoppable = lambda: super(RemoteTask, self)._when_stoppable(func)
+        kill = self._kill_command
+        if self._kill_remote and kill is not None:
+            kill.add_done_callback(stoppable)
+        else:
+            stoppable()
 
+    def _cache_key(self):
+        return ('RemoteTask', self._host, self._remote_command)
 
     def __repr__(self):
-        return ("RemoteTask(status=%s, return_values=%s, command=%s, "
-                "popen_kwargs=%s)" % (
-                    self._status, self.return_values, self._command,
-                    self._popen_kwargs))
+        return "RemoteTask(status=%s, return_values=%s, host=%s, command=%s)" % (
+            self._status, _REPR.repr(self.return_values), self._host,
+            _REPR.repr(self._remote_command))
+
+
+class _RemoteKill(object):
+    """A command killing the processes of ``RemoteTask``s on a single host.
+
+    ``RemoteTask``s being stopped add their PID files, which hold the IDs of
+    the process groups of their commands, to the pending command for their
+    host and grace period. The first task to wait on its command runs all of
+    the pending commands, so that the remote processes of every task being
+    stopped are killed with one ssh command per host, and all hosts at once.
+    """
+    _pending = {}
+    _pending_lock = Lock()
+
+    def __init__(self, ssh_cmd, grace_period):
+        self._ssh_cmd = ssh_cmd
+        self._grace_period = grace_period
+        self._tmp_file_names = []
+        self._lock = Lock()
+        self._process = None
+        self._callbacks = []
+
+    @classmethod
+    def schedule(cls, ssh_cmd, tmp_file_name, grace_period=0):
+        """Add a PID file to the pending kill command for the ssh command.
+
+        Returns:
+            ``_RemoteKill``: The command which will kill the processes.
+        """
+        key = (tuple(ssh_cmd), grace_period)
+        with cls._pending_lock:
+            kill = cls._pending.get(key)
+            if kill is None:
+                kill = cls._pending[key] = cls(ssh_cmd, grace_period)
+            kill._tmp_file_names.append(tmp_file_name) # pylint: disable=W0212
+        return kill
+
+    @staticmethod
+    def command(tmp_file_names, grace_period=0):
+        """Return the remote command killing the process groups in PID files.
+
+        The groups are sent SIGTERM, and SIGKILL once they have all exited or
+        **grace_period** seconds have passed.
+        """
+        files = ' '.join(tmp_file_names)
+        return ('g=`cat %s` ; rm -f %s ; '
+                'for p in $g ; do kill -TERM -$p ; done ; i=0 ; '
+                'for p in $g ; do while [ $i -lt %d ] && kill -0 -$p ; do '
+                'sleep 0.1 ; i=$((i+1)) ; done ; done ; '
+                'for p in $g ; do kill -KILL -$p ; done' % (
+                    files, files, math.ceil(grace_period / 0.1)))
+
+    @classmethod
+    def run_pending(cls):
+        """Start all pending kill commands."""
+        with cls._pending_lock:
+            pending = list(cls._pending.values())
+            cls._pending.clear()
+        for kill in pending:
+            kill.run()
+
+    def run(self):
+        """Start this kill command, if it hasn't been started already."""
+        with self._lock:
+            if self._process is None:
+                # Silence the command to prevent messages about already killed
+                # procs
+                self._process = Popen(
+                    list(self._ssh_cmd) + [self.command(self._tmp_file_names,
+                                                        self._grace_period)],
+                    stdout=SubprocessTask._DEVNULL,
+                    stderr=SubprocessTask._DEVNULL,
+                    stdin=SubprocessTask._DEVNULL)
+
+    def wait(self):
+        """Run all pending kill commands and wait on this one to finish."""
+        self.run_pending()
+        self.run()
+        self._process.wait()
+
+    def add_done_callback(self, func):
+        """Run all pending kill commands, and call ``func()`` once this one
+        has finished (or now). **func** may be called from PyREM's I/O
+        thread.
+        """
+        self.run_pending()
+        self.run()
+        with self._lock:
+            if self._callbacks is not None:
+                self._callbacks.append(func)
+                if len(self._callbacks) == 1:
+                    REACTOR.add_process(self._process, self._finished)
+                return
+        func()
+
+    def _finished(self):
+        self._process.poll()
+        with self._lock:
+            callbacks, self._callbacks = self._callbacks, None
+        for func in callbacks:
+            func()
+
+
+class _Demultiplexer(object):
+    """Splits the output of an ``_AggregatedRemoteTask`` by command.
+
+    The aggregated script prints, for each command, a header line
+    ``<index> <retcode> <stdout length> <stderr length>`` followed by exactly
+    that many bytes of stdout and stderr.
+    """
+    def __init__(self):
+        self.results = {}
+        self._buffer = bytearray()
+        self._header = None
+
+    def feed(self, data):
+        """Handle a chunk of the aggregated stdout."""
+        self._buffer += data
+        while True:
+            if self._header is None:
+                end = self._buffer.find(b'\n')
+                if end < 0:
+                    return
+                self._header = [int(f) for f in self._buffer[:end].split()]
+                del self._buffer[:end + 1]
+            index, retcode, out_len, err_len = self._header
+            if len(self._buffer) < out_len + err_len:
+                return
+            self.results[index] = (retcode,
+                                   bytes(self._buffer[:out_len]),
+                                   bytes(self._buffer[out_len:
+                                                      out_len + err_len]))
+            del self._buffer[:out_len + err_len]
+            self._header = None
+
+
+class _AggregatedRemoteTask(RemoteTask):
+    """Runs several ``RemoteTask``s on the same host in one ssh session.
+
+    Each command runs in the background on the remote host, with its output
+    redirected to remote temp files. Once they have all finished, the output
+    and return code of each command is sent back in its own framed section, so
+    that it can be put in the ``return_values`` of the original task. The
+    original tasks are never started themselves.
+
+    The original tasks must all have the same host, ssh command and
+    **kill_remote**, and must not have an **output_callback**, **log** or
+    **sampler**.
+    """
+    __slots__ = ('_tasks', '_demux')
+
+    def __init__(self, tasks):
+        # pylint: disable=W0212
+        t0 = tasks[0] # pylint: disable=C0103
+        tmp_file_name = self._new_tmp_file_name() if t0._kill_remote else None
+        script = self._script([' '.join(t._remote_command) for t in tasks],
+                              tmp_file_name)
+        super(_AggregatedRemoteTask, self).__init__(
+            t0.host, [script], kill_remote=False,
+            identity_file=t0._identity_file, ssh_options=t0._ssh_options,
+            output_callback=self._handle_output,
+            grace_period=t0._grace_period)
+        # The script logs the PIDs of the commands itself
+        self._kill_remote = t0._kill_remote
+        self._tmp_file_name = tmp_file_name
+        self._tasks = tasks
+        self._demux = _Demultiplexer()
+
+    @staticmethod
+    def _script(commands, tmp_file_name):
+        """Return the remote script running the commands."""
+        indices = range(len(commands))
+        lines = ['d=`mktemp -d /tmp/pyrem_agg-XXXXXXXX` || exit 255']
+        for i, command in enumerate(commands):
+            if tmp_file_name:
+                # Each command leads a process group, see RemoteTask._log_pids
+                command = 'setsid ${SHELL:-sh} -c %s' % shlex.quote(
+                    'echo $$ >>%s\n%s\n' % (tmp_file_name, command))
+            else:
+                command = '(%s\n)' % command
+            lines.append('%s </dev/null >$d/%d.out 2>$d/%d.err & p%d=$!' %
+                         (command, i, i, i))
+        for i in indices:
+            lines.append('wait $p%d ; echo $? >$d/%d.rc' % (i, i))
+        lines.append('for i in %s ; do' % ' '.join(str(i) for i in indices))
+        lines.append('printf "%s %s %s %s\\n" $i `cat $d/$i.rc` '
+                     '`wc -c <$d/$i.out` `wc -c <$d/$i.err`')
+        lines.append('cat $d/$i.out $d/$i.err')
+        lines.append('done')
+        lines.append('rm -rf $d')
+        return '\n'.join(lines)
+
+    def _handle_output(self, stream, line):
+        if stream == 'stdout':
+            self._demux.feed(line)
+        else:
+            # Errors of ssh or of the script itself
+            sys.stderr.write(line.decode(errors='replace'))
+
+    def _wait(self):
+        # pylint: disable=W0212
+        super(_AggregatedRemoteTask, self)._wait()
+        failed = None
+        for i, task in enumerate(self._tasks):
+            # Commands without results were lost with the ssh session
+            retcode, stdout, stderr = self._demux.results.get(
+                i, (self.return_values['retcode'], b'', b''))
+            if task._max_output_lines is not None:
+                stdout, stderr = [
+                    b''.join(value.splitlines(True)[-task._max_output_lines:])
+                    for value in [stdout, stderr]]
+            if task._return_output:
+                task.return_values['stdout'] = stdout
+                task.return_values['stderr'] = stderr
+            else:
+                task.return_values['stdout'] = None
+                task.return_values['stderr'] = None
+                if not task._quiet:
+                    sys.stdout.write(stdout.decode(errors='replace'))
+                    sys.stderr.write(stderr.decode(errors='replace'))
+            task.return_values['retcode'] = retcode
+            if task._require_success and retcode and failed is None:
+                failed = retcode
+        if failed is not None:
+            raise RuntimeError("Return code should have been 0, was %s" %
+                               failed)
+
+    def _reset(self):
+        self._demux = _Demultiplexer()
+
+    def __repr__(self):
+        return ("_AggregatedRemoteTask(status=%s, return_values=%s, "
+                "tasks=%s)" % (self._status, _REPR.repr(self.return_values),
+                               len(self._tasks)))
 
 
 class Parallel(Task):
@@ -368,16 +1707,70 @@ class Parallel(Task):
             host A and 3 of which are running on host B, aggregate will combine
             them into 2 tasks: one for host A and one for host B.
 
-            Warning: The combined task will get its other options (``quiet``,
-            ``kill_remote``, etc.) from one of the constituent commands. If you
-            want to ensure the remote processes are killed, ensure that
-            ``kill_remote`` is `True` for all processes on that host. If you
-            rely on returned output for some of the commands, don't use
-            aggregate (output will get mixed between all commands).
+            The output and return code of each command are kept apart, and
+            are put in the ``return_values`` of the original ``RemoteTask``
+            once the combined task has finished. Output that isn't returned
+            is printed at that point, rather than as it is produced. Only
+            tasks with the same ssh options, ``kill_remote`` and
+            ``grace_period`` are combined, and tasks with an
+            ``output_callback``, a ``log`` or a ``sampler`` are never
+            combined.
+
+        max_concurrency (int): The maximum number of tasks running at once.
+            The remaining tasks are queued and started, in order, as running
+            tasks finish. If `None`, all tasks are started at once. Default
+            `None`.
+
+        max_per_host (int): The maximum number of tasks running at once on
+            any one host, where tasks are grouped by their ``host`` attribute
+            (e.g. ``RemoteTask.host``). Tasks without a ``host`` are only
+            limited by **max_concurrency**. If `None`, there is no per-host
+            limit. Default `None`.
+
+            Running tasks are waited on by the shared ``SCHEDULER`` as they
+            finish, rather than by a thread each. When a task fails, no more
+            queued tasks are started. With a per-host limit, queued tasks are
+            started in order on each host, and in turn across hosts.
+
+        fail_fast (bool): If `True`, all of the other running tasks are
+            stopped as soon as a task fails, and waiting on this task raises
+            the exception of the failed task once they have been stopped.
+            Otherwise, the running tasks are left to finish on their own.
+            Default `False`.
+
+        deadline (float): A time, as returned by ``time.time()``, by which
+            all of the tasks must have finished. If this task is still running
+            at that time, it is stopped (and with it, all of the tasks), and
+            ``return_values[\'timed_out\']`` is set to `True`. Default `None`.
     """
-    def __init__(self, tasks, aggregate=False):
+    __slots__ = ('_tasks', '_max_concurrency', '_max_per_host', '_fail_fast',
+                 '_deadline', '_queue_cond', '_host_queues', '_ready_hosts',
+                 '_num_queued', '_host_counts', '_num_running', '_exception',
+                 '_token')
+
+    _reports_done = True
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, tasks, aggregate=False, max_concurrency=None,
+                 max_per_host=None, fail_fast=False, deadline=None):
         super(Parallel, self).__init__()
         self._tasks = tasks
+        self._max_concurrency = max_concurrency
+        self._max_per_host = max_per_host
+        self._fail_fast = fail_fast
+        self._deadline = deadline
+
+        # State of the ready queues: the queued tasks of each host (all under
+        # None without a per-host limit), and the hosts which have both queued
+        # tasks and spare slots, in the order they get to start their next one
+        self._queue_cond = Condition()
+        self._host_queues = {}
+        self._ready_hosts = deque()
+        self._num_queued = 0
+        self._host_counts = defaultdict(int)
+        self._num_running = 0
+        self._exception = None
+        self._token = None
 
         if aggregate:
             self._aggregate()
@@ -385,54 +1778,179 @@ class Parallel(Task):
     def _aggregate(self):
         """Helper method to aggregate RemoteTasks into single ssh session."""
         # pylint: disable=W0212
-        nonremote = [t for t in self._tasks if not isinstance(t, RemoteTask)]
-        remote = [t for t in self._tasks if isinstance(t, RemoteTask)]
-
-        host_dict = defaultdict(list)
-        for task in remote:
-            host_dict[task.host].append(task)
-
-        aggregated = []
-        for task_group in host_dict.values():
-            # Build up combined command
-            combined_cmd = []
-            for task in task_group:
-                if combined_cmd:
-                    combined_cmd.append('&')
-                combined_cmd.append(' '.join(task._remote_command))
-
-            # Now, generated aggregate task
-            t0 = task_group[0] # pylint: disable=C0103
-            task = RemoteTask(
-                t0.host, combined_cmd, t0._quiet, t0._return_output,
-                t0._kill_remote, t0._identity_file)
-
-            aggregated.append(task)
-
-        self._tasks = nonremote + aggregated
+        groups = defaultdict(list)
+        order = []
+        for task in self._tasks:
+            if (type(task) is RemoteTask and # pylint: disable=C0123
+                    task._output_callback is None and task._log is None and
+                    task._sampler is None):
+                key = (task.host, tuple(task._ssh_cmd), task._kill_remote,
+                       task._grace_period)
+                if key not in groups:
+                    order.append(key)
+                groups[key].append(task)
+            else:
+                order.append(task)
+
+        self._tasks = []
+        for item in order:
+            if isinstance(item, Task):
+                self._tasks.append(item)
+            elif len(groups[item]) == 1:
+                self._tasks.append(groups[item][0])
+            else:
+                self._tasks.append(_AggregatedRemoteTask(groups[item]))
 
     def _start(self):
-        for task in self._tasks:
-            task.start(wait=False)
+        if self._deadline is not None:
+            self._set_timeout(self._deadline - time.time())
+        with self._queue_cond:
+            self._token = CancellationToken()
+            self._clear_queues()
+            for task in self._tasks:
+                host = self._host_of(task)
+                if host not in self._host_queues:
+                    self._host_queues[host] = deque()
+                    self._ready_hosts.append(host)
+                self._host_queues[host].append(task)
+            self._num_queued = len(self._tasks)
+            self._host_counts.clear()
+            self._num_running = 0
+            self._exception = None
+        self._start_queued(self._token)
+
+        # Without limits, all of the tasks are started right away, so report
+        # a failure to start one of them immediately
+        if self._exception and not self._is_limited():
+            _reraise(self._exception)
+
+    def _is_limited(self):
+        return (self._max_concurrency is not None or
+                self._max_per_host is not None)
+
+    def _host_of(self, task):
+        """The host whose limit a task counts against, or `None`."""
+        if self._max_per_host is None:
+            return None
+        return getattr(task, 'host', None)
+
+    def _has_spare_slot(self, host):
+        """Must be called with ``self._queue_cond`` held."""
+        return (host is None or
+                self._host_counts[host] < self._max_per_host)
+
+    def _clear_queues(self):
+        """Must be called with ``self._queue_cond`` held."""
+        self._host_queues.clear()
+        self._ready_hosts.clear()
+        self._num_queued = 0
+
+    def _start_queued(self, token):
+        """Start as many queued tasks as the limits allow."""
+        started = []
+        with self._queue_cond:
+            while self._ready_hosts and not token.cancelled:
+                if (self._max_concurrency is not None and
+                        self._num_running >= self._max_concurrency):
+                    break
+                host = self._ready_hosts.popleft()
+                queue = self._host_queues[host]
+                task = queue.popleft()
+                self._num_queued -= 1
+                # Start the task while holding the lock so that _begin_stop
+                # never misses a task that is about to start
+                try:
+                    task.start()
+                except: # pylint: disable=W0702
+                    self._fail(sys.exc_info())
+                    break
+                self._num_running += 1
+                self._host_counts[host] += 1
+                if queue and self._has_spare_slot(host):
+                    self._ready_hosts.append(host)
+                started.append(task)
+            done = not (self._num_running or self._num_queued)
+            failed = self._exception is not None and not token.cancelled
+            self._queue_cond.notify_all()
+
+        for task in started:
+            _on_finish(task, self._task_finished, token)
+        if failed and self._fail_fast:
+            _stop_started(self._tasks)
+        if done:
+            self._set_done()
+
+    def _task_finished(self, task, token):
+        try:
+            _wait_finished(task)
+        except: # pylint: disable=W0702
+            with self._queue_cond:
+                if not token.cancelled:
+                    self._fail(sys.exc_info())
+        with self._queue_cond:
+            if token is not self._token:
+                return
+            host = self._host_of(task)
+            self._num_running -= 1
+            self._host_counts[host] -= 1
+            # A host which was full, with tasks left, is ready again
+            if (host is not None and self._host_queues.get(host) and
+                    self._host_counts[host] == self._max_per_host - 1):
+                self._ready_hosts.append(host)
+        self._start_queued(token)
+
+    def _fail(self, exc_info):
+        """Record the first exception and stop starting queued tasks.
+
+        Must be called with ``self._queue_cond`` held.
+        """
+        if self._exception is None:
+            self._exception = exc_info
+        self._clear_queues()
+        self._queue_cond.notify_all()
 
     def _wait(self):
         # TODO: capture the return_values of the tasks
-        for task in self._tasks:
-            task.wait()
+        with self._queue_cond:
+            while ((self._num_running or self._num_queued) and
+                   self._exception is None):
+                self._queue_cond.wait()
+            exception = self._exception
+        if exception:
+            if self._fail_fast:
+                _stop_started(self._tasks)
+            _reraise(exception)
+
+    def _begin_stop(self):
+        with self._queue_cond:
+            self._token.cancel()
+            self._clear_queues()
+            self._queue_cond.notify_all()
 
-    def _stop(self):
-        # TODO: this isn't quite right if there was an exception during _start
-        # there needs to be some way to kill only the tasks that were started
+        # pylint: disable=W0212
         for task in self._tasks:
-            task.stop()
+            if task._status is TaskStatus.STARTED:
+                task.stop(wait=False)
+
+    def _wait_stopped(self):
+        stop_all(self._tasks)
+
+    def _when_stoppable(self, func):
+        _when_all_stoppable(self._tasks, func)
 
     def _reset(self):
+        # pylint: disable=W0212
         for task in self._tasks:
-            task.reset()
+            if task._status is not TaskStatus.IDLE:
+                task.reset()
+
+    def _cache_key(self):
+        keys = tuple(t._cache_key() for t in self._tasks) # pylint: disable=W0212
+        return None if None in keys else ('Parallel', keys)
 
     def __repr__(self):
         return "ParallelTask(status=%s, return_values=%s, tasks=%s)" % (
-                self._status, self.return_values, self._tasks
+                self._status, _REPR.repr(self.return_values), len(self._tasks)
             )
 
 
@@ -442,56 +1960,372 @@ class Sequential(Task):
     Currently does not capture the return_values of the underlying tasks, this
     will be fixed in the future.
 
+    Each task is started as soon as the previous one has finished, by the
+    shared ``SCHEDULER`` rather than by a thread of its own, so that any number
+    of ``Sequential`` tasks can run at once. Stopping a ``Sequential`` stops
+    the task currently running right away, and no later task is started.
+
     Args:
         tasks (list of ``Task``): Tasks to execute.
+
+        fail_fast (bool): If `True`, a task which fails is stopped right away
+            (and with it, everything it started), rather than when this task
+            is stopped. Either way, no later task is started. Default `False`.
+
+        deadline (float): See ``Parallel``. Default `None`.
     """
+    __slots__ = ('_tasks', '_fail_fast', '_deadline', '_exception',
+                 '_step_lock', '_next_index', '_token')
 
-    def __init__(self, tasks):
+    _reports_done = True
+
+    def __init__(self, tasks, fail_fast=False, deadline=None):
         super(Sequential, self).__init__()
         assert isinstance(tasks, list)
         self._tasks = tasks
+        self._fail_fast = fail_fast
+        self._deadline = deadline
         self._exception = None
+        self._step_lock = Lock()
+        self._next_index = 0
+        self._token = None
 
-        def run_thread(tasks):
-            try:
-                for task in tasks:
-                    task.start(wait=True)
-            except: # pylint: disable=W0702
-                # Just record the exception and return, the main thread will
-                # raise it
-                self._exception = sys.exc_info()
+    def _start(self):
+        if self._deadline is not None:
+            self._set_timeout(self._deadline - time.time())
+        self._exception = None
+        self._next_index = 0
+        self._token = CancellationToken()
+        SCHEDULER.submit(self._start_next, self._token)
+
+    def _start_next(self, token):
+        """Start the next task, or finish if there are none left."""
+        with self._step_lock:
+            if token.cancelled:
                 return
+            task = None
+            if self._next_index < len(self._tasks):
+                task = self._tasks[self._next_index]
+                self._next_index += 1
+                try:
+                    task.start()
+                except: # pylint: disable=W0702
+                    # Just record the exception and finish, the waiting thread
+                    # will raise it
+                    self._exception = sys.exc_info()
+                    task = None
+
+        if task is None:
+            if self._exception and self._fail_fast:
+                _stop_started(self._tasks)
+            self._set_done()
+        else:
+            _on_finish(task, self._task_finished, token)
 
-        self._thread = Thread(target=run_thread, args=(tasks,))
-
-    def _start(self):
-        self._thread.start()
-        assert self._thread.is_alive()
+    def _task_finished(self, task, token):
+        try:
+            _wait_finished(task)
+        except: # pylint: disable=W0702
+            with self._step_lock:
+                if token.cancelled:
+                    return
+                self._exception = sys.exc_info()
+            if self._fail_fast:
+                _stop_started(self._tasks)
+            self._set_done()
+            return
+        self._start_next(token)
 
     def _wait(self):
         # TODO: capture the return_values of the tasks
-        self._thread.join()
+        self._wait_done()
         if self._exception:
-            # https://portingguide.readthedocs.io/en/latest/exceptions.html#the-new-raise-syntax
-            ex = self._exception[0](self._exception[1])
-            ex.__traceback__ = self._exception[2]
-            raise ex
+            _reraise(self._exception)
+
+    def _begin_stop(self):
+        with self._step_lock:
+            self._token.cancel()
 
-    def _stop(self):
-        # FIXME this isn't threadsafe at all, have to have a way to signal
-        #       the executing thread to stop
         for task in self._tasks:
             # pylint: disable=W0212
-            if task._status in [TaskStatus.STARTED, TaskStatus.STOPPED]:
-                task.stop()
-            else:
-                return
+            if task._status is TaskStatus.STARTED:
+                task.stop(wait=False)
+
+    def _wait_stopped(self):
+        stop_all(self._tasks)
+
+    def _when_stoppable(self, func):
+        _when_all_stoppable(self._tasks, func)
 
     def _reset(self):
         for task in self._tasks:
-            task.reset()
+            # pylint: disable=W0212
+            if task._status is not TaskStatus.IDLE:
+                task.reset()
+
+    def _cache_key(self):
+        keys = tuple(t._cache_key() for t in self._tasks) # pylint: disable=W0212
+        return None if None in keys else ('Sequential', keys)
 
     def __repr__(self):
         return "SequentialTask(status=%s, return_values=%s, tasks=%s)" % (
-                self._status, self.return_values, self._tasks
+                self._status, _REPR.repr(self.return_values), len(self._tasks)
             )
+
+
+class TaskGraph(Task):
+    """A task that executes tasks as soon as the tasks they depend on finish.
+
+    Unlike nesting ``Parallel`` and ``Sequential`` tasks, a graph can express
+    any dependencies between tasks (as long as there are no cycles), and never
+    waits on tasks which a given task doesn't depend on. Like ``Parallel``, the
+    number of tasks running at once can be limited; when more tasks are ready
+    than are allowed to run, the ones with the longest chain of work still
+    depending on them (i.e. the ones on the critical path) are started first.
+
+    If a task fails, no more tasks are started, and the exception is raised
+    when the graph is waited on. With **fail_fast**, the tasks still running
+    are stopped as well, before the exception is raised.
+
+    ``return_values[\'results\']`` maps each task which finished to its
+    ``return_values``, and ``return_values[\'timings\']`` maps each task which
+    was started to a dict with its ``'start'`` and ``'end'`` times, in seconds
+    since the graph was started, and its ``'duration'``.
+
+    Args:
+        dependencies (dict): Maps tasks to lists of the tasks they depend on.
+            Tasks can also be added with ``add()``. Default `None`.
+
+        max_concurrency (int): The maximum number of tasks running at once.
+            If `None`, all ready tasks are started. Default `None`.
+
+        fail_fast (bool): See ``Parallel``. Default `False`.
+
+        deadline (float): See ``Parallel``. Default `None`.
+
+    Example:
+
+        graph = TaskGraph()
+        graph.add(build)
+        sends = [graph.add(host.send_file('server'), after=[build])
+                 for host in HOSTS]
+        server = graph.add(Parallel(servers), after=sends)
+        graph.add(Parallel(clients), after=[server])
+    """
+    __slots__ = ('_max_concurrency', '_fail_fast', '_deadline',
+                 '_dependencies', '_costs', '_cond', '_ready', '_priority',
+                 '_dependents', '_num_waiting_on', '_num_running',
+                 '_num_finished', '_start_time', '_exception', '_token')
+
+    _reports_done = True
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, dependencies=None, max_concurrency=None,
+                 fail_fast=False, deadline=None):
+        super(TaskGraph, self).__init__()
+        self._max_concurrency = max_concurrency
+        self._fail_fast = fail_fast
+        self._deadline = deadline
+        self._dependencies = {}
+        self._costs = {}
+        for task, after in (dependencies or {}).items():
+            self.add(task, after)
+
+        self._cond = Condition()
+        self._ready = []
+        self._priority = {}
+        self._dependents = {}
+        self._num_waiting_on = {}
+        self._num_running = 0
+        self._num_finished = 0
+        self._start_time = None
+        self._exception = None
+        self._token = None
+
+    def add(self, task, after=(), cost=1):
+        """Add a task to the graph.
+
+        Args:
+            task (``Task``): The task to add.
+
+            after (list of ``Task``): The tasks it depends on, which are added
+                to the graph if they aren't in it. Default `()`.
+
+            cost (float): The estimated duration of the task (in any unit,
+                as long as it is the same for all tasks), used to find the
+                critical path. Default `1`.
+
+        Returns:
+            ``Task``: The task, for convenience.
+        """
+        if self._status is not TaskStatus.IDLE:
+            raise RuntimeError("Cannot add tasks to %s in state %s" %
+                               (self, self._status))
+        for dependency in after:
+            if dependency not in self._dependencies:
+                self.add(dependency)
+        self._dependencies.setdefault(task, [])
+        self._dependencies[task].extend(after)
+        self._costs[task] = cost
+        return task
+
+    @property
+    def _tasks(self):
+        return list(self._dependencies)
+
+    def _priorities(self):
+        """Compute the length of the critical path starting at each task.
+
+        Raises:
+            ValueError: If the graph has a cycle.
+        """
+        dependents = defaultdict(list)
+        for task, after in self._dependencies.items():
+            for dependency in after:
+                dependents[dependency].append(task)
+
+        # Visit tasks depth first, after all of the tasks depending on them
+        priorities = {}
+        for root in self._dependencies:
+            stack = [(root, False)]
+            visiting = set()
+            while stack:
+                task, expanded = stack.pop()
+                if task in priorities:
+                    continue
+                if expanded:
+                    visiting.discard(task)
+                    priorities[task] = self._costs[task] + max(
+                        [priorities[t] for t in dependents[task]] or [0])
+                    continue
+                if task in visiting:
+                    raise ValueError("%s has a cycle" % self)
+                visiting.add(task)
+                stack.append((task, True))
+                stack.extend((t, False) for t in dependents[task]
+                             if t not in priorities)
+        return priorities, dependents
+
+    def _start(self):
+        priorities, self._dependents = self._priorities()
+        if self._deadline is not None:
+            self._set_timeout(self._deadline - time.time())
+        order = {task: i for i, task in enumerate(self._dependencies)}
+        with self._cond:
+            self._token = CancellationToken()
+            self._start_time = time.monotonic()
+            self._exception = None
+            self._num_running = 0
+            self._num_finished = 0
+            self._num_waiting_on = {task: len(set(after)) for task, after in
+                                    self._dependencies.items()}
+            # Ties are broken by the order in which tasks were added
+            self._priority = {task: (-priorities[task], order[task])
+                              for task in self._dependencies}
+            self._ready = [(self._priority[task], task)
+                           for task, count in self._num_waiting_on.items()
+                           if not count]
+            heapq.heapify(self._ready)
+            self.return_values['results'] = {}
+            self.return_values['timings'] = {}
+        self._start_ready(self._token)
+
+    def _start_ready(self, token):
+        """Start as many ready tasks as allowed, critical path first."""
+        started = []
+        with self._cond:
+            while (self._ready and not token.cancelled and
+                   self._exception is None and
+                   (self._max_concurrency is None or
+                    self._num_running < self._max_concurrency)):
+                _, task = heapq.heappop(self._ready)
+                self.return_values['timings'][task] = {
+                    'start': time.monotonic() - self._start_time}
+                try:
+                    task.start()
+                except: # pylint: disable=W0702
+                    self._fail(sys.exc_info())
+                    break
+                self._num_running += 1
+                started.append(task)
+            done = not self._num_running and (
+                self._num_finished == len(self._dependencies) or
+                self._exception is not None)
+            failed = self._exception is not None and not token.cancelled
+            self._cond.notify_all()
+
+        for task in started:
+            _on_finish(task, self._task_finished, token)
+        if failed and self._fail_fast:
+            _stop_started(self._dependencies)
+        if done:
+            self._set_done()
+
+    def _task_finished(self, task, token):
+        try:
+            _wait_finished(task)
+        except: # pylint: disable=W0702
+            with self._cond:
+                if not token.cancelled:
+                    self._fail(sys.exc_info())
+
+        with self._cond:
+            if token is not self._token:
+                return
+            timing = self.return_values['timings'][task]
+            timing['end'] = time.monotonic() - self._start_time
+            timing['duration'] = timing['end'] - timing['start']
+            self.return_values['results'][task] = task.return_values
+            self._num_running -= 1
+            self._num_finished += 1
+            for dependent in set(self._dependents[task]):
+                self._num_waiting_on[dependent] -= 1
+                if not self._num_waiting_on[dependent]:
+                    heapq.heappush(self._ready,
+                                   (self._priority[dependent], dependent))
+        self._start_ready(token)
+
+    def _fail(self, exc_info):
+        """Record the first exception. Must be called with the lock held."""
+        if self._exception is None:
+            self._exception = exc_info
+        self._cond.notify_all()
+
+    def _wait(self):
+        with self._cond:
+            while (self._num_finished < len(self._dependencies) and
+                   self._exception is None and not self._token.cancelled):
+                self._cond.wait()
+            exception = self._exception
+        if exception:
+            if self._fail_fast:
+                _stop_started(self._dependencies)
+            _reraise(exception)
+
+    def _begin_stop(self):
+        with self._cond:
+            if self._token:
+                self._token.cancel()
+            self._ready = []
+            self._cond.notify_all()
+
+        for task in self._dependencies:
+            # pylint: disable=W0212
+            if task._status is TaskStatus.STARTED:
+                task.stop(wait=False)
+
+    def _wait_stopped(self):
+        stop_all(self._dependencies)
+
+    def _when_stoppable(self, func):
+        _when_all_stoppable(self._dependencies, func)
+
+    def _reset(self):
+        for task in self._dependencies:
+            # pylint: disable=W0212
+            if task._status is not TaskStatus.IDLE:
+                task.reset()
+
+    def __repr__(self):
+        return "TaskGraph(status=%s, tasks=%s)" % (
+            self._status, len(self._dependencies))
@@ -0,0 +1,174 @@
+"""trace.py: Contains a recorder of the lifecycle of tasks.
+
+While tracing is enabled, every task records when it was started, waited on,
+stopped and reset, and how long it ran (from being started to finishing or
+being stopped). The recording can be exported as a Chrome trace, which can be
+opened with ``chrome://tracing`` or https://ui.perfetto.dev, to see where the
+time of an experiment goes: stragglers, tasks queued behind others, and slow
+teardowns.
+
+Each task gets a track of its own. Tasks run by a ``Parallel``, ``Sequential``
+or ``TaskGraph`` are shown under it, indented, and grouped with the top-level
+task they belong to.
+
+When tracing is disabled (the default), tasks only check a global variable.
+
+Example:
+
+    recorder = pyrem.trace.enable()
+    experiment.start(wait=True)
+    pyrem.trace.disable()
+    recorder.dump('experiment.trace.json')
+"""
+
+__author__ = "Ellis Michael"
+__email__ = "emichael@cs.washington.edu"
+
+__all__ = ['Recorder', 'enable', 'disable']
+
+import json
+import threading
+import time
+
+import pyrem.task
+
+
+class Recorder(object):
+    """Records spans of time spent by tasks in each phase of their lifecycle.
+
+    The phases are ``'run'``, ``'start'``, ``'wait'``, ``'stop'`` and
+    ``'reset'``. Times are in seconds since the recorder was created.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._origin = time.monotonic()
+        self._open = {}
+        self._spans = []
+
+    def begin(self, task, phase):
+        """Mark the beginning of a phase of a task."""
+        now = time.monotonic() - self._origin
+        with self._lock:
+            self._open[(id(task), phase)] = (task, now)
+
+    def end(self, task, phase):
+        """Mark the end of a phase of a task, recording a span."""
+        now = time.monotonic() - self._origin
+        with self._lock:
+            began = self._open.pop((id(task), phase), None)
+            if began:
+                self._spans.append((began[0], phase, began[1], now))
+
+    def spans(self):
+        """Return the recorded spans.
+
+        Returns:
+            list of tuple: ``(task, phase, begin, end)`` tuples.
+        """
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        """Forget everything recorded."""
+        with self._lock:
+            self._open.clear()
+            self._spans = []
+
+    def chrome_trace(self):
+        """Return the recording in the Chrome trace event format.
+
+        Returns:
+            dict: The trace, ready to be serialized to JSON.
+        """
+        spans = self.spans()
+        tasks = []
+        seen = set()
+        for task, _, _, _ in spans:
+            if id(task) not in seen:
+                seen.add(id(task))
+                tasks.append(task)
+
+        # Find the tasks run by each task, to nest them
+        children = {}
+        has_parent = set()
+        for task in tasks:
+            children[id(task)] = [t for t in _children(task) if id(t) in seen]
+            has_parent.update(id(t) for t in children[id(task)])
+
+        events = []
+        tracks = {}
+        for pid, root in enumerate(t for t in tasks
+                                   if id(t) not in has_parent):
+            events.append({'ph': 'M', 'name': 'process_name', 'pid': pid,
+                           'args': {'name': _name(root)}})
+            stack = [(root, 0)]
+            while stack:
+                task, depth = stack.pop()
+                if id(task) in tracks:
+                    continue
+                tid = len(tracks)
+                tracks[id(task)] = (pid, tid)
+                events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid,
+                               'tid': tid,
+                               'args': {'name': '  ' * depth + _name(task)}})
+                events.append({'ph': 'M', 'name': 'thread_sort_index',
+                               'pid': pid, 'tid': tid,
+                               'args': {'sort_index': tid}})
+                stack.extend((t, depth + 1)
+                             for t in reversed(children[id(task)]))
+
+        for task, phase, begin, end in spans:
+            pid, tid = tracks[id(task)]
+            events.append({'ph': 'X', 'name': phase, 'cat': 'pyrem',
+                           'pid': pid, 'tid': tid, 'ts': begin * 1e6,
+                           'dur': (end - begin) * 1e6})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, file_name):
+        """Write the recording to a file, as a Chrome trace."""
+        with open(file_name, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def _children(task):
+    """Return the tasks run by a task."""
+    children = list(getattr(task, '_tasks', None) or [])
+    inner = getattr(task, '_task', None)
+    if isinstance(inner, pyrem.task.Task):
+        children.append(inner)
+    return children
+
+def _name(task):
+    """Return a short name for a task."""
+    name = type(task).__name__
+    host = getattr(task, 'host', None)
+    if host:
+        name += ' @%s' % host
+    command = getattr(task, '_remote_command', None) or getattr(
+        task, '_command', None)
+    if command:
+        if not isinstance(command, str):
+            command = ' '.join(command)
+        name += ': ' + (command if len(command) <= 60 else
+                        command[:57] + '...')
+    return name
+
+
+def enable(recorder=None):
+    """Start recording the lifecycle of all tasks.
+
+    Args:
+        recorder (``Recorder``): The recorder to use. If `None`, a new one is
+            created. Default `None`.
+
+    Returns:
+        ``Recorder``: The recorder.
+    """
+    if recorder is None:
+        recorder = Recorder()
+    pyrem.task.TRACER = recorder
+    return recorder
+
+def disable():
+    """Stop recording."""
+    pyrem.task.TRACER = None
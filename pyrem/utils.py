@@ -4,6 +4,12 @@ __author__ = "Ellis Michael"
 __email__ = "emichael@cs.washington.edu"
 
 
+import sys
+
+from collections import deque
+from threading import Condition, Lock, Thread
+from traceback import print_exc
+
 from decorator import decorator
 
 @decorator
@@ -17,3 +23,93 @@ def synchronized(func, *args, **kwargs):
         return func(*args, **kwargs)
     with args[0]._lock: # pylint: disable=W0212
         return func(*args, **kwargs)
+
+
+class WorkerPool(object):
+    """A size-limited pool of threads which run submitted functions.
+
+    Threads are started as they are needed, up to **max_workers**, and exit
+    after being idle for **idle_timeout** seconds. Unlike the threads of a
+    ``concurrent.futures.ThreadPoolExecutor``, they are daemon threads, so
+    they never delay the interpreter's exit (and thus the cleanup of tasks).
+
+    Args:
+        max_workers (int): The maximum number of threads. Can be changed
+            later through the attribute of the same name.
+
+        idle_timeout (float): Seconds before an idle thread exits. Default
+            `60`.
+    """
+    def __init__(self, max_workers, idle_timeout=60):
+        self.max_workers = max_workers
+        self._idle_timeout = idle_timeout
+        self._cond = Condition()
+        self._queue = deque()
+        self._num_threads = 0
+        self._num_idle = 0
+
+    def submit(self, func, *args):
+        """Run ``func(*args)`` on one of the pool's threads.
+
+        Exceptions raised by the function are printed and otherwise ignored.
+        """
+        with self._cond:
+            self._queue.append((func, args))
+            if self._num_idle:
+                self._cond.notify()
+            elif self._num_threads < self.max_workers:
+                self._num_threads += 1
+                thread = Thread(target=self._work, name='pyrem-worker')
+                thread.daemon = True
+                thread.start()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._num_idle += 1
+                    notified = self._cond.wait(self._idle_timeout)
+                    self._num_idle -= 1
+                    if not notified and not self._queue:
+                        self._num_threads -= 1
+                        return
+                func, args = self._queue.popleft()
+            try:
+                func(*args)
+            except: # pylint: disable=W0702
+                print_exc(file=sys.stderr)
+
+
+class CancellationToken(object):
+    """A flag telling some ongoing work that it should stop.
+
+    Whoever does the work checks ``cancelled`` before each step (or registers
+    a callback), and whoever wants it stopped calls ``cancel()``.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._cancelled = False
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        """Whether ``cancel()`` has been called."""
+        return self._cancelled
+
+    def cancel(self):
+        """Cancel the work, running the registered callbacks."""
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func()
+
+    def add_callback(self, func):
+        """Call ``func()`` when the token is cancelled (or now, if it is)."""
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(func)
+                return
+        func()
@@ -1,4 +1,37 @@
-from pyrem.task import Task, TaskStatus
+import asyncio
+import contextlib
+import csv
+import io
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from array import array
+from collections import defaultdict
+
+import pyrem.host
+import pyrem.trace
+
+from pyrem.agent import AgentConnection, AgentTask
+from pyrem.asynctask import (AsyncParallel, AsyncRemoteTask,
+                             AsyncSequential, AsyncSubprocessTask)
+from pyrem.cache import Cached, ResultCache
+from pyrem.cas import ContentStore, _file_hash
+from pyrem.host import HostGroup, LocalHost, RemoteHost
+from pyrem.logs import LogMultiplexer
+from pyrem.probe import FileExists, OutputMatches, PortOpen, Ready
+from pyrem.reactor import REACTOR
+from pyrem.retry import Retry, RetryPolicy
+from pyrem.sampler import Sampler
+from pyrem.sweep import ColumnStore, CsvStore, Sweep
+from pyrem.task import (Task, TaskStatus, Parallel, RemoteTask, SubprocessTask,
+                        Sequential, SCHEDULER, STARTED_TASKS, TaskGraph,
+                        as_completed, stop_all, wait_any)
 
 class DummyTask(Task):
     def _start(self):
@@ -39,3 +72,1108 @@ class TestDummyTask(object):
     def test_status2(self):
         self.task.start(wait=True)
         assert self.task._status == TaskStatus.STOPPED
+
+
+class TestRemoteHost(object):
+    def test_shared_connection(self):
+        host = RemoteHost('alpha')
+        task = host.run(['ls'])
+        assert task._command[:4] == ('ssh', '-o', 'ControlMaster=auto', '-o')
+        assert task._command[4].startswith('ControlPath=')
+        assert task._ssh_options == host._ssh_options()
+        assert task._ssh_options[3] in host._rsync_cmd()[2]
+
+    def test_no_shared_connection(self):
+        host = RemoteHost('alpha', control_persist=None)
+        assert host.run(['ls'])._command[:2] == ('ssh', 'alpha')
+        assert host._rsync_cmd() == ['rsync']
+
+    def test_broadcast_tree(self):
+        group = HostGroup(['h%d' % i for i in range(7)])
+        # Options of either type of transfer only
+        graph = group.broadcast_files(['data', '/opt/bin'], 'exp', tree=True,
+                                      shell=False, kill_remote=False,
+                                      quiet=True)
+        depth = {}
+        for task in graph._tasks:
+            after = graph._dependencies[task]
+            depth[task] = 1 + max([depth[t] for t in after] or [0])
+        # 1 + 2 + 4 hosts
+        assert sorted(depth.values()) == [1, 2, 2, 3, 3, 3, 3]
+        relay = next(t for t in graph._tasks if isinstance(t, RemoteTask))
+        assert relay._remote_command[:4] == ('cd', 'exp', '&&', 'rsync')
+        assert relay._remote_command[5:7] == ('data', 'opt/bin')
+        assert not relay._kill_remote and relay._quiet
+
+
+class WrapperTask(Task):
+    """A task which doesn't report when it finishes, waiting on another."""
+    def __init__(self, task):
+        super(WrapperTask, self).__init__()
+        self.task = task
+
+    def _start(self):
+        self.task.start()
+
+    def _wait(self):
+        self.task.wait()
+
+    def _stop(self):
+        self.task.stop()
+
+
+class SleepTask(Task):
+    """A task that sleeps in _wait, tracking how many are running at once."""
+    running = 0
+    host_running = defaultdict(int)
+    max_running = defaultdict(int)
+    lock = threading.Lock()
+
+    def __init__(self, host=None, duration=0.05):
+        super(SleepTask, self).__init__()
+        self.host = host
+        self.duration = duration
+
+    def _start(self):
+        with SleepTask.lock:
+            SleepTask.running += 1
+            SleepTask.host_running[self.host] += 1
+            self.max_running['all'] = max(self.max_running['all'],
+                                          SleepTask.running)
+            self.max_running[self.host] = max(
+                self.max_running[self.host], SleepTask.host_running[self.host])
+
+    def _wait(self):
+        time.sleep(self.duration)
+
+    def _stop(self):
+        with SleepTask.lock:
+            SleepTask.running -= 1
+            SleepTask.host_running[self.host] -= 1
+
+
+class TestParallel(object):
+    def test_deadline(self):
+        tasks = [SubprocessTask(['sleep', '10']) for _ in range(3)]
+        task = Parallel(tasks, deadline=time.time() + 0.2)
+        start = time.monotonic()
+        assert task.start(wait=True)['timed_out']
+        assert time.monotonic() - start < 5
+        assert all(t._status == TaskStatus.STOPPED for t in tasks)
+
+    def test_more_waiting_tasks_than_workers(self):
+        # Each wrapper blocks while waiting on its Sequential, which needs the
+        # SCHEDULER to start its second task
+        wrappers = [WrapperTask(Sequential([SubprocessTask(['sleep', '0.2']),
+                                            SubprocessTask(['true'])]))
+                    for _ in range(SCHEDULER.max_workers + 8)]
+        task = Parallel(wrappers)
+        thread = threading.Thread(target=task.start, kwargs={'wait': True})
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        assert not thread.is_alive()
+        assert all(w._status == TaskStatus.STOPPED for w in wrappers)
+
+    def test_teardown_frees_workers(self):
+        # Each first task leaves a child ignoring SIGTERM, killed only after
+        # the grace period, which the SCHEDULER mustn't wait out
+        sequences = [Sequential([
+            SubprocessTask(["trap '' TERM; sleep 30 &"], shell=True,
+                           grace_period=2),
+            SubprocessTask(['true'])])
+                     for _ in range(3 * SCHEDULER.max_workers)]
+        start = time.monotonic()
+        Parallel(sequences).start(wait=True)
+        assert time.monotonic() - start < 4.5
+        assert all(s._status == TaskStatus.STOPPED for s in sequences)
+
+    def test_max_concurrency(self):
+        SleepTask.max_running.clear()
+        tasks = [SleepTask() for _ in range(10)]
+        Parallel(tasks, max_concurrency=3).start(wait=True)
+        assert SleepTask.max_running['all'] == 3
+        assert all(t._status == TaskStatus.STOPPED for t in tasks)
+
+    def test_max_per_host(self):
+        tasks = [SleepTask(host=h) for h in 'aaaab']
+        task = Parallel(tasks, max_per_host=1)
+        task.start()
+        time.sleep(0.02)
+        assert [t._status for t in tasks] == [
+            TaskStatus.STARTED, TaskStatus.IDLE, TaskStatus.IDLE,
+            TaskStatus.IDLE, TaskStatus.STARTED]
+        task.wait()
+        assert all(t._status == TaskStatus.STOPPED for t in tasks)
+
+    def test_many_queued_per_host(self):
+        SleepTask.max_running.clear()
+        tasks = [SleepTask(host=h, duration=0) for h in 'abcd' * 500]
+        Parallel(tasks, max_concurrency=6, max_per_host=2).start(wait=True)
+        assert SleepTask.max_running['all'] == 6
+        assert all(SleepTask.max_running[h] <= 2 for h in 'abcd')
+        assert all(t._status == TaskStatus.STOPPED for t in tasks)
+
+    def test_stop_queued(self):
+        tasks = [SleepTask(duration=0.2) for _ in range(4)]
+        task = Parallel(tasks, max_concurrency=2)
+        task.start()
+        task.stop()
+        assert [t._status for t in tasks] == [
+            TaskStatus.STOPPED, TaskStatus.STOPPED, TaskStatus.IDLE,
+            TaskStatus.IDLE]
+        task.reset()
+        assert all(t._status == TaskStatus.IDLE for t in tasks)
+
+    def test_fail_fast(self):
+        tasks = [SubprocessTask(['sleep', '10'], quiet=True),
+                 SubprocessTask(['sh', '-c', 'sleep 0.1; exit 1'],
+                                require_success=True)]
+        task = Parallel(tasks, fail_fast=True)
+        start = time.time()
+        try:
+            task.start(wait=True)
+        except RuntimeError as e:
+            assert 'was 1' in str(e)
+        else:
+            assert False
+        assert time.time() - start < 5
+        assert all(t._status == TaskStatus.STOPPED for t in tasks)
+        task.stop()
+
+
+def group_running(pgid):
+    """Whether a process group has processes which aren't zombies."""
+    for name in os.listdir('/proc'):
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[2]) == pgid and fields[0] != 'Z':
+            return True
+    return False
+
+
+def group_exits(pgid, timeout=2):
+    """Whether a process group exits in time, SIGKILL being asynchronous."""
+    deadline = time.monotonic() + timeout
+    while group_running(pgid):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+FAKE_SSH = """#!/bin/sh
+# Runs the command locally, logging it
+for arg; do cmd=$arg; done
+echo "$cmd" >> "$PYREM_TEST_SSH_LOG"
+exec sh -c "$cmd"
+"""
+
+
+class TestRemoteTask(object):
+    """Runs RemoteTasks against an ssh which runs commands locally."""
+    @classmethod
+    def setup_class(klass):
+        klass.tmp_dir = tempfile.mkdtemp()
+        ssh = os.path.join(klass.tmp_dir, 'ssh')
+        with open(ssh, 'w') as f:
+            f.write(FAKE_SSH)
+        os.chmod(ssh, 0o755)
+        klass.log = os.path.join(klass.tmp_dir, 'log')
+        klass.old_path = os.environ['PATH']
+        os.environ['PATH'] = klass.tmp_dir + os.pathsep + klass.old_path
+        os.environ['PYREM_TEST_SSH_LOG'] = klass.log
+
+    @classmethod
+    def teardown_class(klass):
+        os.environ['PATH'] = klass.old_path
+        shutil.rmtree(klass.tmp_dir)
+
+    def ssh_log(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_batched_kill(self):
+        open(self.log, 'w').close()
+        tasks = [RemoteTask('alpha', ['sleep 10']) for _ in range(3)]
+        for task in tasks:
+            task.start()
+        assert STARTED_TASKS.tasks_on('alpha') == set(tasks)
+        assert tasks[0]._ssh_cmd is tasks[1]._ssh_cmd
+        time.sleep(0.2)
+        stop_all(tasks)
+        assert all(t._status == TaskStatus.STOPPED for t in tasks)
+        assert 'alpha' not in STARTED_TASKS.hosts()
+
+        kills = [line for line in self.ssh_log() if 'kill -TERM' in line]
+        assert len(kills) == 1
+        for task in tasks:
+            assert task._tmp_file_name in kills[0]
+            assert not os.path.exists(task._tmp_file_name)
+
+    def test_batched_async_kill(self):
+        open(self.log, 'w').close()
+        tasks = [AsyncRemoteTask('alpha', ['sleep 10']) for _ in range(3)]
+        parallel = AsyncParallel(tasks)
+
+        async def run():
+            await parallel.start()
+            await asyncio.sleep(0.2)
+        # Killed after the event loop has stopped, as on exit
+        asyncio.run(run())
+        stop_all([parallel])
+        assert all(t._status == TaskStatus.STOPPED for t in tasks)
+
+        kills = [line for line in self.ssh_log() if 'kill -TERM' in line]
+        assert len(kills) == 1
+        for task in tasks:
+            assert task._tmp_file_name in kills[0]
+
+    def test_kill_remote_process_group(self):
+        # The remote command forks a process which ignores SIGTERM
+        task = RemoteTask('alpha', ["(trap '' TERM ; sleep 30) & sleep 30"],
+                          grace_period=0.3)
+        task.start()
+        time.sleep(0.2)
+        with open(task._tmp_file_name) as f:
+            pgid = int(f.read())
+        assert group_running(pgid)
+        task.stop()
+        assert group_exits(pgid)
+
+    def test_aggregate(self):
+        open(self.log, 'w').close()
+        tasks = [RemoteTask('alpha', ['echo a; echo e >&2'],
+                            return_output=True),
+                 RemoteTask('alpha', ['printf b; exit 3'], return_output=True),
+                 RemoteTask('beta', ['echo c'], return_output=True)]
+        Parallel(tasks, aggregate=True).start(wait=True)
+        assert tasks[0].return_values == {'stdout': b'a\n', 'stderr': b'e\n',
+                                          'retcode': 0}
+        assert tasks[1].return_values == {'stdout': b'b', 'stderr': b'',
+                                          'retcode': 3}
+        assert tasks[2].return_values['stdout'] == b'c\n'
+        sessions = [line for line in self.ssh_log()
+                    if line.startswith('d=') or "; echo c'" in line]
+        assert len(sessions) == 2
+
+    def test_aggregate_keeps_sampler(self):
+        sampler = Sampler(interval=0.05)
+        tasks = [RemoteTask('alpha', ['sleep 0.3'], sampler=sampler),
+                 RemoteTask('alpha', ['true']), RemoteTask('alpha', ['true'])]
+        parallel = Parallel(tasks, aggregate=True)
+        assert tasks[0] in parallel._tasks
+        parallel.start(wait=True)
+        assert len(tasks[0].return_values['resources']['time']) > 2
+
+    def test_deploy_known_blob(self):
+        store = ContentStore(os.path.join(self.tmp_dir, 'cas'), manifest=None)
+        os.mkdir(store.remote_root)
+        source = os.path.join(self.tmp_dir, 'binary')
+        with open(source, 'w') as f:
+            f.write('binary')
+        blob = _file_hash(source)
+        shutil.copy(source, os.path.join(store.remote_root, blob))
+        store.add('alpha', [blob])
+
+        host = RemoteHost('alpha', control_persist=None)
+        destination = os.path.join(self.tmp_dir, 'exp', 'binary')
+        # With an option of the upload only
+        deploy = store.deploy(host, {source: destination}, shell=False)
+        assert deploy.start(wait=True) == {'uploaded': 0}
+        assert os.path.samefile(destination,
+                                os.path.join(store.remote_root, blob))
+
+        # Copied where it can't be linked
+        if (os.path.isdir('/dev/shm') and
+                os.stat('/dev/shm').st_dev != os.stat(self.tmp_dir).st_dev):
+            other_fs = tempfile.mkdtemp(dir='/dev/shm')
+            try:
+                destination = os.path.join(other_fs, 'binary')
+                store.deploy(host, {source: destination}).start(wait=True)
+                with open(destination) as f:
+                    assert f.read() == 'binary'
+            finally:
+                shutil.rmtree(other_fs)
+
+    def test_deploy_stale_manifest(self):
+        store = ContentStore(os.path.join(self.tmp_dir, 'stale'),
+                             manifest=None)
+        source = os.path.join(self.tmp_dir, 'stale-binary')
+        with open(source, 'w') as f:
+            f.write('stale')
+        store.add('alpha', [_file_hash(source), 'other'])
+
+        host = RemoteHost('alpha', control_persist=None)
+        deploy = store.deploy(
+            host, {source: os.path.join(self.tmp_dir, 'stale-out')},
+            quiet=True)
+        try:
+            deploy.start(wait=True)
+        except RuntimeError:
+            pass
+        else:
+            assert False
+        assert store.blobs('alpha') == set(['other'])
+        deploy.stop()
+
+    def test_sampler(self):
+        sampler = Sampler(interval=0.05)
+        task = RemoteTask('alpha', ['sleep 0.5'], sampler=sampler)
+        resources = task.start(wait=True)['resources']
+        assert len(resources['time']) > 2
+        assert len(resources['rss']) == len(resources['time'])
+        assert min(resources['rss']) > 0
+
+    def test_remote_retcode(self):
+        task = RemoteTask('alpha', ['exit 3'])
+        assert task.start(wait=True)['retcode'] == 3
+
+    def test_retry_transport_failures(self):
+        policy = RetryPolicy(backoff=0.01)
+        values = Retry(RemoteTask('alpha', ['exit 255']), policy).start(
+            wait=True)
+        assert values['attempts'] == 3 and values['retcode'] == 255
+        values = Retry(RemoteTask('alpha', ['exit 3']), policy).start(
+            wait=True)
+        assert values['attempts'] == 1 and values['retcode'] == 3
+
+    def test_collect_files(self):
+        results = os.path.join(self.tmp_dir, 'results')
+        os.makedirs(os.path.join(results, 'logs'))
+        for name in ['out', 'logs/a.log', 'logs/b.log']:
+            with open(os.path.join(results, name), 'w') as f:
+                f.write(name * 100)
+        group = HostGroup([RemoteHost(h, control_persist=None)
+                           for h in ['alpha', 'beta']])
+        local = os.path.join(self.tmp_dir, 'collected')
+        collect = group.collect_files(
+            [os.path.join(results, 'out'), os.path.join(results, 'logs')],
+            local, max_concurrency=1)
+        values = collect.start(wait=True)
+        assert sorted(values['hosts']) == ['alpha', 'beta']
+        for host in ['alpha', 'beta']:
+            copy = os.path.join(local, host, results.lstrip('/'))
+            with open(os.path.join(copy, 'logs', 'b.log')) as f:
+                assert f.read() == 'logs/b.log' * 100
+            assert os.listdir(os.path.join(local, host)) == ['tmp']
+            transfer = values['hosts'][host]
+            assert 0 < transfer['bytes'] < 1000
+            assert transfer['throughput'] > 0
+        assert values['bytes'] == sum(t['bytes']
+                                      for t in values['hosts'].values())
+
+        missing = RemoteHost('alpha', control_persist=None).get_files(
+            ['/nonexistent'], local, quiet=True)
+        assert missing.start(wait=True)['retcode'] != 0
+
+        keys = [RemoteHost('alpha').get_files(['out'], local)._cache_key()
+                for _ in range(2)]
+        assert keys[0] == keys[1]
+        assert keys[0] != RemoteHost('alpha').get_files(
+            ['out'], self.tmp_dir)._cache_key()
+
+
+class TestSubprocessTask(object):
+    def test_return_output(self):
+        task = SubprocessTask(['sh', '-c', 'echo out; echo err >&2'],
+                              return_output=True)
+        values = task.start(wait=True)
+        assert values == {'stdout': b'out\n', 'stderr': b'err\n', 'retcode': 0}
+
+    def test_max_output_lines(self):
+        task = SubprocessTask(['seq', '1000'], return_output=True,
+                              max_output_lines=2)
+        assert task.start(wait=True)['stdout'] == b'999\n1000\n'
+
+    def test_timeout(self):
+        task = SubprocessTask(['sleep', '10'])
+        start = time.monotonic()
+        values = task.start(wait=True, timeout=0.2)
+        assert time.monotonic() - start < 5
+        assert values['timed_out'] and values['retcode'] != 0
+
+        task = SubprocessTask(['true'])
+        task.start()
+        assert 'timed_out' not in task.wait(timeout=5)
+
+    def test_timeout_frees_workers(self):
+        # Ignoring SIGTERM, they are killed only after the grace period,
+        # which the SCHEDULER mustn't wait out
+        tasks = [SubprocessTask(["trap '' TERM; sleep 30"], shell=True,
+                                grace_period=2)
+                 for _ in range(2 * SCHEDULER.max_workers)]
+        for task in tasks:
+            task.start(timeout=0.1)
+        time.sleep(0.3)
+        start = time.monotonic()
+        Sequential([SubprocessTask(['true']) for _ in range(3)]).start(
+            wait=True)
+        assert time.monotonic() - start < 1
+        stop_all(tasks)
+        assert all(t.return_values['timed_out'] for t in tasks)
+
+    def test_stop_process_group(self):
+        # Ignores SIGTERM, and so do its children
+        task = SubprocessTask(["trap '' TERM ; sleep 30 & sleep 30"],
+                              shell=True, grace_period=0.3)
+        task.start()
+        time.sleep(0.2)
+        # In a group of its own, but in the same session, to keep the tty
+        assert os.getpgid(task._process.pid) == task._process.pid
+        assert os.getsid(task._process.pid) == os.getsid(0)
+        start = time.monotonic()
+        task.stop()
+        assert 0.3 <= time.monotonic() - start < 5
+        assert task._process.returncode == -signal.SIGKILL
+        assert group_exits(task._process.pid)
+
+        # Left behind by a command which finished
+        task = SubprocessTask(['sleep 30 &'], shell=True, grace_period=0.3)
+        task.start()
+        time.sleep(0.2)
+        assert group_running(task._process.pid)
+        task.wait()
+        assert group_exits(task._process.pid)
+
+    def test_compact(self):
+        tasks = [SubprocessTask(['echo', 'x' * 10000]) for _ in range(2)]
+        assert not hasattr(tasks[0], '__dict__')
+        assert tasks[0]._popen_kwargs is tasks[1]._popen_kwargs
+        assert len(repr(Parallel(tasks))) < 100
+        assert len(repr(tasks[0])) < 400
+        assert tasks[0]._rlock is None
+        tasks[0].start()
+        assert tasks[0] in STARTED_TASKS
+        assert tasks[0] in STARTED_TASKS.tasks_on(None)
+        tasks[0].wait()
+        assert tasks[0] not in STARTED_TASKS
+
+    def test_sampler(self):
+        sampler = Sampler(interval=0.05)
+        task = SubprocessTask(
+            ['sh', '-c', 'i=0; while [ $i -lt 300000 ]; do i=$((i+1)); done'],
+            sampler=sampler)
+        resources = task.start(wait=True)['resources']
+        assert isinstance(resources['cpu'], array)
+        assert len(resources['time']) > 2
+        assert list(resources['cpu']) == sorted(resources['cpu'])
+        assert resources['cpu'][-1] > 0
+
+    def test_iter_output(self):
+        lines = []
+        task = SubprocessTask(['sh', '-c', 'echo a; sleep 0.1; echo b'],
+                              return_output=True,
+                              output_callback=lambda *args: lines.append(args))
+        task.start()
+        # Lines read before iterating are replayed from the kept output
+        assert list(task.iter_output()) == [('stdout', b'a\n'),
+                                            ('stdout', b'b\n')]
+        assert task.wait()['stdout'] == b'a\nb\n'
+        assert lines == [('stdout', b'a\n'), ('stdout', b'b\n')]
+
+        # Without return_output, the lines read before iterating are lost
+        lines = []
+        task = SubprocessTask(['sh', '-c', 'echo a; sleep 0.5; echo b'],
+                              output_callback=lambda *args: lines.append(args))
+        task.start()
+        deadline = time.monotonic() + 5
+        while not lines and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert list(task.iter_output()) == [('stdout', b'b\n')]
+        assert task.wait()['stdout'] is None
+        assert lines == [('stdout', b'a\n'), ('stdout', b'b\n')]
+
+
+class TestCompletion(object):
+    def test_as_completed(self):
+        tasks = [SubprocessTask(['sleep', str(t)]) for t in [0.3, 0.1, 0.2]]
+        for task in tasks:
+            task.start()
+        assert list(as_completed(tasks)) == [tasks[1], tasks[2], tasks[0]]
+        assert all(t._status == TaskStatus.STOPPED for t in tasks)
+
+    def test_as_completed_nested(self):
+        slow = SubprocessTask(['sleep', '0.3'])
+        fast = Parallel([SubprocessTask(['true']), SleepTask(duration=0.1)],
+                        max_concurrency=1)
+        both = [slow, Parallel([fast])]
+        for task in both:
+            task.start()
+        assert list(as_completed(both)) == [both[1], slow]
+
+    def test_wait_any(self):
+        tasks = [SubprocessTask(['sleep', '0.2']),
+                 SubprocessTask(['sh', '-c', 'exit 3'])]
+        for task in tasks:
+            task.start()
+        assert wait_any(tasks) is tasks[1]
+        assert tasks[1].return_values['retcode'] == 3
+        assert wait_any(tasks[:1], timeout=0.01) is None
+        assert wait_any(tasks[:1]) is tasks[0]
+
+    def test_wait_any_removes_callbacks(self):
+        task = SubprocessTask(['sleep', '0.2'])
+        task.start()
+        for _ in range(1000):
+            assert wait_any([task], timeout=0) is None
+        assert not task._done_callbacks
+        completions = as_completed([task])
+        assert next(completions) is task
+        completions.close()
+        assert not task._done_callbacks
+
+    def test_wait_any_waits_once(self):
+        task = SleepTask(duration=0.2)
+        calls = []
+        wait = task._wait
+        task._wait = lambda: (calls.append(1), wait())
+        task.start()
+        for _ in range(5):
+            assert wait_any([task], timeout=0) is None
+        assert wait_any([task]) is task
+        assert list(as_completed([task])) == [task]
+        assert len(calls) == 1
+
+    def test_custom_task(self):
+        tasks = [SleepTask(duration=0.1), SubprocessTask(['true'])]
+        for task in tasks:
+            task.start()
+        assert list(as_completed(tasks)) == [tasks[1], tasks[0]]
+
+
+class TestAsyncTask(object):
+    def test_gather(self):
+        tasks = [AsyncSubprocessTask(['echo', str(i)], return_output=True)
+                 for i in range(3)]
+
+        async def run():
+            return await asyncio.gather(*tasks)
+
+        values = asyncio.run(run())
+        assert [v['stdout'] for v in values] == [b'0\n', b'1\n', b'2\n']
+        assert all(t._status == TaskStatus.STOPPED for t in tasks)
+
+    def test_stop_sequential(self):
+        tasks = [AsyncSubprocessTask(['sleep', '10']),
+                 AsyncSubprocessTask(['true'])]
+        task = AsyncSequential(tasks)
+
+        async def run():
+            await task.start()
+            await asyncio.sleep(0.1)
+            await task.stop()
+
+        asyncio.run(run())
+        assert tasks[0]._status == TaskStatus.STOPPED
+        assert tasks[1]._status == TaskStatus.IDLE
+
+    def test_parallel_limits(self):
+        tasks = [AsyncSubprocessTask(['sleep', '0.3']) for _ in range(4)]
+        for task, host in zip(tasks, ['alpha', 'alpha', 'alpha', 'beta']):
+            task.host = host
+        parallel = AsyncParallel(tasks, max_concurrency=2, max_per_host=1)
+
+        async def run():
+            await parallel.start()
+            await asyncio.sleep(0.45)
+            status = tasks[3]._status
+            await parallel.wait()
+            return status
+
+        # beta runs alongside the first alpha task, rather than after the
+        # queued alpha tasks take up both slots
+        assert asyncio.run(run()) == TaskStatus.STOPPED
+
+
+class TestSequential(object):
+    def test_order(self):
+        tasks = [SleepTask(duration=0.01) for _ in range(3)]
+        task = Sequential(tasks)
+        task.start()
+        for _ in range(2):
+            assert task._status == TaskStatus.STARTED
+            task.wait()
+            assert all(t._status == TaskStatus.STOPPED for t in tasks)
+            task.reset()
+            task.start()
+        task.stop()
+
+    def test_stop(self):
+        tasks = [SubprocessTask(['sleep', '10']), SubprocessTask(['true'])]
+        task = Sequential(tasks)
+        task.start()
+        time.sleep(0.1)
+        start = time.time()
+        task.stop()
+        assert time.time() - start < 1
+        assert tasks[0]._status == TaskStatus.STOPPED
+        time.sleep(0.1)
+        assert tasks[1]._status == TaskStatus.IDLE
+
+    def test_no_thread_per_sequential(self):
+        threads = threading.active_count()
+        tasks = [Sequential([SubprocessTask(['sleep', '0.2']),
+                             SubprocessTask(['true'])])
+                 for _ in range(100)]
+        task = Parallel(tasks)
+        task.start()
+        time.sleep(0.1)
+        assert threading.active_count() - threads <= SCHEDULER.max_workers
+        task.wait()
+
+    def test_exception(self):
+        task = Sequential([SubprocessTask(['false'], require_success=True),
+                           SubprocessTask(['true'])])
+        try:
+            task.start(wait=True)
+        except RuntimeError:
+            pass
+        else:
+            assert False
+        task.stop()
+
+
+class TestTaskGraph(object):
+    def test_dependencies(self):
+        build = SleepTask(duration=0.05)
+        sends = [SleepTask(duration=0.05) for _ in range(3)]
+        run = SleepTask(duration=0.01)
+        graph = TaskGraph({run: sends})
+        for send in sends:
+            graph.add(send, after=[build])
+        values = graph.start(wait=True)
+
+        timings = values['timings']
+        assert set(values['results']) == set([build, run] + sends)
+        for send in sends:
+            assert timings[send]['start'] >= timings[build]['end']
+            assert timings[run]['start'] >= timings[send]['end']
+
+    def test_critical_path(self):
+        short, long1, long2 = [SleepTask(duration=0.01) for _ in range(3)]
+        graph = TaskGraph(max_concurrency=1)
+        graph.add(short)
+        graph.add(long2, after=[long1])
+        timings = graph.start(wait=True)['timings']
+        assert timings[long1]['start'] < timings[short]['start']
+
+    def test_cycle(self):
+        a, b = SleepTask(), SleepTask()
+        graph = TaskGraph({a: [b], b: [a]})
+        try:
+            graph.start()
+        except ValueError:
+            pass
+        else:
+            assert False
+        graph.stop()
+
+
+class TestLogs(object):
+    def test_per_task_files(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            logs = LogMultiplexer(tmp_dir)
+            tasks = [SubprocessTask(['sh', '-c', 'echo out %d; echo err >&2' %
+                                     i], log=logs) for i in range(3)]
+            Parallel(tasks).start(wait=True)
+            for i, task in enumerate(tasks):
+                with open(task.return_values['log'], 'rb') as f:
+                    assert sorted(f.read().splitlines()) == [
+                        b'err', b'out %d' % i]
+                assert task.return_values['stdout'] is None
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_console_summary(self):
+        tmp_dir = tempfile.mkdtemp()
+        summary = io.StringIO()
+        try:
+            logs = LogMultiplexer(tmp_dir, console=True, flush_interval=0.05,
+                                  console_interval=0.05)
+            with contextlib.redirect_stdout(summary):
+                SubprocessTask(['sh', '-c', 'echo hello; sleep 0.5'],
+                               log=logs).start(wait=True)
+            assert '] hello\n' in summary.getvalue()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_per_host_rotation(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            rotated = []
+            # The second run carries on from the rotated files of the first
+            for _ in range(2):
+                logs = LogMultiplexer(tmp_dir, per_host=True, buffer_size=100,
+                                      max_bytes=1000, backups=2, compress=True)
+                Parallel([SubprocessTask(['seq', '1000'], log=logs)
+                          for _ in range(2)]).start(wait=True)
+                logs.flush()
+                names = sorted(os.listdir(tmp_dir))
+                assert 'localhost.log' in names
+                assert len(names) == 3
+                assert all(n.endswith('.gz') for n in names
+                           if n != 'localhost.log')
+                with open(os.path.join(tmp_dir, 'localhost.log'), 'rb') as f:
+                    assert all(line.startswith(b'local-seq-')
+                               for line in f.read().splitlines())
+                rotated.append([n for n in names if n != 'localhost.log'])
+            assert not set(rotated[0]) & set(rotated[1])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestProbe(object):
+    def test_wait_ready(self):
+        task = SubprocessTask(
+            ['sh', '-c', 'sleep 0.1; echo ready; sleep 10'], return_output=True)
+        task.start()
+        task.wait_ready(OutputMatches('^ready'), timeout=5)
+        assert task._status == TaskStatus.STARTED
+        assert not task._done_callbacks
+        try:
+            task.wait_ready(OutputMatches('never'), timeout=0.1)
+        except TimeoutError:
+            pass
+        else:
+            assert False
+        task.stop()
+
+        task = SubprocessTask(['true'], return_output=True)
+        task.start()
+        try:
+            task.wait_ready(OutputMatches('never'), timeout=5)
+        except RuntimeError:
+            pass
+        else:
+            assert False
+        task.wait()
+
+    def test_ready_barrier(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'up')
+            server = SubprocessTask(
+                ['sh', '-c', 'sleep 0.2; touch %s; sleep 10' % path])
+            client = SubprocessTask(['test', '-e', path], require_success=True)
+            Sequential([Ready(server, FileExists(path), timeout=5),
+                        client]).start(wait=True)
+            assert server._status == TaskStatus.STARTED
+            server.stop()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_blocking_probes(self):
+        class Blocking(FileExists):
+            def check(self, task):
+                unblocked.wait(5)
+                return True
+
+        unblocked = threading.Event()
+        servers = [SubprocessTask(['sleep', '10'])
+                   for _ in range(2 * SCHEDULER.max_workers)]
+        readies = [Ready(s, Blocking('never'), timeout=10) for s in servers]
+        try:
+            for ready in readies:
+                ready.start()
+            time.sleep(0.2)
+            start = time.monotonic()
+            Sequential([SubprocessTask(['true']) for _ in range(3)]).start(
+                wait=True)
+            assert time.monotonic() - start < 2
+        finally:
+            unblocked.set()
+            stop_all(readies + servers)
+
+    def test_failing_probe(self):
+        class Broken(FileExists):
+            def check(self, task):
+                raise OSError("broken")
+
+        server = SubprocessTask(['sleep', '10'])
+        ready = Ready(server, Broken('never', interval=0.05), timeout=5)
+        try:
+            ready.start(wait=True)
+        except OSError:
+            pass
+        else:
+            assert False
+        assert server._status == TaskStatus.STOPPED
+        ready.stop()
+
+        server = SubprocessTask(['sleep', '10'])
+        server.start()
+        try:
+            server.wait_ready(Broken('never'), timeout=5)
+        except OSError:
+            pass
+        else:
+            assert False
+        server.stop()
+
+    def test_port_open(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        probe = PortOpen('127.0.0.1', listener.getsockname()[1])
+        assert not probe.check(None)
+        listener.listen()
+        assert probe.check(None)
+        listener.close()
+
+
+class TestRetry(object):
+    def test_retry_until_success(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            count = os.path.join(tmp_dir, 'count')
+            script = 'echo >>%s; [ `wc -l <%s` -ge 3 ]' % (count, count)
+            task = SubprocessTask(['sh', '-c', script], require_success=True)
+            policy = RetryPolicy(max_attempts=5, backoff=0.01,
+                                 retry_if=lambda task, exc_info: exc_info)
+            values = Retry(task, policy).start(wait=True)
+            assert values['retcode'] == 0 and values['attempts'] == 3
+            timings = values['attempt_timings']
+            assert len(timings) == 3
+            assert all(a['end'] <= b['start'] for a, b in zip(timings,
+                                                              timings[1:]))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_backoff(self):
+        policy = RetryPolicy(backoff=1, multiplier=2, max_backoff=5, jitter=0)
+        assert [policy.delay(n) for n in range(1, 5)] == [1, 2, 4, 5]
+
+
+class TestSweep(object):
+    def test_grid(self):
+        hosts = [LocalHost(), LocalHost()]
+        sweep = Sweep(['echo', '{threads}', '{size}'],
+                      {'threads': [1, 2, 4], 'size': ['s', 'l']}, hosts,
+                      extractor=lambda output, params: {
+                          'doubled': 2 * int(output.split()[0])},
+                      repetitions=2, runs_per_host=2)
+        values = sweep.start(wait=True)
+        results = values['results']
+        assert values['runs'] == len(results) == 12
+        assert isinstance(results['threads'], array)
+        assert isinstance(results['size'], list)
+        assert sorted(zip(results['threads'], results['doubled'])) == sorted(
+            [(t, 2.0 * t) for t in [1, 2, 4] for _ in range(4)])
+        assert sorted(results['repetition']) == [0] * 6 + [1] * 6
+        assert set(results['retcode']) == {0}
+
+    def test_failures_and_csv(self):
+        path = os.path.join(tempfile.mkdtemp(), 'results.csv')
+        store = CsvStore(path)
+        sweep = Sweep(lambda params: ['sh', '-c', 'exit %d' % params['code']],
+                      [{'code': 0}, {'code': 3}], [LocalHost()],
+                      extractor=lambda output, params: {'ok': 1},
+                      store=store, cost=lambda params: params['code'])
+        sweep.start(wait=True)
+        store.close()
+        with open(path) as f:
+            rows = list(csv.DictReader(f))
+        # The most expensive run first, and no metrics for a failed run
+        assert [(r['code'], r['retcode'], r['ok']) for r in rows] == [
+            ('3', '3', ''), ('0', '0', '1')]
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_restart(self):
+        sweep = Sweep(['sleep', '{t}'], {'t': [0.3] * 4}, [LocalHost()],
+                      runs_per_host=4)
+        for _ in range(5):
+            sweep.start()
+            time.sleep(0.1)
+            sweep.stop()
+            sweep.reset()
+        start = time.monotonic()
+        values = sweep.start(wait=True)
+        assert time.monotonic() - start >= 0.3
+        assert values['runs'] == len(values['results']) == 4
+
+    def test_column_store(self):
+        store = ColumnStore()
+        store.append({'a': 1, 'b': 'x'})
+        store.append({'a': 2, 'c': 0.5})
+        store.append({'a': 'three'})
+        assert store['a'] == [1.0, 2.0, 'three']
+        assert store['b'] == ['x', None, None]
+        assert len(store['c']) == 3 and store['c'][1] == 0.5
+
+
+class TestCache(object):
+    @classmethod
+    def setup_class(klass):
+        klass.tmp_dir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(klass):
+        shutil.rmtree(klass.tmp_dir)
+
+    def test_key_ignores_ssh_transport(self):
+        def keys(identity_file, control_persist=60):
+            host = RemoteHost('box', identity_file=identity_file,
+                              control_persist=control_persist)
+            tasks = [host.send_file('a', 'b'), host.get_file('c'),
+                     host.run(['ls', '-o'])]
+            keys = [task._cache_key() for task in tasks]
+            # Like another run, which gets a new ControlPath directory
+            pyrem.host._close_connections()
+            return keys
+
+        first = keys(None)
+        assert first == keys('~/.ssh/other')
+        assert first == keys(None, control_persist=None)
+        assert 'ControlPath' not in repr(first)
+        assert first[0] != RemoteHost('box').send_file('a', 'c')._cache_key()
+
+    def test_hit_restores_outputs(self):
+        cache = ResultCache(os.path.join(self.tmp_dir, 'cache'))
+        src, out, runs = [os.path.join(self.tmp_dir, name)
+                          for name in ['src', 'out', 'runs']]
+        with open(src, 'w') as f:
+            f.write('a')
+
+        def build():
+            command = 'echo >>%s; cp %s %s' % (runs, src, out)
+            return Cached(SubprocessTask([command], shell=True), cache,
+                          inputs=[src], outputs=[out])
+
+        assert build().start(wait=True)['cached'] is False
+        os.remove(out)
+        assert build().start(wait=True)['cached'] is True
+        with open(out) as f:
+            assert f.read() == 'a'
+        with open(src, 'w') as f:
+            f.write('b')
+        assert build().start(wait=True)['cached'] is False
+        with open(runs) as f:
+            assert len(f.readlines()) == 2
+
+    def test_eviction(self):
+        cache = ResultCache(os.path.join(self.tmp_dir, 'small'), max_bytes=0)
+        task = Cached(SubprocessTask(['true']), cache)
+        task.start(wait=True)
+        assert os.listdir(cache.directory) == []
+
+
+class TestAgent(object):
+    """Runs an agent locally, over a pipe."""
+    @classmethod
+    def setup_class(klass):
+        klass.connection = AgentConnection(['sh', '-c'], 'local',
+                                           python=sys.executable)
+
+    @classmethod
+    def teardown_class(klass):
+        klass.connection.close()
+
+    def test_output_and_retcode(self):
+        task = AgentTask(self.connection, ['echo out; echo err >&2; exit 3'],
+                         return_output=True)
+        values = task.start(wait=True)
+        assert values['stdout'] == b'out\n'
+        assert values['stderr'] == b'err\n'
+        assert values['retcode'] == 3
+        assert values['pid'] > 0
+
+    def test_stop_kills_process_group(self):
+        task = AgentTask(self.connection, ['sleep 10 & sleep 10'])
+        task.start()
+        time.sleep(0.2)
+        start = time.time()
+        task.stop()
+        assert time.time() - start < 1
+        assert task._retcode < 0
+
+    def test_stop_grace_period(self):
+        task = AgentTask(self.connection, ['trap "exit 7" TERM; sleep 10'],
+                         grace_period=5)
+        task.start()
+        time.sleep(0.2)
+        start = time.time()
+        task.stop()
+        assert time.time() - start < 1
+        assert task._retcode == 7
+
+        host = RemoteHost('local', use_agent=True)
+        host._agent = self.connection
+        task = host.run(['trap "" TERM; sleep 10'], grace_period=0.3)
+        task.start()
+        time.sleep(0.2)
+        start = time.time()
+        task.stop()
+        assert 0.3 <= time.time() - start < 2
+        assert task._retcode == -signal.SIGKILL
+
+    def test_no_sampler(self):
+        host = RemoteHost('local', use_agent=True)
+        host._agent = self.connection
+        try:
+            host.run(['true'], sampler=Sampler())
+        except ValueError:
+            pass
+        else:
+            assert False
+
+    def test_log(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            host = RemoteHost('local', use_agent=True)
+            host._agent = self.connection
+            task = host.run(['echo out; echo err >&2'],
+                            log=LogMultiplexer(tmp_dir))
+            values = task.start(wait=True)
+            assert os.path.dirname(values['log']) == tmp_dir
+            with open(values['log'], 'rb') as f:
+                assert sorted(f.read().splitlines()) == [b'err', b'out']
+            assert values['stdout'] is None
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_lost_connection(self):
+        # Kill the agent as if the ssh connection had dropped
+        connection = AgentConnection(['setsid', 'sh', '-c'],
+                                     python=sys.executable)
+        task = AgentTask(connection, ['sleep 1'])
+        task.start()
+        time.sleep(0.2)
+        os.killpg(connection._process.pid, signal.SIGKILL)
+        assert task.wait()['retcode'] == 255
+        assert connection.closed
+
+
+def test_call_later():
+    calls = []
+    done = threading.Event()
+    REACTOR.call_later(0.1, calls.append, 2)
+    REACTOR.call_later(0.05, calls.append, 1)
+    REACTOR.call_later(0.05, calls.append, 0).cancel()
+    REACTOR.call_later(0.2, done.set)
+    assert done.wait(5)
+    assert calls == [1, 2]
+
+
+def test_chrome_trace():
+    children = [SleepTask(duration=0.01) for _ in range(2)]
+    task = Parallel(children)
+    recorder = pyrem.trace.enable()
+    try:
+        task.start(wait=True)
+    finally:
+        pyrem.trace.disable()
+
+    trace = recorder.chrome_trace()['traceEvents']
+    runs = [e for e in trace if e['ph'] == 'X' and e['name'] == 'run']
+    assert len(runs) == 3
+    assert len(set(e['pid'] for e in runs)) == 1
+    names = sorted(e['args']['name'] for e in trace
+                   if e['name'] == 'thread_name')
+    assert names == ['  SleepTask', '  SleepTask', 'Parallel']
+    parent = next(e for e in runs if e['tid'] == 0)
+    for run in runs:
+        assert run['ts'] >= parent['ts']